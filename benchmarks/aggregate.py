@@ -0,0 +1,64 @@
+""" Microbenchmark of folding listed repos into a profile aggregate
+
+Usage: python -m benchmarks.aggregate --repos 10000 --page-len 100
+
+Times ProfileAggregate.add_page against a per-repo loop on the same synthetic pages, for the repo resources of both
+providers, and prints the cost per 10k repos.
+"""
+import argparse
+import timeit
+
+from benchmarks.upstream import FakeUpstreamHandler, SyntheticUser
+from service.models import BitbucketProfile, GithubProfile, ProfileAggregate
+
+
+def synthetic_pages(provider, repo_count, page_len, seed=0):
+    """ Pages of repo resources shaped like the provider's repo listing """
+    user = SyntheticUser('benchmark-user', repo_count, seed)
+    make_repo = FakeUpstreamHandler.github_repo if provider == 'github' else FakeUpstreamHandler.bitbucket_repo
+    repos = [make_repo('http://upstream', user, repo) for repo in user.repos]
+    return [repos[start:start + page_len] for start in range(0, len(repos), page_len)]
+
+
+def per_repo(pages, profile_class):
+    """ Adds each repo's fields to the aggregate one at a time """
+    aggregate = ProfileAggregate()
+    for repos in pages:
+        aggregate.total_repo_count += len(repos)
+        for repo in repos:
+            for name, field in profile_class.repo_columns.items():
+                setattr(aggregate, name, getattr(aggregate, name) + repo[field])
+            if repo[profile_class.language_field]:
+                aggregate.add_languages((repo[profile_class.language_field],))
+            if profile_class.topics_field:
+                aggregate.add_topics(repo[profile_class.topics_field])
+    return aggregate
+
+
+def per_page(pages, profile_class):
+    aggregate = ProfileAggregate()
+    for repos in pages:
+        aggregate.add_page(repos, profile_class.repo_columns, profile_class.language_field, profile_class.topics_field)
+    return aggregate
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark folding repo pages into an aggregate.')
+    parser.add_argument('--repos', type=int, default=10000, help='repos aggregated per run')
+    parser.add_argument('--page-len', type=int, default=100, help='repos per page')
+    parser.add_argument('--repeat', type=int, default=5, help='runs timed, the fastest is reported')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for provider, profile_class in (('github', GithubProfile), ('bitbucket', BitbucketProfile)):
+        pages = synthetic_pages(provider, args.repos, args.page_len)
+        assert per_repo(pages, profile_class).dump() == per_page(pages, profile_class).dump()
+        for name, reducer in (('per_repo', per_repo), ('per_page', per_page)):
+            best = min(timeit.repeat(lambda: reducer(pages, profile_class), number=1, repeat=args.repeat))
+            results[provider, name] = best * 10000 / args.repos * 1000
+            print('{:<10} {:<9} {:8.2f} ms per 10k repos'.format(provider, name, results[provider, name]))
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+""" Compares two results saved by benchmarks.run
+
+Usage: python -m benchmarks.compare before.json after.json
+"""
+import argparse
+import json
+
+# Result fields compared, and whether a larger value is better
+FIELDS = (
+    ('latency_ms.p50', False),
+    ('latency_ms.p95', False),
+    ('latency_ms.p99', False),
+    ('latency_ms.mean', False),
+    ('throughput_rps', True),
+    ('upstream_calls.total', False),
+    ('upstream_calls.per_request', False),
+    ('peak_rss_mb', False),
+    ('errors', False),
+)
+
+
+def lookup(results, field):
+    value = results
+    for key in field.split('.'):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def compare(before, after):
+    """ Rows of field, value before, value after and relative change
+
+    :param before: result saved by benchmarks.run
+    :type before: dict
+    :param after: result saved by benchmarks.run
+    :type after: dict
+    :rtype: list
+    """
+    rows = []
+    for field, larger_is_better in FIELDS:
+        old, new = lookup(before['results'], field), lookup(after['results'], field)
+        change = None
+        if old and new is not None:
+            change = (new - old) / old
+        rows.append((field, old, new, change, larger_is_better))
+    return rows
+
+
+def format_rows(rows):
+    lines = ['{:<28} {:>12} {:>12} {:>9}'.format('', 'before', 'after', 'change')]
+    for field, old, new, change, larger_is_better in rows:
+        verdict = ''
+        if change:
+            verdict = 'better' if (change > 0) == larger_is_better else 'worse'
+        lines.append('{:<28} {:>12} {:>12} {:>9} {}'.format(
+            field,
+            '-' if old is None else round(old, 2),
+            '-' if new is None else round(new, 2),
+            '-' if change is None else '{:+.1%}'.format(change),
+            verdict,
+        ))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare two benchmark results.')
+    parser.add_argument('before')
+    parser.add_argument('after')
+    args = parser.parse_args(argv)
+    with open(args.before) as before, open(args.after) as after:
+        before, after = json.load(before), json.load(after)
+    ignored = ('output',)
+    if {k: v for k, v in before['config'].items() if k not in ignored} != \
+            {k: v for k, v in after['config'].items() if k not in ignored}:
+        print('warning: the results were run with different arguments')
+    print(format_rows(compare(before, after)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+""" Benchmarks profile requests against the fake upstream
+
+Usage: python -m benchmarks.run --users 10 --repos 500 --latency 0.02 --requests 200 --concurrency 8 --output a.json
+
+Results are printed and, with --output, saved as json for benchmarks.compare. Runs with the same arguments serve the
+same synthetic users and make the same upstream calls, so results can be compared between commits.
+"""
+import argparse
+import json
+import math
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+from unittest import mock
+
+from flask import Flask
+from requests.adapters import HTTPAdapter
+
+from benchmarks.upstream import FakeUpstream, UpstreamConfig
+from service import aio, constants, handlers, models
+from service.ratelimit import UpstreamScheduler
+from service.routes import api_blueprint
+
+DRIVERS = ('handler', 'async', 'route')
+
+
+def percentile(values, percent):
+    """ Nearest rank percentile of a list of numbers """
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = math.ceil(percent / 100 * len(ordered))
+    return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on linux, bytes on macos
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def upstream_stats(upstream, reset=False):
+    with urllib.request.urlopen(upstream.base_url + ('/_reset' if reset else '/_stats')) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def clear_caches():
+    caches = (
+        handlers.consolidated_cache,
+        handlers.provider_cache,
+        handlers.snapshot_cache,
+        handlers.stale_cache,
+        handlers.partial_cache,
+    )
+    for cache in caches:
+        cache.clear()
+
+
+def point_service_at(upstream, page_len, stack):
+    """ Sends every upstream request of the service to the fake upstream, without rate limit throttling """
+    stack.enter_context(mock.patch.object(constants, 'GITHUB_PROFILE_URL', upstream.github_profile_url))
+    stack.enter_context(mock.patch.object(constants, 'BITBUCKET_PROFILE_URL', upstream.bitbucket_profile_url))
+    stack.enter_context(mock.patch.object(constants, 'BITBUCKET_TEAMS_URL', upstream.bitbucket_teams_url))
+
+    transport = models.Profile.transport
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=constants.UPSTREAM_POOL_SIZE)
+    transport.session.mount(upstream.base_url, adapter)
+    stack.enter_context(mock.patch.object(transport, 'scheduler', UpstreamScheduler(rates={})))
+    for async_class in (aio.AsyncGithubProfile, aio.AsyncBitbucketProfile):
+        stack.enter_context(mock.patch.object(async_class.async_transport, 'scheduler', UpstreamScheduler(rates={})))
+
+    github_class = partial(models.GithubProfile, page_len=page_len)
+    bitbucket_class = partial(models.BitbucketProfile, page_len=page_len)
+    stack.enter_context(mock.patch.object(handlers, 'GithubProfile', github_class))
+    stack.enter_context(mock.patch.object(handlers, 'BitbucketProfile', bitbucket_class))
+    stack.enter_context(mock.patch.dict(handlers.PROFILE_CLASSES, github=github_class, bitbucket=bitbucket_class))
+    for name in ('AsyncGithubProfile', 'AsyncBitbucketProfile'):
+        stack.enter_context(mock.patch.object(aio, name, partial(getattr(aio, name), page_len=page_len)))
+
+
+def make_driver(driver, refresh):
+    """ Function that gets the profile of a github and bitbucket username, raising on failure """
+    if driver == 'handler':
+        return lambda github, bitbucket: handlers.handle_get_profile(github, bitbucket, refresh=refresh)
+    if driver == 'async':
+        return lambda github, bitbucket: handlers.handle_get_profile_async(github, bitbucket, refresh=refresh)
+
+    app = Flask(__name__)
+    app.register_blueprint(api_blueprint)
+    clients = threading.local()
+
+    def get_profile(github, bitbucket):
+        if not hasattr(clients, 'client'):
+            clients.client = app.test_client()
+        url = '/api/profile?github={}&bitbucket={}&refresh={}'.format(github, bitbucket, str(refresh).lower())
+        response = clients.client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError('Status {}: {}'.format(response.status_code, response.get_data(as_text=True)))
+        return response.json
+
+    return get_profile
+
+
+def run_benchmark(args):
+    """ Runs a benchmark and returns its results
+
+    :param args: parsed command line arguments
+    :type args: argparse.Namespace
+    :rtype: dict
+    """
+    upstream_config = UpstreamConfig(
+        repos=args.repos, max_page_len=args.max_page_len, latency=args.latency, seed=args.seed,
+    )
+    usernames = ['user-{}'.format(index) for index in range(args.users)]
+    with FakeUpstream(upstream_config) as upstream, ExitStack() as stack:
+        point_service_at(upstream, args.page_len, stack)
+        get_profile = make_driver(args.driver, refresh=args.cache == 'cold')
+        clear_caches()
+
+        def timed_request(index):
+            username = usernames[index % len(usernames)]
+            started = time.perf_counter()
+            try:
+                get_profile(username, username)
+                return time.perf_counter() - started, None
+            except Exception as exc:
+                return time.perf_counter() - started, repr(exc)
+
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(timed_request, range(args.warmup)))
+            upstream_stats(upstream, reset=True)
+            started = time.perf_counter()
+            outcomes = list(executor.map(timed_request, range(args.requests)))
+            duration = time.perf_counter() - started
+        calls = upstream_stats(upstream)['calls']
+
+    latencies = [latency * 1000 for latency, error in outcomes if error is None]
+    errors = [error for _, error in outcomes if error is not None]
+    total_calls = sum(calls.values())
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'config': vars(args),
+        'results': {
+            'requests': len(outcomes),
+            'errors': len(errors),
+            'first_error': errors[0] if errors else None,
+            'duration_s': round(duration, 3),
+            'throughput_rps': round(len(outcomes) / duration, 2) if duration else None,
+            'latency_ms': {
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+                'mean': sum(latencies) / len(latencies) if latencies else None,
+                'max': max(latencies) if latencies else None,
+            },
+            'upstream_calls': {
+                'total': total_calls,
+                'per_request': round(total_calls / len(outcomes), 2) if outcomes else None,
+                'by_kind': calls,
+            },
+            'peak_rss_mb': peak_rss_mb(),
+        },
+    }
+
+
+def format_results(result):
+    results = result['results']
+    latency = {name: round(value, 2) if value is not None else None for name, value in results['latency_ms'].items()}
+    lines = [
+        'commit {} python {}'.format(result['commit'], result['python']),
+        'requests {requests} errors {errors} in {duration_s}s, {throughput_rps} req/s'.format(**results),
+        'latency ms p50 {p50} p95 {p95} p99 {p99} mean {mean} max {max}'.format(**latency),
+        'upstream calls {total} ({per_request} per request) {by_kind}'.format(**results['upstream_calls']),
+        'peak rss {} MB'.format(results['peak_rss_mb']),
+    ]
+    if results['first_error']:
+        lines.append('first error {}'.format(results['first_error']))
+    return '\n'.join(lines)
+
+
+parser = argparse.ArgumentParser(description='Benchmark profile requests against a fake github and bitbucket.')
+parser.add_argument('--users', type=int, default=10, help='distinct synthetic users, requests cycle through them')
+parser.add_argument('--repos', type=int, default=200, help='repos of each user on each provider')
+parser.add_argument('--page-len', type=int, default=50, help='page length requested by the service')
+parser.add_argument('--max-page-len', type=int, default=100, help='largest page length the fake upstream serves')
+parser.add_argument('--latency', type=float, default=0.01, help='seconds added to every upstream call')
+parser.add_argument('--requests', type=int, default=50, help='timed profile requests')
+parser.add_argument('--warmup', type=int, default=0, help='untimed profile requests made first')
+parser.add_argument('--concurrency', type=int, default=4, help='profile requests in flight at once')
+parser.add_argument(
+    '--driver', choices=DRIVERS, default='handler', help='handle_get_profile, its async engine or the route',
+)
+parser.add_argument(
+    '--cache', choices=('cold', 'warm'), default='cold',
+    help='cold refreshes every profile, warm lets requests use the caches',
+)
+parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic users')
+parser.add_argument('--output', help='file to save the results to as json')
+
+
+def main(argv=None):
+    args = parser.parse_args(argv)
+    result = run_benchmark(args)
+    print(format_results(result))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(result, output, indent=2, sort_keys=True)
+    return result
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+""" Fake github and bitbucket apis serving synthetic users, for benchmarking without the network
+
+Every user is generated from its username and the seed, so the same configuration always serves the same data. Github
+resources are served under /github and bitbucket resources under /bitbucket, each paginated the way its provider does.
+"""
+import json
+import multiprocessing
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+LANGUAGES = ('Python', 'JavaScript', 'Go', 'Java', 'Ruby', 'C', 'Rust', 'Shell', 'TypeScript', 'PHP', None)
+TOPICS = tuple('topic-{}'.format(index) for index in range(200))
+# Url fields of a github repo resource, served so that payloads are about as large as the real ones
+GITHUB_URL_FIELDS = (
+    'forks', 'keys', 'collaborators', 'teams', 'hooks', 'issue_events', 'events', 'assignees', 'branches', 'tags',
+    'blobs', 'git_tags', 'git_refs', 'trees', 'statuses', 'languages', 'stargazers', 'contributors', 'subscribers',
+    'subscription', 'commits', 'git_commits', 'comments', 'issue_comment', 'contents', 'compare', 'merges', 'archive',
+    'downloads', 'issues', 'pulls', 'milestones', 'notifications', 'labels', 'releases', 'deployments',
+)
+
+
+class SyntheticUser:
+    """ Repos and counts of a generated user """
+    def __init__(self, username, repo_count, seed=0):
+        rng = random.Random(zlib.crc32(username.encode('utf-8')) ^ seed)
+        self.username = username
+        self.followers = rng.randint(0, 5000)
+        self.starred = rng.randint(2, 2000)
+        self.repos = []
+        for index in range(repo_count):
+            self.repos.append({
+                'name': 'repo-{}'.format(index),
+                'updated': '2020-01-01T00:00:{:02d}Z'.format(index % 60),
+                'stars': rng.randint(0, 500),
+                'watchers': rng.randint(0, 100),
+                'open_issues': rng.randint(0, 50),
+                'has_issues': rng.random() < 0.9,
+                'size': rng.randint(0, 100000),
+                'language': rng.choice(LANGUAGES),
+                'topics': rng.sample(TOPICS, rng.randint(0, 5)),
+            })
+
+
+class UpstreamConfig:
+    """ What the fake upstream serves and how slowly
+
+    :param repos: repos of each user
+    :type repos: int
+    :param max_page_len: largest page served, larger page lengths are cut down to it like the real apis do
+    :type max_page_len: int
+    :param latency: seconds added to every call
+    :type latency: float
+    :param seed: seed for generating users
+    :type seed: int
+    """
+    def __init__(self, repos=100, max_page_len=100, latency=0.0, seed=0):
+        self.repos = repos
+        self.max_page_len = max_page_len
+        self.latency = latency
+        self.seed = seed
+
+    def dict(self):
+        return dict(vars(self))
+
+
+class FakeUpstreamServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, address, config):
+        super().__init__(address, FakeUpstreamHandler)
+        self.config = config
+        self.base_url = 'http://{}:{}'.format(*self.server_address[:2])
+        self.users = {}
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def user(self, username):
+        with self.lock:
+            if username not in self.users:
+                self.users[username] = SyntheticUser(username, self.config.repos, self.config.seed)
+            return self.users[username]
+
+    def count_call(self, provider, kind):
+        key = '{}:{}'.format(provider, kind)
+        with self.lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+
+class FakeUpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.route()
+
+    def do_GET(self):
+        self.route()
+
+    def route(self):
+        split = urlsplit(self.path)
+        parts = split.path.strip('/').split('/')
+        query = dict(parse_qsl(split.query))
+        if parts == ['_stats']:
+            return self.send_json({'calls': dict(self.server.calls)})
+        if parts == ['_reset']:
+            with self.server.lock:
+                self.server.calls.clear()
+            return self.send_json({})
+
+        if self.server.config.latency:
+            time.sleep(self.server.config.latency)
+        if parts[0] == 'github':
+            return self.github(parts[1:], query, split.path)
+        if parts[0] == 'bitbucket':
+            return self.bitbucket(parts[1:], query, split.path)
+        self.send_json({'message': 'Not Found'}, status=404)
+
+    def send_json(self, body, status=200, headers=None):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+
+    def page_bounds(self, query, name, total):
+        page_len = min(int(query.get(name, 30)), self.server.config.max_page_len)
+        page = int(query.get('page', 1))
+        return page_len, page, (page - 1) * page_len, min(page * page_len, total)
+
+    def page_url(self, path, query, page):
+        return '{}{}?{}'.format(self.server.base_url, path, urlencode(dict(query, page=page)))
+
+    def github(self, parts, query, path):
+        base = self.server.base_url + '/github'
+        if len(parts) == 2 and parts[0] == 'users':
+            user = self.server.user(parts[1])
+            self.server.count_call('github', 'profile')
+            return self.send_json({
+                'login': user.username,
+                'repos_url': '{}/users/{}/repos'.format(base, user.username),
+                'starred_url': '{}/users/{}/starred{{/owner}}{{/repo}}'.format(base, user.username),
+                'followers': user.followers,
+                'public_repos': len(user.repos),
+            })
+
+        if len(parts) == 3 and parts[0] == 'users' and parts[2] in ('repos', 'starred'):
+            user = self.server.user(parts[1])
+            total = len(user.repos) if parts[2] == 'repos' else user.starred
+            page_len, page, start, end = self.page_bounds(query, 'per_page', total)
+            last = max((total + page_len - 1) // page_len, 1)
+            links = []
+            if page < last:
+                links.append('<{}>; rel="next"'.format(self.page_url(path, query, page + 1)))
+                links.append('<{}>; rel="last"'.format(self.page_url(path, query, last)))
+            headers = {'link': ', '.join(links)} if links else {}
+            if parts[2] == 'starred':
+                self.server.count_call('github', 'count')
+                return self.send_json([{} for _ in range(start, end)], headers=headers)
+            self.server.count_call('github', 'list')
+            repos = [self.github_repo(base, user, repo) for repo in user.repos[start:end]]
+            return self.send_json(repos, headers=headers)
+
+        self.send_json({'message': 'Not Found'}, status=404)
+
+    @staticmethod
+    def github_repo(base, user, repo):
+        full_name = '{}/{}'.format(user.username, repo['name'])
+        resource = {
+            'name': repo['name'],
+            'full_name': full_name,
+            'updated_at': repo['updated'],
+            'watchers_count': repo['stars'],
+            'stargazers_count': repo['stars'],
+            'open_issues_count': repo['open_issues'],
+            'size': repo['size'],
+            'language': repo['language'],
+            'topics': repo['topics'],
+        }
+        for field in GITHUB_URL_FIELDS:
+            resource[field + '_url'] = '{}/repos/{}/{}'.format(base, full_name, field)
+        return resource
+
+    def bitbucket(self, parts, query, path):
+        base = self.server.base_url + '/bitbucket/2.0'
+        parts = parts[1:] if parts[:1] == ['2.0'] else parts
+        if len(parts) == 2 and parts[0] in ('users', 'teams'):
+            user = self.server.user(parts[1])
+            self.server.count_call('bitbucket', 'profile')
+            return self.send_json({
+                'username': user.username,
+                'links': {
+                    'repositories': {'href': '{}/repositories/{}'.format(base, user.username)},
+                    'followers': {'href': '{}/users/{}/followers'.format(base, user.username)},
+                },
+            })
+
+        if len(parts) == 3 and parts[0] == 'users' and parts[2] == 'followers':
+            self.server.count_call('bitbucket', 'count')
+            page, _ = self.bitbucket_page(path, query, self.server.user(parts[1]).followers)
+            return self.send_json(page)
+
+        if len(parts) == 2 and parts[0] == 'repositories':
+            user = self.server.user(parts[1])
+            self.server.count_call('bitbucket', 'list')
+            page, (start, end) = self.bitbucket_page(path, query, len(user.repos))
+            page['values'] = [self.bitbucket_repo(base, user, repo) for repo in user.repos[start:end]]
+            return self.send_json(page)
+
+        if len(parts) == 4 and parts[0] == 'repositories' and parts[3] in ('watchers', 'issues'):
+            repos = {repo['name']: repo for repo in self.server.user(parts[1]).repos}
+            repo = repos.get(parts[2])
+            if repo is None:
+                return self.send_json({'error': {'message': 'Repository not found'}}, status=404)
+            self.server.count_call('bitbucket', 'count')
+            total = repo['watchers'] if parts[3] == 'watchers' else repo['open_issues']
+            page, _ = self.bitbucket_page(path, query, total)
+            return self.send_json(page)
+
+        self.send_json({'error': {'message': 'Resource not found'}}, status=404)
+
+    def bitbucket_page(self, path, query, total):
+        """ A bitbucket page with empty values, and the range of the items that belong on it
+
+        pagelen=0 only returns the size.
+        """
+        if int(query.get('pagelen', 10)) == 0:
+            return {'size': total, 'pagelen': 0, 'values': []}, (0, 0)
+        page_len, page_number, start, end = self.page_bounds(query, 'pagelen', total)
+        page = {'size': total, 'page': page_number, 'pagelen': page_len, 'values': []}
+        if end < total:
+            page['next'] = self.page_url(path, query, page_number + 1)
+        return page, (start, end)
+
+    @staticmethod
+    def bitbucket_repo(base, user, repo):
+        full_name = '{}/{}'.format(user.username, repo['name'])
+        links = {'watchers': {'href': '{}/repositories/{}/watchers'.format(base, full_name)}}
+        if repo['has_issues']:
+            links['issues'] = {'href': '{}/repositories/{}/issues'.format(base, full_name)}
+        return {
+            'name': repo['name'],
+            'full_name': full_name,
+            'slug': repo['name'],
+            'updated_on': repo['updated'],
+            'size': repo['size'],
+            'language': (repo['language'] or '').lower(),
+            'links': links,
+        }
+
+
+def serve(config, address_queue):
+    server = FakeUpstreamServer(('127.0.0.1', 0), config)
+    address_queue.put(server.base_url)
+    server.serve_forever()
+
+
+class FakeUpstream:
+    """ Runs the fake upstream in a child process, so that it does not add to the peak memory of the process measured
+
+    Used as a context manager, base_url is set once the server is accepting connections.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.base_url = None
+        self.process = None
+
+    def __enter__(self):
+        address_queue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=serve, args=(self.config, address_queue), daemon=True)
+        self.process.start()
+        self.base_url = address_queue.get(timeout=30)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.process.terminate()
+        self.process.join()
+
+    @property
+    def github_profile_url(self):
+        return self.base_url + '/github/users/{username}'
+
+    @property
+    def bitbucket_profile_url(self):
+        return self.base_url + '/bitbucket/2.0/users/{username}'
+
+    @property
+    def bitbucket_teams_url(self):
+        return self.base_url + '/bitbucket/2.0/teams/{username}'
@@ -1,17 +1,41 @@
 import argparse
 
-from service import app
-from service.routes import api_blueprint
+from service import constants, create_app
+from service.handlers import start_prewarming, warm_start
 
 
 parser = argparse.ArgumentParser(description='Run Git Profile API Server.')
 parser.add_argument('-H', '--hostname', type=str, default='127.0.0.1', help='the hostname for the api server')
 parser.add_argument('-P', '--port', type=int, default='5000', help='the port for the api server')
-
-args = parser.parse_args()
-
-app.register_blueprint(api_blueprint)
+parser.add_argument(
+    '--production', action='store_true', help='serve with gunicorn worker processes instead of the development server',
+)
+parser.add_argument('-w', '--workers', type=int, default=constants.SERVER_WORKERS, help='production worker processes')
+parser.add_argument('-t', '--threads', type=int, default=constants.SERVER_THREADS, help='threads of each worker')
+parser.add_argument(
+    '--graceful-timeout', type=int, default=constants.SERVER_GRACEFUL_TIMEOUT,
+    help='seconds production workers get to finish their requests when shutting down',
+)
+parser.add_argument(
+    '--no-preload', dest='preload', action='store_false', help='create the app in every worker instead of once',
+)
 
 
 if __name__ == '__main__':
-    app.run(args.hostname, port=args.port)
+    args = parser.parse_args()
+    if args.production:
+        from service.server import options, ProductionServer
+
+        ProductionServer(options(
+            '{}:{}'.format(args.hostname, args.port),
+            workers=args.workers,
+            threads=args.threads,
+            graceful_timeout=args.graceful_timeout,
+            preload=args.preload,
+        )).run()
+    else:
+        app = create_app()
+        warm_start()
+        if constants.PREWARM_INTERVAL:
+            start_prewarming()
+        app.run(args.hostname, port=args.port)
@@ -1,4 +1,14 @@
 from flask import Flask
 
 
-app = Flask(__name__)
+def create_app():
+    """ Creates the api app with all of its routes, for servers and workers to import
+
+    :rtype: flask.Flask
+    """
+    # Imported here so that importing any module of the package does not set up the handlers' caches and executors
+    from service.routes import api_blueprint
+
+    api_app = Flask(__name__)
+    api_app.register_blueprint(api_blueprint)
+    return api_app
@@ -0,0 +1,289 @@
+""" Asyncio implementation of the profile fetch logic
+
+All coroutines run on a single event loop owned by a daemon thread, so every request thread in the process shares one
+aiohttp session and many upstream calls can be in flight at once. Like the threaded profiles, repo lists are read a
+page at a time and each page is added to the aggregates and dropped, so memory depends on page size and not on repo
+count.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+
+import aiohttp
+
+from service import codec, constants
+from service.models import BitbucketProfile, GithubProfile
+from service.ratelimit import credential_id, INTERACTIVE, scheduler
+
+
+class EventLoopThread:
+    """ Runs an event loop forever on a daemon thread """
+    def __init__(self):
+        self.loop = None
+        self._lock = threading.Lock()
+
+    def get_loop(self):
+        with self._lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=self.loop.run_forever, name='aio-loop', daemon=True)
+                thread.start()
+        return self.loop
+
+    def run(self, coro, timeout=None):
+        """ Runs a coroutine on the loop and blocks the calling thread until it finishes
+
+        :param coro: coroutine to run
+        :param timeout: seconds to wait for the result
+        :type timeout: float
+        :return: the result of the coroutine
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.get_loop())
+        try:
+            return future.result(timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+
+loop_thread = EventLoopThread()
+
+
+def run(coro, timeout=None):
+    return loop_thread.run(coro, timeout=timeout)
+
+
+class AsyncResponse:
+    """ The parts of an upstream response the profiles use, read fully before the connection is released """
+    def __init__(self, status_code, headers, links, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.links = links
+        self.content = content
+
+    def json(self):
+        return codec.parse(self.content)
+
+
+class AsyncTransport:
+    """ aiohttp counterpart of service.transport.Transport
+
+    The session is created lazily on the loop that first uses it and lives for the whole process.
+    """
+    def __init__(
+            self,
+            limit_per_host=constants.ASYNC_UPSTREAM_LIMIT_PER_HOST,
+            connect_timeout=constants.UPSTREAM_CONNECT_TIMEOUT,
+            read_timeout=constants.UPSTREAM_READ_TIMEOUT,
+            scheduler=None,
+    ):
+        self.limit_per_host = limit_per_host
+        self.scheduler = scheduler
+        self.timeout = aiohttp.ClientTimeout(connect=connect_timeout, sock_read=read_timeout)
+        self.session = None
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.limit_per_host)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self.session
+
+    async def request(self, method, url, headers=None, provider=None, priority=INTERACTIVE):
+        """ Sends a request over the shared session
+
+        :param method: http method
+        :type method: str
+        :param url: full url of the resource
+        :type url: str
+        :param headers: request headers
+        :type headers: dict
+        :param provider: provider name the scheduler tracks the request under
+        :type provider: str
+        :param priority: scheduler priority, service.ratelimit.INTERACTIVE or BACKGROUND
+        :type priority: int
+        :rtype: AsyncResponse
+        :raises service.ratelimit.RateLimitExceeded: when the scheduler sheds the request
+        """
+        scheduled = self.scheduler is not None and provider is not None
+        if scheduled:
+            credential = credential_id(headers)
+            await self.scheduler.acquire_async(provider, credential, priority)
+        async with self.get_session().request(method, url, headers=headers) as response:
+            content = await response.read()
+            links = {
+                str(rel): {'url': str(link['url'])}
+                for rel, link in response.links.items()
+            }
+            if scheduled:
+                self.scheduler.update(provider, credential, response.headers, response.status)
+            return AsyncResponse(response.status, dict(response.headers), links, content)
+
+    async def get(self, url, headers=None, **kwargs):
+        return await self.request('GET', url, headers=headers, **kwargs)
+
+    async def head(self, url, headers=None, **kwargs):
+        return await self.request('HEAD', url, headers=headers, **kwargs)
+
+
+class AsyncProfileMixin:
+    """ Sends the requests of an async profile through its async transport and the shared scheduler """
+    async def request(self, method, url, kind='list'):
+        self.spend_budget(kind)
+        headers = self.headers
+        started = time.perf_counter()
+        response = await self.async_transport.request(
+            method,
+            url,
+            headers=headers,
+            provider=self.provider,
+            priority=self.priority,
+        )
+        self.record_call(kind, method, url, response.status_code, len(response.content), started)
+        self.report_credential(headers, response)
+        return response
+
+
+class AsyncGithubProfile(AsyncProfileMixin, GithubProfile):
+    """ GithubProfile whose fetch methods are coroutines """
+    async_transport = AsyncTransport(scheduler=scheduler)
+
+    async def get_user_profile(self):
+        url = self.profile_url.format(username=self.username)
+        response = await self.request('GET', url, kind='profile')
+        self.user_profile = self.decode(response)
+
+    async def get_paginated_count(self, start_url):
+        url = start_url + self.pagination_str.format(page_len=1)
+        response = await self.request('HEAD', url, kind='count')
+        last = response.links.get('last', {}).get('url')
+        return int(last.split('page=')[-1]) if last else None
+
+    async def iter_paginated_list(self, start_url, fields=None):
+        """ Gets each page of a list in turn, only holding the page being read """
+        url = start_url + self.pagination_str.format(page_len=self.page_len)
+        while url:
+            response = await self.request('GET', url)
+            yield self.decode(response, fields)
+            url = response.links.get('next', {}).get('url')
+
+    async def get_paginated_list(self, start_url, fields=None):
+        return [item async for page in self.iter_paginated_list(start_url, fields) for item in page]
+
+    async def add_all_repos(self):
+        """ Adds each page of repos to the aggregates as it arrives """
+        async for repos in self.iter_paginated_list(self.repos_url, self.listed_repo_fields):
+            self.add_repos(repos)
+
+    async def get_all_data(self):
+        """ Retrieves all data. The repo list and starred count are requested concurrently """
+        await self.get_user_profile()
+        self.total_follower_count = self.user_profile['followers']
+        _, self.total_stars_received_count = await asyncio.gather(
+            self.add_all_repos(),
+            self.get_paginated_count(self.stars_received_url),
+        )
+
+
+class AsyncBitbucketProfile(AsyncProfileMixin, BitbucketProfile):
+    """ BitbucketProfile whose fetch methods are coroutines """
+    async_transport = AsyncTransport(scheduler=scheduler)
+
+    async def get_user_profile(self):
+        url = self.profile_url.format(username=self.username)
+        response = await self.request('GET', url, kind='profile')
+        response_body = self.decode(response)
+        if response_body.get('error', {}).get('message') == '{} is a team account'.format(self.username):
+            url = self.teams_url.format(username=self.username)
+            response = await self.request('GET', url, kind='profile')
+            response_body = self.decode(response)
+
+        self.user_profile = response_body
+
+    async def get_paginated_count(self, start_url):
+        url = start_url + self.pagination_str.format(page_len=0)
+        response = await self.request('GET', url, kind='count')
+        return self.decode(response)['size']
+
+    async def iter_paginated_list(self, start_url, fields=None):
+        """ Gets each page of a list in turn, only holding the page being read """
+        url = start_url + self.pagination_str.format(page_len=self.page_len)
+        while url:
+            response = await self.request('GET', url)
+            response_body = self.decode(response, fields)
+            self.list_sizes.setdefault(start_url, response_body.get('size'))
+            yield response_body['values']
+            url = response_body.get('next')
+
+    async def get_paginated_list(self, start_url, fields=None):
+        return [item async for page in self.iter_paginated_list(start_url, fields) for item in page]
+
+    async def iter_repos(self):
+        """ Yields each repo, adding its page to the aggregates as the page arrives """
+        async for repos in self.iter_paginated_list(self.repos_url, self.listed_repo_fields):
+            self.add_repos(repos)
+            for repo in repos:
+                yield repo
+
+    async def get_repo_counts(self, repo):
+        watcher_count = await self.get_paginated_count(repo['links']['watchers']['href'])
+        issues_link = repo['links'].get('issues', {}).get('href')
+        open_issues_count = await self.get_paginated_count(issues_link) if issues_link else 0
+        return watcher_count, open_issues_count
+
+    def add_finished_counts(self, pending):
+        """ Sums the counts of the repos at the front of pending that have finished
+
+        :param pending: deque of each repo with the task getting its counts, in repo order
+        :type pending: collections.deque
+        :return: the first exception raised by a finished task, or None
+        """
+        failure = None
+        while pending and pending[0][1].done():
+            repo, task = pending.popleft()
+            if task.exception() is not None:
+                failure = failure or task.exception()
+                continue
+            self.add_repo_counts([(repo, task.result())])
+        return failure
+
+    async def add_all_repo_counts(self, repos):
+        """ Gets and sums the watcher and open issue counts of repos as they are listed, like iter_repo_counts
+
+        At most max_in_flight repos are counted at once, and repos are read from the async iterable as slots free up.
+        Once listing or a count fails no more repos are read, the counts already in flight are still summed, and the
+        first failure is raised.
+
+        :param repos: async iterable of repo resources
+        """
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        pending = deque()
+        failure = None
+        try:
+            try:
+                async for repo in repos:
+                    await in_flight.acquire()
+                    task = asyncio.ensure_future(self.get_repo_counts(repo))
+                    task.add_done_callback(lambda _: in_flight.release())
+                    pending.append((repo, task))
+                    failure = self.add_finished_counts(pending)
+                    if failure is not None:
+                        break
+            except Exception as exc:
+                failure = exc
+            if pending:
+                await asyncio.wait([task for _, task in pending])
+            failure = self.add_finished_counts(pending) or failure
+        finally:
+            for _, task in pending:
+                task.cancel()
+        if failure is not None:
+            raise failure
+
+    async def get_all_data(self):
+        """ Retrieves all data. Makes additional requests for each repo to get counts while the repos are listed """
+        await self.get_user_profile()
+        _, self.total_follower_count = await asyncio.gather(
+            self.add_all_repo_counts(self.iter_repos()),
+            self.get_paginated_count(self.followers_url),
+        )
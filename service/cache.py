@@ -0,0 +1,337 @@
+import json
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+from service import constants
+from service.local import connect_sqlite, local_connection
+from service.resp import RespClient
+
+
+def serialize(value):
+    """ Encodes a value as compact json, compressed when that makes it smaller
+
+    :param value: json serializable value
+    :rtype: bytes
+    """
+    data = json.dumps(value, separators=(',', ':')).encode('utf-8')
+    if len(data) > constants.CACHE_COMPRESS_MIN_BYTES:
+        return b'z' + zlib.compress(data)
+    return b'j' + data
+
+
+def deserialize(data):
+    if data[:1] == b'z':
+        return json.loads(zlib.decompress(data[1:]).decode('utf-8'))
+    return json.loads(data[1:].decode('utf-8'))
+
+
+class CacheBackend:
+    """ Interface for the profile caches
+
+    Keys are tuples of strings. Subclasses implement load, set, add, delete and clear, and get hit and miss counters
+    and stampede protection from this class.
+    """
+    def __init__(self, ttl=constants.PROFILE_CACHE_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, key):
+        """ Gets a value without counting a hit or miss
+
+        :return: the cached value, or None when missing or expired
+        """
+        raise NotImplementedError
+
+    def get(self, key):
+        """ Gets a value from the cache
+
+        :param key: tuple cache key
+        :return: the cached value, or None when missing or expired
+        """
+        value = self.load(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def add(self, key, value, ttl=None):
+        """ Stores a value only if the key is missing or expired
+
+        :return: whether the value was stored
+        :rtype: bool
+        """
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def get_or_set(self, key, compute, ttl=None, lock_timeout=constants.CACHE_LOCK_TIMEOUT):
+        """ Gets a value, computing and storing it on a miss
+
+        Only the caller holding the key's lock computes the value. Every other caller, in any process sharing the
+        backend, polls for the value until the lock expires, and only then computes the value itself.
+
+        :param key: tuple cache key
+        :param compute: function returning the value to cache
+        :type compute: function
+        :param ttl: seconds until the entry expires, defaults to the cache ttl
+        :type ttl: float
+        :param lock_timeout: seconds a lock is held before other callers stop waiting for it
+        :type lock_timeout: float
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        lock_key = ('lock',) + tuple(key)
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + lock_timeout
+        while True:
+            if self.add(lock_key, token, ttl=lock_timeout):
+                try:
+                    value = self.load(key)
+                    if value is None:
+                        value = compute()
+                        self.set(key, value, ttl=ttl)
+                    return value
+                finally:
+                    if self.load(lock_key) == token:
+                        self.delete(lock_key)
+            time.sleep(constants.CACHE_LOCK_POLL_INTERVAL)
+            value = self.load(key)
+            if value is not None:
+                return value
+            if time.monotonic() > deadline:
+                return compute()
+
+    @property
+    def stats(self):
+        """ Counters describing how the cache is being used """
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class TTLCache(CacheBackend):
+    """ Thread safe in-process cache with TTL expiry and LRU eviction
+
+    Entries are evicted least recently used first once either the entry count or the approximate size of the stored
+    values goes over its bound. Sizes are approximated by the length of the json encoded value.
+    """
+    def __init__(
+            self,
+            ttl=constants.PROFILE_CACHE_TTL,
+            max_entries=constants.PROFILE_CACHE_MAX_ENTRIES,
+            max_bytes=constants.PROFILE_CACHE_MAX_BYTES,
+    ):
+        super().__init__(ttl=ttl)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, size, value = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """ Stores a value in the cache, evicting least recently used entries to stay within bounds
+
+        :param key: hashable cache key
+        :param value: json serializable value
+        :param ttl: seconds until the entry expires, defaults to the cache ttl
+        :type ttl: float
+        """
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def add(self, key, value, ttl=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                return False
+            self._store(key, value, ttl)
+            return True
+
+    def _store(self, key, value, ttl):
+        size = len(json.dumps(value))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), size, value)
+        self.current_bytes += size
+        while len(self._entries) > self.max_entries or self.current_bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.current_bytes -= size
+
+    @property
+    def stats(self):
+        """ Counters describing how the cache is being used """
+        stats = super().stats
+        stats.update({
+            'entries': len(self._entries),
+            'bytes': self.current_bytes,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        })
+        return stats
+
+
+class SqliteBackend(CacheBackend):
+    """ Cache kept in a sqlite file, shared by every process on the host
+
+    Each thread keeps its own connection. The database runs in WAL mode so readers do not block the writer.
+    """
+    def __init__(self, path, namespace='', ttl=constants.PROFILE_CACHE_TTL):
+        super().__init__(ttl=ttl)
+        self.path = path
+        self.namespace = namespace
+        self._local = threading.local()
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)'
+        )
+
+    @property
+    def connection(self):
+        return local_connection(self._local, lambda: connect_sqlite(self.path))
+
+    def make_key(self, key):
+        return ':'.join((self.namespace,) + tuple(key))
+
+    def load(self, key):
+        row = self.connection.execute(
+            'SELECT value FROM cache WHERE key = ? AND expires_at > ?', (self.make_key(key), time.time())
+        ).fetchone()
+        return deserialize(row[0]) if row else None
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        self.connection.execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+            (self.make_key(key), serialize(value), expires_at)
+        )
+
+    def add(self, key, value, ttl=None):
+        now = time.time()
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('DELETE FROM cache WHERE key = ? AND expires_at <= ?', (self.make_key(key), now))
+            cursor = connection.execute(
+                'INSERT OR IGNORE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+                (self.make_key(key), serialize(value), now + (self.ttl if ttl is None else ttl))
+            )
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return cursor.rowcount == 1
+
+    def delete(self, key):
+        self.connection.execute('DELETE FROM cache WHERE key = ?', (self.make_key(key),))
+
+    def clear(self):
+        self.connection.execute(
+            "DELETE FROM cache WHERE key LIKE ? ESCAPE '\\'",
+            (self.namespace.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + ':%',)
+        )
+
+
+class RedisBackend(CacheBackend):
+    """ Cache kept in any server speaking the redis protocol, shared by every process that can reach it """
+    def __init__(self, client, namespace='', ttl=constants.PROFILE_CACHE_TTL):
+        super().__init__(ttl=ttl)
+        self.client = client
+        self.namespace = namespace
+
+    def make_key(self, key):
+        return ':'.join((self.namespace,) + tuple(key))
+
+    def ttl_ms(self, ttl):
+        return int((self.ttl if ttl is None else ttl) * 1000)
+
+    def load(self, key):
+        data = self.client.execute('GET', self.make_key(key))
+        return deserialize(data) if data is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.execute('SET', self.make_key(key), serialize(value), 'PX', self.ttl_ms(ttl))
+
+    def add(self, key, value, ttl=None):
+        reply = self.client.execute('SET', self.make_key(key), serialize(value), 'PX', self.ttl_ms(ttl), 'NX')
+        return reply is not None
+
+    def delete(self, key):
+        self.client.execute('DEL', self.make_key(key))
+
+    def clear(self):
+        cursor = b'0'
+        while True:
+            cursor, keys = self.client.execute('SCAN', cursor, 'MATCH', self.namespace + ':*', 'COUNT', 1000)
+            if keys:
+                self.client.execute('DEL', *keys)
+            if cursor == b'0':
+                break
+
+
+def from_url(url, namespace, ttl=constants.PROFILE_CACHE_TTL):
+    """ Creates a cache backend from a url
+
+    :param url: "memory", "sqlite:///path/to/file.db" or "redis://host:port/db"
+    :type url: str
+    :param namespace: prefix that keeps keys of different caches apart in shared backends
+    :type namespace: str
+    :param ttl: default seconds until entries expire
+    :type ttl: float
+    :rtype: CacheBackend
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == 'sqlite':
+        return SqliteBackend(parsed.path, namespace=namespace, ttl=ttl)
+    if parsed.scheme == 'redis':
+        db = int(parsed.path.strip('/') or 0)
+        client = RespClient(parsed.hostname or '127.0.0.1', parsed.port or 6379, db=db)
+        return RedisBackend(client, namespace=namespace, ttl=ttl)
+    if url == 'memory':
+        return TTLCache(ttl=ttl)
+    raise ValueError('Unsupported cache url {}'.format(url))
@@ -0,0 +1,66 @@
+""" JSON decoding of upstream responses and encoding of api responses
+
+Decoding uses orjson when it is installed and the standard library otherwise. Documents are parsed straight from the
+response bytes, and pages of items can be projected down to the fields the profiles read so that only those are kept.
+Encoding always uses the standard library, so api responses are formatted the same whether orjson is installed or not.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def parse(content):
+    """ Parses a json document
+
+    :param content: utf-8 encoded document
+    :type content: bytes or str
+    :return: the parsed document
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def project(items, fields):
+    """ Copies of the items with only the given fields, fields an item lacks are left out
+
+    :param items: list of json objects
+    :type items: list
+    :param fields: names of the fields to keep
+    :type fields: tuple
+    :rtype: list
+    """
+    return [{field: item[field] for field in fields if field in item} for item in items]
+
+
+def loads(content, fields=None, items_key=None):
+    """ Parses a json document, optionally keeping only some fields of each item of a page
+
+    :param content: utf-8 encoded document
+    :type content: bytes or str
+    :param fields: names of the fields to keep of each item, all fields are kept when empty
+    :type fields: tuple
+    :param items_key: key of the list of items when the page is an object, the page itself is the list when empty
+    :type items_key: str
+    :return: the parsed document. Error bodies without a list of items are returned whole
+    """
+    body = parse(content)
+    if not fields:
+        return body
+    if items_key is None:
+        return project(body, fields) if isinstance(body, list) else body
+    if isinstance(body, dict) and isinstance(body.get(items_key), list):
+        body[items_key] = project(body[items_key], fields)
+    return body
+
+
+def dumps(value):
+    """ Encodes a value as a json document, formatted like json.dumps
+
+    :param value: json compatible value
+    :rtype: str
+    """
+    return json.dumps(value)
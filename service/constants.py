@@ -1,3 +1,125 @@
+import os
+
 GITHUB_PROFILE_URL = 'https://api.github.com/users/{username}'
 BITBUCKET_PROFILE_URL = 'https://api.bitbucket.org/2.0/users/{username}'
 BITBUCKET_TEAMS_URL = 'https://api.bitbucket.org/2.0/teams/{username}'
+GITHUB_GRAPHQL_URL = 'https://api.github.com/graphql'
+
+# How github profiles are fetched: "rest", or "graphql" for a query per 100 repos. Graphql needs GITHUB_TOKENS and
+# falls back to rest without them or when a query fails
+GITHUB_FETCH_STRATEGY = os.environ.get('GITHUB_FETCH_STRATEGY', 'rest')
+# Repos per graphql query, 100 is the most github allows
+GITHUB_GRAPHQL_PAGE_LEN = 100
+
+# Worker processes and threads per worker of the production server. Requests mostly wait on upstream apis, so a few
+# processes with many threads each serve them best. Every process has its own caches and executors
+SERVER_WORKERS = int(os.environ.get('GIT_PROFILE_SERVER_WORKERS', '2'))
+SERVER_THREADS = int(os.environ.get('GIT_PROFILE_SERVER_THREADS', '32'))
+
+# Number of worker threads shared by all requests for fetching provider profiles. Every uncached profile request holds
+# two of them for its whole crawl, one per provider, so there are two for each server thread
+PROFILE_FETCH_WORKERS = 2 * SERVER_THREADS
+# Seconds to wait for a single provider's profile before giving up
+PROFILE_FETCH_TIMEOUT = 60
+# Bounds on the crawl of a single provider profile for a request, past which the profile is returned partial with
+# estimated counts. List pages, upstream calls of any kind and seconds since the crawl started, 0 turns a bound off
+CRAWL_MAX_PAGES = int(os.environ.get('GIT_PROFILE_CRAWL_MAX_PAGES', '100'))
+CRAWL_MAX_CALLS = int(os.environ.get('GIT_PROFILE_CRAWL_MAX_CALLS', '2000'))
+CRAWL_DEADLINE = float(os.environ.get('GIT_PROFILE_CRAWL_DEADLINE', '30'))
+# Seconds the estimate of a crawl that ran out of budget is served for, while the profile is crawled in full in the
+# background
+PARTIAL_PROFILE_TTL = int(os.environ.get('GIT_PROFILE_PARTIAL_TTL', '60'))
+
+# Worker threads shared by all bitbucket profiles for per-repo watcher and issue counts
+BITBUCKET_COUNT_WORKERS = 32
+# Maximum per-repo count requests a single bitbucket profile may have in flight
+BITBUCKET_COUNT_MAX_IN_FLIGHT = 8
+
+# Hosts that get their own keep-alive connection pool
+UPSTREAM_HOSTS = ('https://api.github.com', 'https://api.bitbucket.org')
+# Connection pool size for each upstream host
+UPSTREAM_POOL_SIZE = 32
+# Retries for failed connections and 5xx responses, with exponential backoff between attempts. 429 responses and
+# Retry-After headers are left to the upstream scheduler, which sheds requests instead of sleeping through them
+UPSTREAM_RETRIES = 3
+UPSTREAM_RETRY_BACKOFF = 0.3
+UPSTREAM_RETRY_STATUSES = (500, 502, 503, 504)
+# Connect and read timeouts in seconds for each upstream request
+UPSTREAM_CONNECT_TIMEOUT = 3.05
+UPSTREAM_READ_TIMEOUT = 20
+
+# Requests per second and burst size admitted to each provider, shared by all of its credentials and split evenly
+# between the production server's worker processes
+UPSTREAM_RATES = {'github': (20, 40), 'bitbucket': (20, 40)}
+# Share of each rate limit and burst kept for user facing requests, background requests are shed below it
+UPSTREAM_BACKGROUND_RESERVE = 0.2
+# Seconds user facing and background requests wait for admission before they are shed
+UPSTREAM_INTERACTIVE_MAX_WAIT = 5
+UPSTREAM_BACKGROUND_MAX_WAIT = 30
+
+# Comma separated credentials rotated between upstream requests: github api tokens, and bitbucket username:app_password
+# pairs or oauth access tokens. Requests are sent unauthenticated when there are none
+GITHUB_TOKENS = os.environ.get('GITHUB_TOKENS', '')
+BITBUCKET_CREDENTIALS = os.environ.get('BITBUCKET_CREDENTIALS', '')
+# Seconds a credential is left out of rotation after the provider rejects it with a 401 or 403
+TOKEN_COOLDOWN = 300
+
+# Maximum concurrent connections per upstream host for the asyncio engine
+ASYNC_UPSTREAM_LIMIT_PER_HOST = 100
+
+# Send a Server-Timing header with every profile response, not only when the debug flag is set
+SERVER_TIMING = os.environ.get('GIT_PROFILE_SERVER_TIMING', '').lower() in ('1', 'true', 'yes')
+
+# Seconds a cached profile stays fresh
+PROFILE_CACHE_TTL = 300
+# Seconds an expired profile may still be served while it is refreshed in the background
+PROFILE_MAX_STALENESS = 60 * 60
+# Worker threads for background refreshes, separate from the executors serving requests
+REFRESH_WORKERS = 4
+# Seconds between background refreshes of the most requested profiles, 0 turns pre-warming off
+PREWARM_INTERVAL = int(os.environ.get('GIT_PROFILE_PREWARM_INTERVAL', '0'))
+# Number of most requested provider profiles that are pre-warmed
+PREWARM_TOP_N = int(os.environ.get('GIT_PROFILE_PREWARM_TOP_N', '100'))
+# Most provider profiles whose requests are counted for pre-warming, the least requested half is forgotten past it
+PREWARM_MAX_TRACKED = max(PREWARM_TOP_N * 10, 1000)
+# Bounds for each in-process profile cache, by entry count and approximate size in bytes
+PROFILE_CACHE_MAX_ENTRIES = 10000
+PROFILE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Bounds for the store of ETag/Last-Modified validators and the response bodies they validate
+VALIDATOR_STORE_MAX_ENTRIES = 50000
+VALIDATOR_STORE_MAX_BYTES = 256 * 1024 * 1024
+
+# Where profile caches are kept: "memory", "sqlite:///path/to/file.db" or "redis://host:port/db"
+CACHE_URL = os.environ.get('GIT_PROFILE_CACHE_URL', 'memory')
+# Cached values larger than this are zlib compressed
+CACHE_COMPRESS_MIN_BYTES = 512
+# Seconds a cache fill lock is held before other workers stop waiting for it, and how often they check for the value
+CACHE_LOCK_TIMEOUT = 60
+CACHE_LOCK_POLL_INTERVAL = 0.05
+
+# Worker threads shared by all profiles for fetching the pages of paginated lists
+PAGE_FETCH_WORKERS = 32
+# Maximum pages of a single list that are fetched at once
+PAGE_FETCH_MAX_IN_FLIGHT = 4
+
+# Worker threads shared by all batch requests for fetching provider profiles
+BATCH_FETCH_WORKERS = 16
+# Seconds a batch request waits for all of its profiles
+BATCH_FETCH_TIMEOUT = 120
+# Maximum username pairs in a single batch request
+BATCH_MAX_ITEMS = 500
+
+# Seconds per-repo snapshots are kept for incremental refreshes, after which the next refresh crawls every repo
+SNAPSHOT_TTL = 7 * 24 * 60 * 60
+# Sqlite file crawled profiles are persisted to across restarts, empty to keep them in the caches only
+SNAPSHOT_STORE_PATH = os.environ.get('GIT_PROFILE_SNAPSHOT_STORE', '')
+# Seconds between batched writes to the snapshot store
+SNAPSHOT_STORE_FLUSH_INTERVAL = 1.0
+# Most recently stored profiles loaded into the caches when a worker starts
+SNAPSHOT_WARM_START = int(os.environ.get('GIT_PROFILE_SNAPSHOT_WARM_START', '1000'))
+
+# Seconds a production worker may take on a request before it is restarted, longer than the slowest batch request
+SERVER_TIMEOUT = BATCH_FETCH_TIMEOUT + 30
+# Seconds workers are given to finish their requests after a shutdown or restart signal
+SERVER_GRACEFUL_TIMEOUT = int(os.environ.get('GIT_PROFILE_SERVER_GRACEFUL_TIMEOUT', '30'))
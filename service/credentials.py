@@ -0,0 +1,114 @@
+import base64
+import threading
+import time
+
+from service import constants
+from service.ratelimit import credential_id, scheduler
+
+
+def github_authorization(token):
+    return 'token {}'.format(token)
+
+
+def bitbucket_authorization(credential):
+    """ Basic auth for a username:app_password pair, bearer auth for an oauth access token """
+    if ':' in credential:
+        return 'Basic {}'.format(base64.b64encode(credential.encode('utf-8')).decode('ascii'))
+    return 'Bearer {}'.format(credential)
+
+
+class TokenPool:
+    """ Rotates the credentials of a provider by their remaining rate limit
+
+    Each request uses the available credential with the most remaining budget according to the scheduler, taking
+    turns between credentials with the same budget. Credentials whose budget is unknown are tried first so that their
+    budget is learnt. A credential that is rejected with a 401, or with a 403 once its rate limit is spent, is left out
+    for the cooldown.
+    """
+    def __init__(self, provider, authorizations, scheduler=scheduler, cooldown=constants.TOKEN_COOLDOWN):
+        self.provider = provider
+        self.authorizations = list(authorizations)
+        self.scheduler = scheduler
+        self.cooldown = cooldown
+        self._ids = {
+            authorization: credential_id({'authorization': authorization}) for authorization in self.authorizations
+        }
+        self._dropped_until = {}
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, provider, value, to_authorization):
+        """ Builds a pool from a comma separated list of credentials
+
+        :param provider: provider name
+        :type provider: str
+        :param value: comma separated credentials
+        :type value: str
+        :param to_authorization: function turning a credential into an Authorization header value
+        :type to_authorization: function
+        :rtype: TokenPool
+        """
+        credentials = [credential.strip() for credential in value.split(',') if credential.strip()]
+        return cls(provider, [to_authorization(credential) for credential in credentials])
+
+    def __len__(self):
+        return len(self.authorizations)
+
+    def score(self, authorization, now):
+        budget = self.scheduler.budget(self.provider, self._ids[authorization])
+        if budget.wait_time(now):
+            return -1
+        return float('inf') if budget.remaining is None else budget.remaining
+
+    def choose(self):
+        """ Picks the credential for the next request
+
+        :return: Authorization header value, or None when the pool is empty
+        :rtype: str
+        """
+        if not self.authorizations:
+            return None
+        now = time.time()
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % len(self.authorizations)
+            rotation = self.authorizations[start:] + self.authorizations[:start]
+            available = [
+                authorization for authorization in rotation
+                if self._dropped_until.get(authorization, 0) <= now
+            ]
+        # With every credential dropped, the one that has been out the longest is tried again
+        if not available:
+            return min(rotation, key=lambda authorization: self._dropped_until[authorization])
+        return max(available, key=lambda authorization: self.score(authorization, now))
+
+    def report(self, authorization, status_code, headers=None):
+        """ Drops a credential for the cooldown when the provider rejects it
+
+        A 403 only drops the credential when it has no rate limit remaining. Providers also answer 403 for resources the
+        credential may not read, such as blocked repos, which says nothing about the credential itself.
+
+        :param authorization: Authorization header value the request was sent with
+        :type authorization: str
+        :param status_code: response status code
+        :type status_code: int
+        :param headers: response headers
+        :type headers: dict
+        """
+        headers = {name.lower(): value for name, value in (headers or {}).items()}
+        exhausted = status_code == 403 and headers.get('x-ratelimit-remaining') == '0'
+        if (status_code == 401 or exhausted) and authorization in self._ids:
+            with self._lock:
+                self._dropped_until[authorization] = time.time() + self.cooldown
+
+    @property
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            dropped = sum(until > now for until in self._dropped_until.values())
+        return {'credentials': len(self.authorizations), 'dropped': dropped}
+
+
+github_pool = TokenPool.from_config('github', constants.GITHUB_TOKENS, github_authorization)
+bitbucket_pool = TokenPool.from_config('bitbucket', constants.BITBUCKET_CREDENTIALS, bitbucket_authorization)
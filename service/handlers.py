@@ -1,26 +1,609 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import as_completed, ThreadPoolExecutor, TimeoutError
+
+from service import aio, constants
+from service import cache, store
+from service.ratelimit import BACKGROUND
+from service.singleflight import AsyncSingleFlight, SingleFlight
 from service.models import (
     BitbucketProfile,
     ConsolidatedProfile,
+    CrawlBudget,
+    CrawlBudgetExhausted,
     GithubProfile,
 )
 
+logger = logging.getLogger(__name__)
+
+PROFILE_CLASSES = {'github': GithubProfile, 'bitbucket': BitbucketProfile}
+
+profile_executor = ThreadPoolExecutor(max_workers=constants.PROFILE_FETCH_WORKERS)
+# Separate from profile_executor so that large batches cannot hold up single profile requests
+batch_executor = ThreadPoolExecutor(max_workers=constants.BATCH_FETCH_WORKERS)
+# Consolidated profile dicts keyed by (github username, bitbucket username)
+consolidated_cache = cache.from_url(constants.CACHE_URL, 'consolidated')
+# Provider aggregates keyed by (provider, username), shared by every pairing that includes the username
+provider_cache = cache.from_url(constants.CACHE_URL, 'provider')
+# Per-repo snapshots of provider profiles keyed by (provider, username), used to refresh them incrementally
+snapshot_cache = cache.from_url(constants.CACHE_URL, 'snapshot', ttl=constants.SNAPSHOT_TTL)
+# Provider aggregates that stay around past their ttl for up to the max staleness, served while they are refreshed
+stale_cache = cache.from_url(
+    constants.CACHE_URL,
+    'stale',
+    ttl=constants.PROFILE_CACHE_TTL + constants.PROFILE_MAX_STALENESS,
+)
+# Estimated aggregates of crawls that ran out of budget, served without crawling again while a complete crawl runs
+partial_cache = cache.from_url(constants.CACHE_URL, 'partial', ttl=constants.PARTIAL_PROFILE_TTL)
+# Crawled profiles persisted across restarts, None when no store is configured
+snapshot_store = store.from_path(constants.SNAPSHOT_STORE_PATH)
+# Separate from the request serving executors so that refreshes cannot hold up requests
+refresh_executor = ThreadPoolExecutor(max_workers=constants.REFRESH_WORKERS)
+refreshing = set()
+refreshing_lock = threading.Lock()
+# How often each (provider, username) was requested, for pre-warming the most requested profiles
+requested = Counter()
+requested_lock = threading.Lock()
+# Concurrent get_all_data calls for the same provider and username share one fetch
+profile_flight = SingleFlight()
+async_profile_flight = AsyncSingleFlight()
+
+
+class ProfileFetchTimeout(Exception):
+    """ Raised when a provider does not return its profile in time """
+    def __init__(self, provider, username):
+        self.provider = provider
+        self.username = username
+        super().__init__('Timed out fetching {} profile for {}'.format(provider, username))
+
+
+class PartialProfile(Exception):
+    """ Raised in place of a crawl's aggregates when the crawl ran out of budget, carrying the estimated aggregates
+
+    Raising keeps the estimate out of every cache the crawl's result would otherwise be stored in.
+    """
+    def __init__(self, aggregates, reason):
+        self.aggregates = aggregates
+        self.reason = reason
+        super().__init__('Crawl ran out of budget: {}'.format(reason))
+
+
+def crawl_profile(provider, profile, incremental=True):
+    """ Runs get_all_data for a profile and stores its snapshot and stale copy
+
+    Concurrent crawls of the same profile within the process share a single get_all_data through profile_flight, as
+    long as they are either all bounded by a crawl budget or all unbounded, so that a request never waits on a
+    background crawl that has no deadline. When
+    a snapshot from an earlier fetch is available, in the snapshot cache or the snapshot store, the profile is refreshed
+    incrementally, only fetching repos updated since. The result is queued for the snapshot store.
+
+    When the profile's crawl budget runs out the counters are extrapolated from the repos crawled so far, or taken
+    from the snapshot when an incremental refresh ran out, and PartialProfile is raised with them. Nothing is stored.
+
+    :param provider: provider name
+    :type provider: str
+    :param profile: unfetched profile
+    :type profile: Profile
+    :param incremental: refresh from the snapshot when there is one, otherwise every repo is crawled
+    :type incremental: bool
+    :return: the profile's aggregates
+    :rtype: list
+    """
+    def get_all_data():
+        snapshot = snapshot_cache.get(key) if incremental else None
+        if snapshot is None and incremental and snapshot_store is not None:
+            snapshot = snapshot_store.get(*key)
+        try:
+            if snapshot is None or not profile.get_incremental_data(snapshot):
+                profile.repo_records = {}
+                profile.get_all_data()
+        except CrawlBudgetExhausted as exc:
+            if snapshot is not None and not profile.total_repo_count:
+                # Nothing was summed yet, the last complete crawl is closer than any estimate
+                profile.load_aggregates(snapshot['aggregate'])
+            else:
+                profile.extrapolate()
+            raise PartialProfile(profile.aggregates, exc.reason)
+        snapshot_cache.set(key, profile.snapshot)
+        stale_cache.set(key, profile.aggregates)
+        if snapshot_store is not None:
+            snapshot_store.put(provider, profile.username, profile.aggregates, profile.repo_records)
+        return profile.aggregates
+
+    key = (provider, profile.username)
+    return profile_flight.do(key + (profile.budget is not None,), get_all_data)
+
+
+def crawl_budgeted(provider, profile, incremental=True):
+    """ Runs crawl_profile for a request, whose profile is bounded by a CrawlBudget
+
+    A crawl that runs out of budget keeps its estimate in the partial cache and queues an unbounded crawl of the
+    profile in the background. Until that crawl fills the provider cache or the estimate expires, requests get the
+    estimate without crawling again. A forced refresh always crawls.
+
+    :param provider: provider name
+    :type provider: str
+    :param profile: unfetched profile
+    :type profile: Profile
+    :param incremental: refresh from the snapshot when there is one, otherwise every repo is crawled
+    :type incremental: bool
+    :return: the profile's aggregates
+    :rtype: list
+    :raises PartialProfile: when the crawl ran out of budget, now or recently
+    """
+    key = (provider, profile.username)
+    aggregates = partial_cache.get(key) if incremental else None
+    if aggregates is not None:
+        raise PartialProfile(aggregates, 'completing the profile in the background')
+    try:
+        return crawl_profile(provider, profile, incremental=incremental)
+    except PartialProfile as exc:
+        complete_in_background(key, exc.aggregates)
+        raise
+
+
+def complete_in_background(key, aggregates):
+    """ Serves the estimate of a partial crawl for a while and crawls the profile in full in the background """
+    partial_cache.set(key, aggregates)
+    refresh_in_background(*key)
+
+
+def load_profile(provider, profile, refresh=False):
+    """ Fills in a profile's aggregates from the provider cache, crawling the profile on a miss
+
+    Concurrent misses for the same profile wait for a single crawl, within the process through profile_flight and
+    across workers sharing the cache through its fill lock. An expired profile that is within the max staleness is
+    served as it is and refreshed in the background. Profiles missing from the caches are restored from the snapshot
+    store when it has them. A forced refresh always crawls every repo.
+
+    Crawls for the request are bounded by a CrawlBudget. A crawl that runs out of it leaves the profile partial, with
+    estimated counters that are only cached briefly while the profile is crawled in full, see crawl_budgeted.
+
+    :param provider: provider name
+    :type provider: str
+    :param profile: unfetched profile
+    :type profile: Profile
+    :param refresh: ignore the cached aggregates and fetch the profile again
+    :type refresh: bool
+    :return: whether the aggregates are stale
+    :rtype: bool
+    """
+    key = (provider, profile.username)
+    count_request(key)
+    profile.budget = CrawlBudget()
+    stale = partial = False
+    try:
+        if refresh:
+            aggregates = crawl_budgeted(provider, profile, incremental=False)
+            provider_cache.set(key, aggregates)
+        else:
+            aggregates = provider_cache.get(key)
+            if aggregates is None and restore_stored(key):
+                aggregates = provider_cache.get(key)
+            if aggregates is None:
+                aggregates = stale_cache.get(key)
+                stale = aggregates is not None
+                if stale:
+                    refresh_in_background(provider, profile.username)
+                else:
+                    aggregates = provider_cache.get_or_set(key, lambda: crawl_budgeted(provider, profile))
+    except PartialProfile as exc:
+        logger.info('Returning partial %s profile for %s: %s', provider, profile.username, exc.reason)
+        aggregates = exc.aggregates
+        partial = True
+    profile.load_aggregates(aggregates)
+    profile.partial = partial
+    return stale
+
+
+def restore(key, aggregates, stored_at, now=None):
+    """ Puts stored aggregates back into the provider cache while they are fresh, and the stale cache while they are
+    within the max staleness, each for the rest of its ttl
+
+    :param key: provider and username
+    :type key: tuple
+    :param aggregates: aggregates read from the snapshot store
+    :type aggregates: list
+    :param stored_at: unix time the aggregates were stored
+    :type stored_at: float
+    :return: whether the aggregates were recent enough to restore
+    :rtype: bool
+    """
+    age = (time.time() if now is None else now) - stored_at
+    if age < constants.PROFILE_CACHE_TTL:
+        provider_cache.set(key, aggregates, ttl=constants.PROFILE_CACHE_TTL - age)
+    max_age = constants.PROFILE_CACHE_TTL + constants.PROFILE_MAX_STALENESS
+    if age < max_age:
+        stale_cache.set(key, aggregates, ttl=max_age - age)
+        return True
+    return False
+
+
+def restore_stored(key):
+    """ Restores a profile from the snapshot store into the caches, see restore
+
+    :param key: provider and username
+    :type key: tuple
+    :rtype: bool
+    """
+    stored = snapshot_store.aggregate(*key) if snapshot_store is not None else None
+    return stored is not None and restore(key, *stored)
+
+
+def warm_start(limit=constants.SNAPSHOT_WARM_START):
+    """ Fills the caches from the most recently stored profiles, for a worker that has just started
+
+    :param limit: maximum number of profiles to read from the store
+    :type limit: int
+    :return: number of profiles restored
+    :rtype: int
+    """
+    if snapshot_store is None:
+        return 0
+    now = time.time()
+    return sum(
+        restore((provider, username), aggregates, stored_at, now)
+        for provider, username, aggregates, stored_at in snapshot_store.recent(limit)
+    )
+
+
+def count_request(key, max_tracked=constants.PREWARM_MAX_TRACKED):
+    """ Counts a request for a provider profile, only while pre-warming is on
+
+    Past max_tracked profiles the least requested half is forgotten, so one-off usernames cannot grow the counts
+    without bound.
+    """
+    if not constants.PREWARM_INTERVAL:
+        return
+    with requested_lock:
+        requested[key] += 1
+        if len(requested) > max_tracked:
+            for forgotten, _ in requested.most_common()[max_tracked // 2:]:
+                del requested[forgotten]
+
+
+def refresh_in_background(provider, username):
+    """ Crawls a profile again on the refresh executor, at background priority
+
+    :param provider: provider name
+    :type provider: str
+    :param username: username of the profile
+    :type username: str
+    :return: whether a refresh was queued, False when one is already queued or running for the profile
+    :rtype: bool
+    """
+    key = (provider, username)
+    with refreshing_lock:
+        if key in refreshing:
+            return False
+        refreshing.add(key)
+
+    def refresh():
+        try:
+            profile = PROFILE_CLASSES[provider](username)
+            profile.priority = BACKGROUND
+            provider_cache.set(key, crawl_profile(provider, profile))
+        except Exception:
+            logger.exception('Background refresh of %s profile for %s failed', provider, username)
+        finally:
+            with refreshing_lock:
+                refreshing.discard(key)
+
+    refresh_executor.submit(refresh)
+    return True
+
 
-def handle_get_profile(github_username, bitbucket_username):
+def prewarm(top_n=constants.PREWARM_TOP_N):
+    """ Refreshes the most requested profiles in the background, so that they are fresh when they are next requested
+
+    Request counts are halved after each run, so that profiles that are no longer requested drop out.
+
+    :param top_n: number of profiles to refresh
+    :type top_n: int
+    :return: provider and username of each profile queued for a refresh
+    :rtype: list
+    """
+    with requested_lock:
+        keys = [key for key, _ in requested.most_common(top_n)]
+        for key, count in list(requested.items()):
+            if count > 1:
+                requested[key] = count // 2
+            else:
+                del requested[key]
+    return [key for key in keys if refresh_in_background(*key)]
+
+
+def start_prewarming(interval=constants.PREWARM_INTERVAL, top_n=constants.PREWARM_TOP_N):
+    """ Runs prewarm every interval seconds on a daemon thread
+
+    :rtype: threading.Thread
+    """
+    def run():
+        while True:
+            time.sleep(interval)
+            prewarm(top_n)
+
+    thread = threading.Thread(target=run, name='prewarm', daemon=True)
+    thread.start()
+    return thread
+
+
+def fetch_profiles(profiles, timeout=constants.PROFILE_FETCH_TIMEOUT, refresh=False):
+    """ Loads each profile concurrently on the shared executor
+
+    Each profile gets the full timeout measured from when the fetches started. If any fetch fails or times out, the
+    remaining fetches are cancelled and the error is raised in the calling thread.
+
+    :param profiles: mapping of provider name to an unfetched profile
+    :type profiles: dict
+    :param timeout: seconds to wait for each provider
+    :type timeout: float
+    :param refresh: ignore cached aggregates and fetch every profile again
+    :type refresh: bool
+    :return: whether any of the profiles is stale
+    :rtype: bool
+    """
+    started = time.monotonic()
+    futures = {
+        provider: profile_executor.submit(load_profile, provider, profile, refresh)
+        for provider, profile in profiles.items()
+    }
+    stale = False
+    try:
+        for provider, future in futures.items():
+            remaining = max(timeout - (time.monotonic() - started), 0)
+            try:
+                stale = future.result(timeout=remaining) or stale
+            except TimeoutError:
+                raise ProfileFetchTimeout(provider, profiles[provider].username)
+        return stale
+    finally:
+        for future in futures.values():
+            future.cancel()
+
+
+async def fetch_profiles_async(profiles, timeout=constants.PROFILE_FETCH_TIMEOUT, refresh=False):
+    """ Coroutine counterpart of fetch_profiles for async profiles
+
+    Uses the provider cache but not its fill lock, waiting on the lock would block the event loop. A fetch that times
+    out keeps running for any other coroutine waiting on it and still fills the cache. Fetches are bounded by a
+    CrawlBudget, with partial results handled like in crawl_budgeted, and collect per-repo records for the snapshot
+    cache and store like crawl_profile.
+
+    :param profiles: mapping of provider name to an unfetched async profile
+    :type profiles: dict
+    :param timeout: seconds to wait for each provider
+    :type timeout: float
+    :param refresh: ignore cached aggregates and fetch every profile again
+    :type refresh: bool
+    """
+    async def get_all_data(key, profile):
+        profile.repo_records = {}
+        try:
+            await profile.get_all_data()
+        except CrawlBudgetExhausted as exc:
+            profile.extrapolate()
+            raise PartialProfile(profile.aggregates, exc.reason)
+        provider_cache.set(key, profile.aggregates)
+        snapshot_cache.set(key, profile.snapshot)
+        stale_cache.set(key, profile.aggregates)
+        if snapshot_store is not None:
+            snapshot_store.put(*key, profile.aggregates, profile.repo_records)
+        return profile.aggregates
+
+    async def fetch(provider, profile):
+        key = (provider, profile.username)
+        aggregates = None if refresh else provider_cache.get(key)
+        if aggregates is None and not refresh:
+            aggregates = partial_cache.get(key)
+            profile.partial = aggregates is not None
+        if aggregates is None:
+            profile.budget = CrawlBudget()
+            try:
+                aggregates = await asyncio.wait_for(
+                    async_profile_flight.do(key, lambda: get_all_data(key, profile)),
+                    timeout,
+                )
+            except asyncio.TimeoutError:
+                raise ProfileFetchTimeout(provider, profile.username)
+            except PartialProfile as exc:
+                aggregates = exc.aggregates
+                profile.partial = True
+                complete_in_background(key, aggregates)
+        profile.load_aggregates(aggregates)
+
+    tasks = [asyncio.ensure_future(fetch(provider, profile)) for provider, profile in profiles.items()]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def get_consolidated_profile(profiles, fetch, refresh=False):
+    """ Gets a consolidated profile from the cache, or from its providers on a miss
+
+    :param profiles: mapping of provider name to an unfetched profile, github first then bitbucket
+    :type profiles: dict
+    :param fetch: function that loads a mapping of profiles, taking a refresh flag and returning whether any of them
+        is stale
+    :type fetch: function
+    :param refresh: ignore cached data and fetch every provider again
+    :type refresh: bool
+    :return: consolidated user info for both profiles
+    :rtype: dict
+    """
+    github_profile, bitbucket_profile = profiles.values()
+    key = (github_profile.username, bitbucket_profile.username)
+    if not refresh:
+        profile_dict = consolidated_cache.get(key)
+        if profile_dict is not None:
+            return profile_dict
+
+    stale = fetch(profiles, refresh=refresh)
+    profile_dict = ConsolidatedProfile(github_profile, bitbucket_profile).dict
+    # Stale and partial profiles are not cached, so the complete aggregates are used as soon as they are ready
+    if not stale and not (github_profile.partial or bitbucket_profile.partial):
+        consolidated_cache.set(key, profile_dict)
+    return profile_dict
+
+
+def handle_get_profile(github_username, bitbucket_username, refresh=False, trace=None):
     """ Handler for get profile.
 
+    The github and bitbucket profiles are fetched concurrently. Consolidated profiles and each provider's aggregates
+    are cached.
+
+    :param github_username: username of a github user
+    :type github_username: str
+    :param bitbucket_username: username of a bitbucket user
+    :type bitbucket_username: str
+    :param refresh: ignore cached data and fetch both profiles again
+    :type refresh: bool
+    :param trace: trace to record the upstream calls of both profiles in
+    :type trace: service.tracing.Trace
+    :return: consolidated user info for both profiles
+    :rtype: dict
+    """
+    profiles = {
+        'github': GithubProfile(github_username),
+        'bitbucket': BitbucketProfile(bitbucket_username),
+    }
+    for profile in profiles.values():
+        profile.trace = trace
+    return get_consolidated_profile(profiles, fetch_profiles, refresh=refresh)
+
+
+def handle_get_profile_async(github_username, bitbucket_username, refresh=False, trace=None):
+    """ Handler for get profile using the asyncio engine.
+
+    Both profiles and all of their upstream calls run on the shared event loop, the calling thread only waits for the
+    result. Uses the same caches as handle_get_profile.
+
     :param github_username: username of a github user
     :type github_username: str
     :param bitbucket_username: username of a bitbucket user
     :type bitbucket_username: str
+    :param refresh: ignore cached data and fetch both profiles again
+    :type refresh: bool
+    :param trace: trace to record the upstream calls of both profiles in
+    :type trace: service.tracing.Trace
     :return: consolidated user info for both profiles
     :rtype: dict
     """
-    github_profile = GithubProfile(github_username)
-    github_profile.get_all_data()
+    profiles = {
+        'github': aio.AsyncGithubProfile(github_username),
+        'bitbucket': aio.AsyncBitbucketProfile(bitbucket_username),
+    }
+    for profile in profiles.values():
+        profile.trace = trace
+    return get_consolidated_profile(
+        profiles,
+        lambda async_profiles, refresh: aio.run(fetch_profiles_async(async_profiles, refresh=refresh)),
+        refresh=refresh,
+    )
+
+
+def load_batch_profile(provider, profile, refresh=False):
+    stale = load_profile(provider, profile, refresh=refresh)
+    return profile, stale
+
 
-    bitbucket_profile = BitbucketProfile(bitbucket_username)
-    bitbucket_profile.get_all_data()
+def iter_profiles(pairs, refresh=False, timeout=constants.BATCH_FETCH_TIMEOUT):
+    """ Gets consolidated profiles for many username pairs, yielding each one as soon as it is ready
+
+    Each distinct github and bitbucket username is loaded once on the batch executor, no matter how many pairs it
+    appears in. A failure only affects the items that include the failing profile.
+
+    :param pairs: list of dicts with github and bitbucket usernames
+    :type pairs: list
+    :param refresh: ignore cached data and fetch every profile again
+    :type refresh: bool
+    :param timeout: seconds to wait for the whole batch
+    :type timeout: float
+    :return: generator of (index of the pair, item) with either a profile or an error for each pair
+    :rtype: generator
+    """
+    usernames = {}
+    futures = {}
+    waiting = {}
+    for index, pair in enumerate(pairs):
+        missing = [key for key in ('github', 'bitbucket') if not isinstance(pair, dict) or key not in pair]
+        if missing:
+            yield index, {'error': 'No {} in item'.format(missing[0])}
+            continue
+        invalid = [key for key in ('github', 'bitbucket') if not isinstance(pair[key], str) or not pair[key]]
+        if invalid:
+            yield index, {'error': 'Invalid {} username in item'.format(invalid[0])}
+            continue
 
-    profile = ConsolidatedProfile(github_profile, bitbucket_profile)
+        item = {'github': pair['github'], 'bitbucket': pair['bitbucket']}
+        profile_dict = None if refresh else consolidated_cache.get((item['github'], item['bitbucket']))
+        if profile_dict is not None:
+            item['profile'] = profile_dict
+            yield index, item
+            continue
 
-    return profile.dict
+        usernames[index] = item
+        for key, profile_class in (('github', GithubProfile), ('bitbucket', BitbucketProfile)):
+            provider_key = (key, item[key])
+            if provider_key not in futures:
+                profile = profile_class(item[key])
+                futures[provider_key] = batch_executor.submit(load_batch_profile, key, profile, refresh)
+            waiting.setdefault(provider_key, []).append(index)
+
+    def build_item(index):
+        item = usernames.pop(index)
+        github_future = futures[('github', item['github'])]
+        bitbucket_future = futures[('bitbucket', item['bitbucket'])]
+        for provider, future in (('github', github_future), ('bitbucket', bitbucket_future)):
+            if future.exception() is not None:
+                item['error'] = 'Failed to fetch {} profile for {}'.format(provider, item[provider])
+                return item
+        (github_profile, github_stale), (bitbucket_profile, bitbucket_stale) = (
+            github_future.result(),
+            bitbucket_future.result(),
+        )
+        profile_dict = ConsolidatedProfile(github_profile, bitbucket_profile).dict
+        # Like get_consolidated_profile, stale and partial profiles are not cached
+        stale = github_stale or bitbucket_stale
+        if not stale and not (github_profile.partial or bitbucket_profile.partial):
+            consolidated_cache.set((item['github'], item['bitbucket']), profile_dict)
+        item['profile'] = profile_dict
+        return item
+
+    provider_keys = {future: provider_key for provider_key, future in futures.items()}
+    remaining = {index: 2 for index in usernames}
+    try:
+        for future in as_completed(provider_keys, timeout=timeout):
+            for index in waiting[provider_keys[future]]:
+                remaining[index] -= 1
+                if not remaining[index]:
+                    yield index, build_item(index)
+    except TimeoutError:
+        for index in list(usernames):
+            item = usernames.pop(index)
+            item['error'] = 'Timed out fetching profiles'
+            yield index, item
+    finally:
+        for future in futures.values():
+            future.cancel()
+
+
+def handle_get_profiles(pairs, refresh=False):
+    """ Handler for get profiles.
+
+    :param pairs: list of dicts with github and bitbucket usernames
+    :type pairs: list
+    :param refresh: ignore cached data and fetch every profile again
+    :type refresh: bool
+    :return: an item with either a profile or an error for each pair, in the same order as the pairs
+    :rtype: list
+    """
+    items = [None] * len(pairs)
+    for index, item in iter_profiles(pairs, refresh=refresh):
+        items[index] = item
+    return items
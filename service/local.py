@@ -0,0 +1,36 @@
+""" Connections kept per thread and never shared with a forked process
+
+Thread locals carry over into a process forked from their thread, which would leave a preloaded server's workers
+talking over the connections of the master. Connections opened in another process are replaced by new ones instead.
+"""
+import os
+import sqlite3
+
+
+def local_connection(local, connect):
+    """ The calling thread's connection, opened with connect when the thread has none in this process yet
+
+    :param local: threading.local the connection is kept on
+    :type local: threading.local
+    :param connect: opens a new connection
+    :type connect: callable
+    :return: the connection returned by connect
+    """
+    connection = getattr(local, 'connection', None)
+    if connection is None or local.pid != os.getpid():
+        connection = connect()
+        local.connection = connection
+        local.pid = os.getpid()
+    return connection
+
+
+def connect_sqlite(path):
+    """ Opens a sqlite database in autocommit and WAL mode, so readers do not block the writer
+
+    :param path: database file
+    :type path: str
+    :rtype: sqlite3.Connection
+    """
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    return connection
@@ -0,0 +1,176 @@
+""" In-process metrics in the Prometheus text exposition format
+
+Each metric keeps its values in a dict keyed by label values behind its own lock, so recording a value from any worker
+thread is a dict lookup and an addition.
+"""
+import math
+import threading
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape(value)) for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """ Base class for metrics with a value for each combination of label values """
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        """ Lines of the metric's values
+
+        :rtype: list
+        """
+        with self._lock:
+            values = sorted(self._values.items())
+        return [
+            '{}{} {}'.format(self.name, format_labels(self.labels, key), format_value(value))
+            for key, value in values
+        ]
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.type)]
+        return lines + self.samples()
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+    # Seconds, from a fast cache hit up to a full crawl of a large team
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [[0] * len(self.buckets), 0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][index] += 1
+                    break
+            counts[1] += value
+            counts[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = [
+                (key, list(bucket_counts), total, count)
+                for key, (bucket_counts, total, count) in sorted(self._values.items())
+            ]
+        lines = []
+        for key, bucket_counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                labels = format_labels(self.labels, key, [('le', format_value(bound))])
+                lines.append('{}_bucket{} {}'.format(self.name, labels, cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, format_labels(self.labels, key), format_value(total)))
+            lines.append('{}_count{} {}'.format(self.name, format_labels(self.labels, key), count))
+        return lines
+
+
+class Registry:
+    """ Metrics of the process, along with collectors that build metrics from other state when they are scraped """
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=Histogram.default_buckets):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def add_collector(self, collector):
+        """ Adds a function that returns a list of metrics each time the registry is rendered
+
+        :param collector: function returning a list of Metric
+        :type collector: function
+        """
+        self.collectors.append(collector)
+
+    def render(self):
+        """ All metrics in the Prometheus text exposition format
+
+        :rtype: str
+        """
+        metrics = list(self.metrics)
+        for collector in self.collectors:
+            metrics += collector()
+        return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+
+registry = Registry()
+
+request_duration = registry.histogram(
+    'git_profile_request_duration_seconds',
+    'Time taken to serve api requests',
+    ('route', 'method', 'status'),
+)
+requests_in_flight = registry.gauge(
+    'git_profile_requests_in_flight',
+    'Api requests being served',
+    ('route',),
+)
+upstream_requests = registry.counter(
+    'git_profile_upstream_requests_total',
+    'Requests sent to the providers',
+    ('provider', 'kind', 'status'),
+)
+upstream_duration = registry.histogram(
+    'git_profile_upstream_request_duration_seconds',
+    'Time taken by requests to the providers',
+    ('provider', 'kind'),
+)
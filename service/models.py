@@ -1,39 +1,548 @@
 import json
-import requests
+import math
+import sys
+import threading
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import chain
+from operator import itemgetter
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from service import codec, constants, metrics
+from service.credentials import bitbucket_pool, github_pool
+from service.ratelimit import CORE, INTERACTIVE, scheduler
+from service.tracing import phase
+from service.transport import Transport
+
+
+count_executor = ThreadPoolExecutor(max_workers=constants.BITBUCKET_COUNT_WORKERS)
+page_executor = ThreadPoolExecutor(max_workers=constants.PAGE_FETCH_WORKERS)
+
+# Only the fields that are aggregated. Open pull requests are counted as open issues like in the rest api
+GITHUB_REPOS_QUERY = '''
+query($login: String!, $first: Int!, $after: String) {
+  user(login: $login) {
+    followers { totalCount }
+    starredRepositories { totalCount }
+    repositories(first: $first, after: $after, ownerAffiliations: OWNER, privacy: PUBLIC) {
+      totalCount
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        nameWithOwner
+        updatedAt
+        stargazerCount
+        diskUsage
+        primaryLanguage { name }
+        issues(states: OPEN) { totalCount }
+        pullRequests(states: OPEN) { totalCount }
+        repositoryTopics(first: 100) { nodes { topic { name } } }
+      }
+    }
+  }
+}
+'''
+
+
+class GraphQLError(Exception):
+    """ Raised when a graphql query is rejected or answers with errors """
+
+
+class CrawlBudgetExhausted(Exception):
+    """ Raised in place of an upstream request once the crawl budget of its profile is spent """
+    def __init__(self, reason):
+        self.reason = reason
+        super().__init__('Crawl budget exhausted: {}'.format(reason))
+
+
+class CrawlBudget:
+    """ Bounds on the upstream requests of a single profile crawl
+
+    Shared by every thread the crawl's requests run on. A bound of 0 is no bound.
+
+    :param max_pages: list pages that may be requested
+    :type max_pages: int
+    :param max_calls: upstream requests of any kind that may be sent
+    :type max_calls: int
+    :param deadline: seconds from now after which no more requests may be sent
+    :type deadline: float
+    """
+    def __init__(
+            self,
+            max_pages=constants.CRAWL_MAX_PAGES,
+            max_calls=constants.CRAWL_MAX_CALLS,
+            deadline=constants.CRAWL_DEADLINE,
+    ):
+        self.max_pages = max_pages
+        self.max_calls = max_calls
+        self.deadline = time.monotonic() + deadline if deadline else None
+        self.pages = 0
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def spend(self, kind):
+        """ Counts a request that is about to be sent
+
+        :param kind: what the request fetches: profile, list or count
+        :type kind: str
+        :raises CrawlBudgetExhausted: when the request would go over a bound
+        """
+        with self._lock:
+            if self.deadline is not None and time.monotonic() >= self.deadline:
+                raise CrawlBudgetExhausted('deadline')
+            if self.max_calls and self.calls >= self.max_calls:
+                raise CrawlBudgetExhausted('calls')
+            if kind == 'list' and self.max_pages and self.pages >= self.max_pages:
+                raise CrawlBudgetExhausted('pages')
+            self.calls += 1
+            if kind == 'list':
+                self.pages += 1
+
+
+def get_page_number(url):
+    """ Gets the value of the page query parameter of a url
+
+    :param url: url of a page of a paginated list
+    :type url: str
+    :return: the page number, or None if the url has none
+    :rtype: int
+    """
+    page = dict(parse_qsl(urlsplit(url).query)).get('page')
+    return int(page) if page else None
+
+
+def set_page_number(url, page):
+    """ Sets the page query parameter of a url, keeping all other parameters
+
+    :param url: url of a page of a paginated list
+    :type url: str
+    :param page: page number
+    :type page: int
+    :rtype: str
+    """
+    parts = urlsplit(url)
+    query = [(key, value) for key, value in parse_qsl(parts.query) if key != 'page']
+    query.append(('page', str(page)))
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+class ProfileAggregate:
+    """ Compact record of the counts, languages and topics aggregated from a profile
+
+    Uses slots instead of an instance dict, and interns language and topic strings so that the many cached aggregates
+    in a worker share a single copy of each name.
+    """
+    COUNTERS = (
+        'total_repo_count',
+        'total_watcher_count',
+        'total_follower_count',
+        'total_stars_received_count',
+        'total_stars_given_count',
+        'total_open_issues_count',
+        'total_size',
+    )
+    __slots__ = COUNTERS + ('languages_used', 'repo_topics')
+
+    def __init__(self):
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        self.languages_used = set()
+        self.repo_topics = set()
+
+    def add_languages(self, languages):
+        self.languages_used.update(map(sys.intern, languages))
+
+    def add_topics(self, topics):
+        self.repo_topics.update(map(sys.intern, topics))
+
+    def add_page(self, repos, columns, language_field=None, topics_field=None):
+        """ Folds a page of repos into the aggregate
+
+        Each counter is summed over its whole column of the page at once, and languages and topics are added to the
+        existing sets in place, so the cost per repo is a few item lookups no matter how many topics were seen before.
+
+        :param repos: page of repo resources
+        :type repos: list
+        :param columns: counter names mapped to the repo field summed into them
+        :type columns: dict
+        :param language_field: repo field holding the language, empty languages are skipped
+        :type language_field: str
+        :param topics_field: repo field holding a list of topics
+        :type topics_field: str
+        """
+        self.total_repo_count += len(repos)
+        for name, field in columns.items():
+            setattr(self, name, getattr(self, name) + sum(map(itemgetter(field), repos)))
+        if language_field:
+            self.add_languages(filter(None, map(itemgetter(language_field), repos)))
+        if topics_field:
+            self.add_topics(chain.from_iterable(map(itemgetter(topics_field), repos)))
+
+    def merge(self, other):
+        """ Combines two aggregates into a new one
+
+        Costs one addition per counter plus the union of the language and topic sets, no matter how many repos were
+        aggregated.
+
+        :param other: aggregate to combine with this one
+        :type other: ProfileAggregate
+        :rtype: ProfileAggregate
+        """
+        merged = ProfileAggregate()
+        for name in self.COUNTERS:
+            setattr(merged, name, getattr(self, name) + getattr(other, name))
+        merged.languages_used = self.languages_used | other.languages_used
+        merged.repo_topics = self.repo_topics | other.repo_topics
+        return merged
+
+    def dump(self):
+        """ Serializes the aggregate as a flat json compatible list, counters first then languages and topics
+
+        :rtype: list
+        """
+        return [getattr(self, name) for name in self.COUNTERS] + [sorted(self.languages_used), sorted(self.repo_topics)]
+
+    @classmethod
+    def load(cls, dumped):
+        """ Restores an aggregate serialized by dump
 
-from service import constants
+        :param dumped: list produced by dump
+        :type dumped: list
+        :rtype: ProfileAggregate
+        """
+        aggregate = cls()
+        for name, value in zip(cls.COUNTERS, dumped):
+            setattr(aggregate, name, value)
+        aggregate.add_languages(dumped[-2])
+        aggregate.add_topics(dumped[-1])
+        return aggregate
+
+
+def aggregate_property(name):
+    """ Property exposing an attribute of a profile's aggregate as an attribute of the profile """
+    def getter(self):
+        return getattr(self.aggregate, name)
+
+    def setter(self, value):
+        setattr(self.aggregate, name, value)
+
+    return property(getter, setter)
 
 
 class Profile:
     """ Base Profile class with shared logic for github and bitbucket """
-    def __init__(self, username, page_len=50):
+    transport = Transport(scheduler=scheduler)
+    provider = None
+    # Credentials rotated between the profile's requests, requests are unauthenticated without any
+    token_pool = None
+    # Scheduler priority of every upstream request made for the profile
+    priority = INTERACTIVE
+    # service.tracing.Trace of the api request the profile is fetched for, if it is being traced
+    trace = None
+    # CrawlBudget bounding the profile's requests, unbounded without one
+    budget = None
+    max_page_requests = constants.PAGE_FETCH_MAX_IN_FLIGHT
+    # Counters summed from fields of the listed repos, and the fields languages and topics are collected from
+    repo_columns = {}
+    language_field = None
+    topics_field = None
+    # Fields read from listed repos, other fields are dropped as pages are decoded unless keep_repos is set
+    repo_fields = ()
+    # Key of the list of items in a page, when pages are objects rather than lists
+    page_items_key = None
+
+    total_repo_count = aggregate_property('total_repo_count')
+    total_watcher_count = aggregate_property('total_watcher_count')
+    total_follower_count = aggregate_property('total_follower_count')
+    total_stars_received_count = aggregate_property('total_stars_received_count')
+    total_stars_given_count = aggregate_property('total_stars_given_count')
+    total_open_issues_count = aggregate_property('total_open_issues_count')
+    total_size = aggregate_property('total_size')
+    languages_used = aggregate_property('languages_used')
+    repo_topics = aggregate_property('repo_topics')
+
+    def __init__(self, username, page_len=50, keep_repos=False, keep_records=False):
         self.username = username
         self.page_len = page_len
+        self.keep_repos = keep_repos
+        self.user_profile = {}
+        self.repos = []
+        self.aggregate = ProfileAggregate()
+        # Per-repo records of the aggregated fields keyed by repo name, kept for incremental refreshes
+        self.repo_records = {} if keep_records else None
+        # Whether the crawl ran out of budget, leaving the per-repo counters estimated
+        self.partial = False
+
+    def reset(self):
+        """ Forgets everything fetched so far, so the profile can be fetched again from scratch """
         self.user_profile = {}
         self.repos = []
+        self.aggregate = ProfileAggregate()
+        if self.repo_records is not None:
+            self.repo_records = {}
+        self.partial = False
 
-        self.total_repo_count = 0
-        self.total_watcher_count = 0
-        self.total_follower_count = 0
-        self.total_stars_received_count = 0
-        self.total_stars_given_count = 0
-        self.total_open_issues_count = 0
-        self.total_size = 0
-        self.languages_used = set()
-        self.repo_topics = set()
+    @property
+    def snapshot(self):
+        """ The aggregate and per-repo records needed to refresh the profile incrementally later """
+        return {'aggregate': self.aggregates, 'repos': self.repo_records}
+
+    def get_incremental_data(self, snapshot):
+        """ Updates the aggregate from a previous snapshot, only fetching repos updated since it was taken
+
+        Repos are listed most recently updated first, and listing stops at the first repo that is unchanged since the
+        snapshot. Counters are adjusted by the difference between the old and new records of each changed repo.
+        Languages and topics are collected again from the records.
+
+        :param snapshot: snapshot taken after a previous fetch
+        :type snapshot: dict
+        :return: whether the snapshot could be brought up to date. False when repos were deleted or renamed, in which
+            case the profile's aggregate is left untouched
+        :rtype: bool
+        """
+        self.get_user_profile()
+        records = dict(snapshot['repos'])
+        changed = OrderedDict()
+        pages = self.iter_paginated_list(
+            self.repos_url, parallel=False, sort_str=self.sort_str, fields=self.listed_repo_fields,
+        )
+        try:
+            for repos in pages:
+                unchanged = False
+                for repo in repos:
+                    record = records.get(repo['full_name'])
+                    unchanged = record is not None and record[0] == self.repo_marker(repo)
+                    if unchanged:
+                        break
+                    changed[repo['full_name']] = repo
+                if unchanged:
+                    break
+        finally:
+            pages.close()
+
+        if len(records) + sum(key not in records for key in changed) != self.get_repo_total():
+            return False
+
+        aggregate = ProfileAggregate.load(snapshot['aggregate'])
+        for repo, counts in self.iter_changed_counts(changed.values()):
+            new_record = self.repo_record(repo, counts)
+            old_record = records.get(repo['full_name'])
+            for position, name in enumerate(self.record_counters, start=1):
+                difference = new_record[position] - (old_record[position] if old_record else 0)
+                setattr(aggregate, name, getattr(aggregate, name) + difference)
+            records[repo['full_name']] = new_record
+
+        aggregate.total_repo_count = len(records)
+        aggregate.languages_used = set()
+        aggregate.repo_topics = set()
+        aggregate.add_languages(filter(None, map(itemgetter(-2), records.values())))
+        aggregate.add_topics(chain.from_iterable(map(itemgetter(-1), records.values())))
+
+        self.aggregate = aggregate
+        self.repo_records = records
+        self.get_profile_counts()
+        return True
+
+    @property
+    def aggregates(self):
+        """ The aggregate in its compact serialized form, see ProfileAggregate.dump """
+        return self.aggregate.dump()
+
+    def load_aggregates(self, aggregates):
+        """ Restores the aggregated counts, languages and topics without fetching anything
+
+        :param aggregates: list produced by the aggregates property
+        :type aggregates: list
+        """
+        self.aggregate = ProfileAggregate.load(aggregates)
+
+    def iter_pages(self, urls, get_page):
+        """ Fetches pages on the shared page executor, at most max_page_requests at once
+
+        :param urls: urls of the pages to fetch
+        :type urls: list
+        :param get_page: function that fetches the items of a page from its url
+        :type get_page: function
+        :return: generator of the items of each page, in the same order as the urls
+        :rtype: generator
+        """
+        pending = deque()
+        try:
+            for url in urls:
+                if len(pending) >= self.max_page_requests:
+                    yield pending.popleft().result()
+                pending.append(page_executor.submit(get_page, url))
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def get_paginated_list(self, start_url):
+        """ Sends get requests to get a full list of resources at an endpoint
+
+        :param start_url: url of the first page of an endpoint
+        :type start_url: str
+        """
+        return [item for page in self.iter_paginated_list(start_url) for item in page]
+
+    def add_repos(self, repos):
+        """ Adds a page of repos to the aggregates, only keeping the repos themselves if keep_repos is set
+
+        :param repos: page of repo resources
+        :type repos: list
+        """
+        if self.keep_repos:
+            self.repos += repos
+        with phase(self.trace, 'aggregate'):
+            self.aggregate_repos(repos)
+
+    def aggregate_repos(self, repos):
+        """ Sums the repo_columns and collects the languages and topics of a page of repos
+
+        :param repos: page of repo resources
+        :type repos: list
+        """
+        self.aggregate.add_page(repos, self.repo_columns, self.language_field, self.topics_field)
+
+    def request(self, method, url, conditional=False, data=None, kind='list', resource=CORE):
+        """ Sends a request for the profile through the shared transport and scheduler
+
+        :param method: http method
+        :type method: str
+        :param url: full url of the resource
+        :type url: str
+        :param conditional: send and store ETag/Last-Modified validators
+        :type conditional: bool
+        :param data: request body
+        :type data: str
+        :param kind: what the request fetches: profile, list or count
+        :type kind: str
+        :param resource: rate limit resource of the provider the request counts against
+        :type resource: str
+        :rtype: requests.Response
+        :raises CrawlBudgetExhausted: when the profile's crawl budget is spent
+        """
+        self.spend_budget(kind)
+        headers = self.headers
+        started = time.perf_counter()
+        response = self.transport.request(
+            method,
+            url,
+            headers=headers,
+            conditional=conditional,
+            provider=self.provider,
+            priority=self.priority,
+            data=data,
+            resource=resource,
+        )
+        self.record_call(kind, method, url, response.status_code, len(response.content), started)
+        self.report_credential(headers, response)
+        return response
+
+    def spend_budget(self, kind):
+        """ Counts a request against the profile's crawl budget, if it has one """
+        if self.budget is not None:
+            self.budget.spend(kind)
+
+    def sampled_counters(self):
+        """ Number of repos each per-repo counter has been summed over so far
+
+        :rtype: dict
+        """
+        return {name: self.total_repo_count for name in self.repo_columns}
+
+    def known_repo_total(self):
+        """ Repo total of the profile when the provider already reported it, None otherwise """
+        return None
+
+    def extrapolate(self):
+        """ Scales the per-repo counters of a partial crawl up to the repo total the provider reported
+
+        Each counter is multiplied by the repo total over the number of repos it was summed over. Counters are left as
+        they are when the repo total is unknown or none of its repos were summed. Languages and topics are only those
+        of the repos that were listed.
+        """
+        total = self.known_repo_total()
+        if not total:
+            return
+        for name, sampled in self.sampled_counters().items():
+            if 0 < sampled < total:
+                setattr(self, name, int(round(getattr(self, name) * total / sampled)))
+        self.total_repo_count = max(total, self.total_repo_count)
+
+    def record_call(self, kind, method, url, status_code, size, started):
+        """ Adds an upstream call that started at the given perf_counter time to the metrics and profile's trace """
+        duration = time.perf_counter() - started
+        metrics.upstream_requests.inc(self.provider, kind, str(status_code))
+        metrics.upstream_duration.observe(duration, self.provider, kind)
+        if self.trace is not None:
+            self.trace.record_call(self.provider, kind, method, url, status_code, size, duration)
+
+    @property
+    def listed_repo_fields(self):
+        """ Fields to keep of each listed repo, None to keep every field """
+        return None if self.keep_repos else self.repo_fields
+
+    def decode(self, response, fields=None):
+        """ Decodes the json body of a response
+
+        :param response: upstream response
+        :type response: requests.Response
+        :param fields: fields to keep of each item when the body is a page, all fields are kept when empty
+        :type fields: tuple
+        """
+        with phase(self.trace, 'decode'):
+            return codec.loads(response.content, fields=fields, items_key=self.page_items_key)
+
+    def report_credential(self, headers, response):
+        """ Lets the token pool drop the credential a request was sent with if the provider rejected it """
+        if self.token_pool is not None and 'authorization' in headers:
+            self.token_pool.report(headers['authorization'], response.status_code, response.headers)
 
     @property
     def default_headers(self):
         """ Headers to pass to all requests
 
-        Content-type for all requests is application/json
+        Content-type for all requests is application/json. Requests are authenticated with the next credential from
+        the token pool, if there is one.
         """
-        return {
+        headers = {
             'content-type': 'application/json',
         }
+        authorization = self.token_pool.choose() if self.token_pool is not None else None
+        if authorization:
+            headers['authorization'] = authorization
+        return headers
 
 
 class GithubProfile(Profile):
+    """ Profile for a github user
+
+    All github requests are conditional, unchanged resources come back as 304s which do not count against the rate
+    limit.
+    """
+    provider = 'github'
+    token_pool = github_pool
+    # "rest" or "graphql"
+    fetch_strategy = constants.GITHUB_FETCH_STRATEGY
+    # updated_at changes when a repo is starred or edited, pushed_at only when commits are pushed
+    sort_str = '&sort=updated&direction=desc'
+    record_counters = ('total_watcher_count', 'total_stars_given_count', 'total_open_issues_count', 'total_size')
+    repo_columns = {
+        'total_watcher_count': 'watchers_count',
+        'total_stars_given_count': 'stargazers_count',
+        'total_open_issues_count': 'open_issues_count',
+        'total_size': 'size',
+    }
+    language_field = 'language'
+    topics_field = 'topics'
+    repo_fields = (
+        'full_name', 'updated_at', 'watchers_count', 'stargazers_count', 'open_issues_count', 'size', 'language',
+        'topics',
+    )
+
     @property
     def headers(self):
         """ Headers to pass to all requests
@@ -63,8 +572,8 @@ class GithubProfile(Profile):
     def get_user_profile(self):
         """ Retrieves the user profile from the api """
         url = self.profile_url.format(username=self.username)
-        response = requests.get(url, headers=self.headers)
-        self.user_profile = response.json()
+        response = self.request('GET', url, conditional=True, kind='profile')
+        self.user_profile = self.decode(response)
 
     def get_paginated_count(self, start_url):
         """ Sends a head request to get a count of resources at a endpoint
@@ -73,45 +582,208 @@ class GithubProfile(Profile):
         :type start_url: str
         """
         url = start_url + self.pagination_str.format(page_len=1)
-        response = requests.head(url)
+        response = self.request('HEAD', url, conditional=True, kind='count')
         last = response.links.get('last', {}).get('url')
         return int(last.split('page=')[-1]) if last else None
 
-    def get_paginated_list(self, start_url):
-        """ Sends a get request to get a full list of resources at an endpoint. Loops through each page
+    def get_page(self, url, fields=None):
+        """ Gets the items of a single page """
+        return self.decode(self.request('GET', url, conditional=True), fields)
+
+    def iter_paginated_list(self, start_url, parallel=True, sort_str='', fields=None):
+        """ Sends get requests for each page of resources at an endpoint
+
+        When the first page links to the last page, the remaining pages are fetched concurrently. Otherwise, or if
+        parallel is off, each page is followed in turn.
 
         :param start_url: url of the first page of an endpoint
         :type start_url: str
+        :param parallel: allow fetching pages ahead of the consumer
+        :type parallel: bool
+        :param sort_str: sort query parameters to add to the url
+        :type sort_str: str
+        :param fields: fields to keep of each item, all fields are kept when empty
+        :type fields: tuple
+        :return: generator of the items of each page, in order
+        :rtype: generator
         """
-        url = start_url + self.pagination_str.format(page_len=self.page_len)
-        paginated_list = []
-        while True:
-            response = requests.get(url, headers=self.headers)
-            paginated_list += response.json()
+        url = start_url + self.pagination_str.format(page_len=self.page_len) + sort_str
+        response = self.request('GET', url, conditional=True)
+        yield self.decode(response, fields)
+        url = response.links.get('next', {}).get('url')
+        last = response.links.get('last', {}).get('url')
+        first_page, last_page = (get_page_number(url), get_page_number(last)) if url and last else (None, None)
+        if parallel and first_page and last_page:
+            urls = [set_page_number(url, page) for page in range(first_page, last_page + 1)]
+            yield from self.iter_pages(urls, partial(self.get_page, fields=fields))
+            return
+
+        while url:
+            response = self.request('GET', url, conditional=True)
+            yield self.decode(response, fields)
             url = response.links.get('next', {}).get('url')
-            if not url:
-                break
-        return paginated_list
 
     def get_all_data(self):
-        """ Retrieves all data. Loops through each repo to get counts """
+        """ Retrieves all data with the configured fetch strategy
+
+        The graphql strategy needs a credential, without one or if the query fails the rest api is used.
+        """
+        if self.fetch_strategy == 'graphql' and self.token_pool:
+            try:
+                self.get_graphql_data()
+                return
+            except GraphQLError:
+                self.reset()
+        self.get_rest_data()
+
+    def get_rest_data(self):
+        """ Retrieves all data from the rest api. Adds each page of repos to the counts as it arrives """
         self.get_user_profile()
-        self.repos = self.get_paginated_list(self.repos_url)
-        self.total_stars_received_count = self.get_paginated_count(self.stars_received_url)
+        self.get_profile_counts()
+        for repos in self.iter_paginated_list(self.repos_url, fields=self.listed_repo_fields):
+            self.add_repos(repos)
+
+    def query(self, query, variables):
+        """ Sends a graphql query
+
+        :param query: graphql query
+        :type query: str
+        :param variables: query variables
+        :type variables: dict
+        :return: data of the response
+        :rtype: dict
+        :raises GraphQLError: when the query is rejected or has errors
+        """
+        body = json.dumps({'query': query, 'variables': variables})
+        response = self.request('POST', constants.GITHUB_GRAPHQL_URL, data=body, resource='graphql')
+        if response.status_code != 200:
+            raise GraphQLError('Graphql query failed with status {}'.format(response.status_code))
+        response_body = self.decode(response)
+        if response_body.get('errors') or not response_body.get('data'):
+            raise GraphQLError('Graphql query failed: {}'.format(response_body.get('errors')))
+        return response_body['data']
+
+    def get_graphql_data(self):
+        """ Retrieves all data with a graphql query per page of repos, only asking for the aggregated fields
+
+        Each repo node is converted to the fields of a rest repo resource so both strategies aggregate the same way.
+        """
+        cursor = None
+        while True:
+            variables = {'login': self.username, 'first': constants.GITHUB_GRAPHQL_PAGE_LEN, 'after': cursor}
+            user = self.query(GITHUB_REPOS_QUERY, variables)['user']
+            if user is None:
+                raise GraphQLError('No github user {}'.format(self.username))
+            self.user_profile = user
+            self.total_follower_count = user['followers']['totalCount']
+            self.total_stars_received_count = user['starredRepositories']['totalCount']
+            repositories = user['repositories']
+            self.add_repos([self.graphql_repo(node) for node in repositories['nodes']])
+            if not repositories['pageInfo']['hasNextPage']:
+                break
+            cursor = repositories['pageInfo']['endCursor']
+
+    @staticmethod
+    def graphql_repo(node):
+        """ The rest fields of a repo node
+
+        Like the rest api the watcher count is the stargazer count, and the open issue count includes open pull
+        requests. Sizes are in kilobytes in both apis.
+
+        :param node: repository node from the graphql api
+        :type node: dict
+        :rtype: dict
+        """
+        return {
+            'full_name': node['nameWithOwner'],
+            'updated_at': node['updatedAt'],
+            'watchers_count': node['stargazerCount'],
+            'stargazers_count': node['stargazerCount'],
+            'open_issues_count': node['issues']['totalCount'] + node['pullRequests']['totalCount'],
+            'size': node['diskUsage'] or 0,
+            'language': (node['primaryLanguage'] or {}).get('name'),
+            'topics': [topic['topic']['name'] for topic in node['repositoryTopics']['nodes']],
+        }
 
-        self.total_repo_count = len(self.repos)
+    def get_profile_counts(self):
+        """ Gets the counts that belong to the user rather than their repos """
         self.total_follower_count = self.user_profile['followers']
-        for repo in self.repos:
-            self.total_watcher_count += repo['watchers_count']
-            self.total_stars_given_count += repo['stargazers_count']
-            self.total_open_issues_count += repo['open_issues_count']
-            self.total_size += repo['size']
-            if repo['language']:
-                self.languages_used = self.languages_used.union({repo['language']})
-            self.repo_topics = self.repo_topics.union(set(repo['topics']))
+        self.total_stars_received_count = self.get_paginated_count(self.stars_received_url)
+
+    def aggregate_repos(self, repos):
+        """ Aggregates a page of repos, keeping their records when records are kept
+
+        :param repos: page of repo resources
+        :type repos: list
+        """
+        super().aggregate_repos(repos)
+        if self.repo_records is not None:
+            self.repo_records.update((repo['full_name'], self.repo_record(repo)) for repo in repos)
+
+    def repo_marker(self, repo):
+        return repo['updated_at']
+
+    def repo_record(self, repo, counts=None):
+        """ Record of the aggregated fields of a repo, laid out as marker, record_counters, language, topics
+
+        :param repo: repo resource
+        :type repo: dict
+        :rtype: list
+        """
+        return [
+            repo['updated_at'],
+            repo['watchers_count'],
+            repo['stargazers_count'],
+            repo['open_issues_count'],
+            repo['size'],
+            repo['language'],
+            repo['topics'],
+        ]
+
+    def get_repo_total(self):
+        return self.user_profile['public_repos']
+
+    def known_repo_total(self):
+        if 'public_repos' in self.user_profile:
+            return self.user_profile['public_repos']
+        return self.user_profile.get('repositories', {}).get('totalCount')
+
+    def iter_changed_counts(self, repos):
+        """ Github repos carry all of their counts, nothing more to fetch """
+        return ((repo, None) for repo in repos)
 
 
 class BitbucketProfile(Profile):
+    provider = 'bitbucket'
+    token_pool = bitbucket_pool
+    sort_str = '&sort=-updated_on'
+    record_counters = ('total_watcher_count', 'total_open_issues_count', 'total_size')
+    # Watcher and open issue counts are fetched for each repo, see add_repo_counts
+    repo_columns = {'total_size': 'size'}
+    language_field = 'language'
+    repo_fields = ('full_name', 'updated_on', 'size', 'language', 'links')
+    page_items_key = 'values'
+
+    def __init__(
+            self,
+            username,
+            page_len=50,
+            keep_repos=False,
+            keep_records=False,
+            max_in_flight=constants.BITBUCKET_COUNT_MAX_IN_FLIGHT,
+    ):
+        super().__init__(username, page_len=page_len, keep_repos=keep_repos, keep_records=keep_records)
+        self.max_in_flight = max_in_flight
+        # Sizes bitbucket reported for the lists crawled, keyed by the url of their first page
+        self.list_sizes = {}
+        # Repos whose watcher and open issue counts have been summed
+        self.counted_repos = 0
+
+    def reset(self):
+        super().reset()
+        self.list_sizes = {}
+        self.counted_repos = 0
+
     @property
     def headers(self):
         return self.default_headers
@@ -142,12 +814,12 @@ class BitbucketProfile(Profile):
         If the user is a "team account", then it will try the teams url
         """
         url = self.profile_url.format(username=self.username)
-        response = requests.get(url, headers=self.headers)
-        response_body = response.json()
+        response = self.request('GET', url, kind='profile')
+        response_body = self.decode(response)
         if response_body.get('error', {}).get('message') == '{} is a team account'.format(self.username):
             url = self.teams_url.format(username=self.username)
-            response = requests.get(url, headers=self.headers)
-            response_body = response.json()
+            response = self.request('GET', url, kind='profile')
+            response_body = self.decode(response)
 
         self.user_profile = response_body
 
@@ -158,44 +830,149 @@ class BitbucketProfile(Profile):
         :type start_url: str
         """
         url = start_url + self.pagination_str.format(page_len=0)
-        response = requests.get(url, headers=self.headers)
-        response_body = response.json()
+        response = self.request('GET', url, kind='count')
+        response_body = self.decode(response)
         return response_body['size']
 
-    def get_paginated_list(self, start_url):
-        """ Sends a get request to get a full list of resources at an endpoint. Loops through each page
+    def get_page(self, url, fields=None):
+        """ Gets the items of a single page """
+        return self.decode(self.request('GET', url), fields)['values']
+
+    def iter_paginated_list(self, start_url, parallel=True, sort_str='', fields=None):
+        """ Sends get requests for each page of resources at an endpoint
+
+        When the first page has the size and pagelen of the list, the remaining pages are fetched concurrently.
+        Otherwise, or if parallel is off, each page is followed in turn.
 
         :param start_url: url of the first page of an endpoint
         :type start_url: str
+        :param parallel: allow fetching pages ahead of the consumer
+        :type parallel: bool
+        :param sort_str: sort query parameters to add to the url
+        :type sort_str: str
+        :param fields: fields to keep of each item, all fields are kept when empty
+        :type fields: tuple
+        :return: generator of the items of each page, in order
+        :rtype: generator
         """
-        url = start_url + self.pagination_str.format(page_len=self.page_len)
-        paginated_list = []
-        while True:
-            response = requests.get(url, headers=self.headers)
-            response_body = json.loads(response.text)
-            paginated_list += response_body['values']
+        url = start_url + self.pagination_str.format(page_len=self.page_len) + sort_str
+        response = self.request('GET', url)
+        response_body = self.decode(response, fields)
+        self.list_sizes[start_url] = response_body.get('size')
+        yield response_body['values']
+        url = response_body.get('next')
+        first_page = get_page_number(url) if url else None
+        if parallel and first_page and response_body.get('size') and response_body.get('pagelen'):
+            last_page = math.ceil(response_body['size'] / response_body['pagelen'])
+            urls = [set_page_number(url, page) for page in range(first_page, last_page + 1)]
+            yield from self.iter_pages(urls, partial(self.get_page, fields=fields))
+            return
+
+        while url:
+            response = self.request('GET', url)
+            response_body = self.decode(response, fields)
+            yield response_body['values']
             url = response_body.get('next')
-            if not url:
-                break
 
-        return paginated_list
+    def iter_repos(self):
+        """ Yields each repo, adding its page to the aggregates as the page arrives """
+        for repos in self.iter_paginated_list(self.repos_url, fields=self.listed_repo_fields):
+            self.add_repos(repos)
+            yield from repos
+
+    def get_repo_counts(self, repo):
+        """ Gets the watcher and open issue counts for a single repo
+
+        :param repo: repo resource from the repositories endpoint
+        :type repo: dict
+        :return: watcher count and open issue count
+        :rtype: tuple
+        """
+        watcher_count = self.get_paginated_count(repo['links']['watchers']['href'])
+        issues_link = repo['links'].get('issues', {}).get('href')
+        open_issues_count = self.get_paginated_count(issues_link) if issues_link else 0
+        return watcher_count, open_issues_count
+
+    def iter_repo_counts(self, repos):
+        """ Gets the watcher and open issue counts for every repo on the shared count executor
+
+        At most max_in_flight repos from this profile are queued or running at once, so one large team cannot take
+        over the whole executor. Repos are read from the iterable as slots free up.
+
+        :param repos: iterable of repo resources
+        :type repos: iterable
+        :return: generator of each repo with its watcher count and open issue count, in order
+        :rtype: generator
+        """
+        in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        pending = deque()
+        try:
+            for repo in repos:
+                in_flight.acquire()
+                future = count_executor.submit(self.get_repo_counts, repo)
+                future.add_done_callback(lambda _: in_flight.release())
+                pending.append((repo, future))
+                while pending and pending[0][1].done():
+                    repo, future = pending.popleft()
+                    yield repo, future.result()
+            while pending:
+                repo, future = pending.popleft()
+                yield repo, future.result()
+        finally:
+            for _, future in pending:
+                future.cancel()
 
     def get_all_data(self):
-        """ Retrieves all data. Loops through each repo and makes additional requests to get counts """
+        """ Retrieves all data. Makes additional requests for each repo to get counts while the repos are listed """
         self.get_user_profile()
-        self.repos = self.get_paginated_list(self.repos_url)
+        self.get_profile_counts()
+        self.add_repo_counts(self.iter_repo_counts(self.iter_repos()))
+
+    def get_profile_counts(self):
+        """ Gets the counts that belong to the user rather than their repos """
         self.total_follower_count = self.get_paginated_count(self.followers_url)
-        self.total_repo_count = len(self.repos)
 
-        for repo in self.repos:
-            self.total_watcher_count += self.get_paginated_count(repo['links']['watchers']['href'])
-            self.total_size += repo['size']
+    def add_repo_counts(self, repo_counts):
+        """ Sums the watcher and open issue counts of repos
 
-            issues_link = repo['links'].get('issues', {}).get('href')
-            if issues_link:
-                self.total_open_issues_count += self.get_paginated_count(issues_link)
-            if repo['language']:
-                self.languages_used = self.languages_used.union({repo['language']})
+        :param repo_counts: each repo with its watcher count and open issue count
+        :type repo_counts: iterable
+        """
+        for repo, (watcher_count, open_issues_count) in repo_counts:
+            self.total_watcher_count += watcher_count
+            self.total_open_issues_count += open_issues_count
+            self.counted_repos += 1
+            if self.repo_records is not None:
+                self.repo_records[repo['full_name']] = self.repo_record(repo, (watcher_count, open_issues_count))
+
+    def repo_marker(self, repo):
+        return repo['updated_on']
+
+    def repo_record(self, repo, counts):
+        """ Record of the aggregated fields of a repo, laid out as marker, record_counters, language, topics
+
+        :param repo: repo resource
+        :type repo: dict
+        :param counts: watcher count and open issue count of the repo
+        :type counts: tuple
+        :rtype: list
+        """
+        watcher_count, open_issues_count = counts
+        return [repo['updated_on'], watcher_count, open_issues_count, repo['size'], repo['language'], []]
+
+    def get_repo_total(self):
+        return self.get_paginated_count(self.repos_url)
+
+    def sampled_counters(self):
+        sampled = super().sampled_counters()
+        sampled.update(total_watcher_count=self.counted_repos, total_open_issues_count=self.counted_repos)
+        return sampled
+
+    def known_repo_total(self):
+        return self.list_sizes.get(self.repos_url) if 'links' in self.user_profile else None
+
+    def iter_changed_counts(self, repos):
+        return self.iter_repo_counts(repos)
 
 
 class ConsolidatedProfile:
@@ -207,20 +984,16 @@ class ConsolidatedProfile:
     @property
     def dict(self):
         """ A dictionary of all data consolidated from both profiles """
-
+        aggregate = self.github_profile.aggregate.merge(self.bitbucket_profile.aggregate)
         response_dict = {
             'github_username': self.github_profile.username,
             'bitbucket_username': self.bitbucket_profile.username,
-            'languages_used': list(self.github_profile.languages_used.union(self.bitbucket_profile.languages_used)),
-            'repo_topics': list(self.github_profile.repo_topics.union(self.bitbucket_profile.repo_topics)),
-            'total_repo_count': self.github_profile.total_repo_count + self.bitbucket_profile.total_repo_count,
-            'total_watcher_count': self.github_profile.total_watcher_count + self.bitbucket_profile.total_watcher_count,
-            'total_follower_count': self.github_profile.total_follower_count + self.bitbucket_profile.total_follower_count,
-            'total_stars_received_count': self.github_profile.total_stars_received_count + self.bitbucket_profile.total_stars_received_count,
-            'total_stars_given_count': self.github_profile.total_stars_given_count + self.bitbucket_profile.total_stars_given_count,
-            'total_open_issues_count': self.github_profile.total_open_issues_count + self.bitbucket_profile.total_open_issues_count,
-            'total_size': self.github_profile.total_size + self.bitbucket_profile.total_size,
+            'languages_used': list(aggregate.languages_used),
+            'repo_topics': list(aggregate.repo_topics),
+            'partial': self.github_profile.partial or self.bitbucket_profile.partial,
         }
+        for name in ProfileAggregate.COUNTERS:
+            response_dict[name] = getattr(aggregate, name)
         response_dict.update({
             'languages_used_count': len(response_dict['languages_used']),
             'repo_topics_count': len(response_dict['repo_topics']),
@@ -0,0 +1,268 @@
+import asyncio
+import hashlib
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from service import constants
+
+# Priorities of upstream requests, user facing requests are admitted before background work
+INTERACTIVE = 0
+BACKGROUND = 1
+# Rate limit resource of requests that do not name one. Github limits the rest api (core) and graphql separately and
+# names the resource a response counts against in X-RateLimit-Resource
+CORE = 'core'
+
+
+class RateLimitExceeded(Exception):
+    """ Raised when a request is shed instead of being sent upstream """
+    def __init__(self, provider, retry_after=None):
+        self.provider = provider
+        self.retry_after = retry_after
+        super().__init__('Rate limit reached for {}'.format(provider))
+
+
+def credential_id(headers):
+    """ Short id of the credential a request is sent with, without exposing the credential itself
+
+    :param headers: request headers
+    :type headers: dict
+    :rtype: str
+    """
+    for name, value in (headers or {}).items():
+        if name.lower() == 'authorization':
+            return 'token:' + hashlib.sha256(value.encode('utf-8')).hexdigest()[:12]
+    return 'anonymous'
+
+
+def parse_retry_after(value, now):
+    """ Seconds to wait from a Retry-After header, given either as seconds or as an http date
+
+    :rtype: float or None
+    """
+    try:
+        return max(float(value), 0)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - now, 0)
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+class TokenBucket:
+    """ Admits requests at a steady rate with bursts of up to capacity """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, reserve=0):
+        """ Takes a token if one is available above the reserve
+
+        :param reserve: tokens that must be left in the bucket, for keeping room for higher priority requests
+        :type reserve: float
+        :return: 0 if a token was taken, otherwise the seconds until one will be available
+        :rtype: float
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens - reserve >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 + reserve - self.tokens) / self.rate
+
+
+class RateLimitBudget:
+    """ The remaining rate limit of one credential for one resource of a provider, as last reported by the provider """
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset_at = None
+        self.blocked_until = 0
+
+    def update(self, headers, status_code, now):
+        """ Reads the X-RateLimit and Retry-After headers of a response
+
+        :param headers: response headers
+        :param status_code: response status code
+        :type status_code: int
+        :param now: current epoch time
+        :type now: float
+        """
+        headers = {name.lower(): value for name, value in headers.items()}
+        try:
+            if 'x-ratelimit-limit' in headers:
+                self.limit = int(headers['x-ratelimit-limit'])
+            if 'x-ratelimit-remaining' in headers:
+                self.remaining = int(headers['x-ratelimit-remaining'])
+            if 'x-ratelimit-reset' in headers:
+                self.reset_at = float(headers['x-ratelimit-reset'])
+        except ValueError:
+            pass
+        if status_code in (403, 429) and 'retry-after' in headers:
+            retry_after = parse_retry_after(headers['retry-after'], now)
+            if retry_after is not None:
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+
+    def wait_time(self, now):
+        """ Seconds until the provider will accept requests again, 0 if it accepts them now """
+        wait = self.blocked_until - now
+        if self.remaining == 0 and self.reset_at is not None:
+            wait = max(wait, self.reset_at - now)
+        return max(wait, 0)
+
+    def below(self, fraction):
+        """ Whether less than a fraction of the limit remains """
+        if self.limit is None or self.remaining is None:
+            return False
+        return self.remaining < self.limit * fraction
+
+    def dict(self):
+        return {
+            'limit': self.limit,
+            'remaining': self.remaining,
+            'reset_at': self.reset_at,
+            'blocked_until': self.blocked_until or None,
+        }
+
+
+class UpstreamScheduler:
+    """ Admits upstream requests according to each provider's rate limit
+
+    Each provider has a token bucket shared by all of its credentials, and the remaining budget of each credential is
+    tracked from the rate limit headers of its responses, separately for each rate limit resource. Background requests
+    are shed first, once the budget of their credential falls below the reserve, and they may only take tokens above
+    the reserve share of the bucket.
+    User facing requests can use the whole budget, and only fail once it is spent or the provider asked to back off
+    for longer than they can wait.
+    """
+    def __init__(
+            self,
+            rates=constants.UPSTREAM_RATES,
+            reserve=constants.UPSTREAM_BACKGROUND_RESERVE,
+            max_wait=(constants.UPSTREAM_INTERACTIVE_MAX_WAIT, constants.UPSTREAM_BACKGROUND_MAX_WAIT),
+    ):
+        self.rates = rates
+        self.buckets = {provider: TokenBucket(rate, burst) for provider, (rate, burst) in rates.items()}
+        self.reserve = reserve
+        self.max_wait = max_wait
+        self.admitted = 0
+        self.shed = 0
+        self._budgets = {}
+        self._lock = threading.Lock()
+
+    def share(self, processes):
+        """ Scales the provider buckets down to this process's share of the rates, when several processes send requests
+
+        Each process only sees its own buckets, so they admit rate / processes requests per second with bursts of
+        burst / processes, and of at least one request so that every process can send.
+
+        :param processes: number of processes sending upstream requests
+        :type processes: int
+        """
+        self.buckets = {
+            provider: TokenBucket(rate / processes, max(burst / processes, 1))
+            for provider, (rate, burst) in self.rates.items()
+        }
+
+    def budget(self, provider, credential, resource=CORE):
+        with self._lock:
+            key = (provider, credential, resource)
+            if key not in self._budgets:
+                self._budgets[key] = RateLimitBudget()
+            return self._budgets[key]
+
+    def admit(self, provider, credential, priority=INTERACTIVE, resource=CORE):
+        """ Tries to admit a request without waiting
+
+        :param provider: provider name
+        :type provider: str
+        :param credential: id of the credential the request is sent with, see credential_id
+        :type credential: str
+        :param priority: INTERACTIVE or BACKGROUND
+        :type priority: int
+        :param resource: rate limit resource the request counts against
+        :type resource: str
+        :return: 0 if the request was admitted, otherwise the seconds to wait before trying again
+        :rtype: float
+        :raises RateLimitExceeded: when the request should be shed
+        """
+        budget = self.budget(provider, credential, resource)
+        wait = budget.wait_time(time.time())
+        if wait > self.max_wait[priority] or (priority == BACKGROUND and budget.below(self.reserve)):
+            self._shed()
+            raise RateLimitExceeded(provider, wait or None)
+        if wait:
+            return wait
+
+        bucket = self.buckets.get(provider)
+        if bucket is not None:
+            wait = bucket.take(bucket.capacity * self.reserve if priority == BACKGROUND else 0)
+            if wait:
+                return wait
+        with self._lock:
+            self.admitted += 1
+        return 0
+
+    def acquire(self, provider, credential, priority=INTERACTIVE, resource=CORE):
+        """ Waits until a request is admitted, queueing it for up to the max wait of its priority
+
+        :raises RateLimitExceeded: when the request is shed or was not admitted in time
+        """
+        deadline = time.monotonic() + self.max_wait[priority]
+        while True:
+            wait = self.admit(provider, credential, priority, resource)
+            if not wait:
+                return
+            if time.monotonic() + wait > deadline:
+                self._shed()
+                raise RateLimitExceeded(provider, wait)
+            time.sleep(wait)
+
+    async def acquire_async(self, provider, credential, priority=INTERACTIVE, resource=CORE):
+        """ Coroutine counterpart of acquire that waits without blocking the event loop """
+        deadline = time.monotonic() + self.max_wait[priority]
+        while True:
+            wait = self.admit(provider, credential, priority, resource)
+            if not wait:
+                return
+            if time.monotonic() + wait > deadline:
+                self._shed()
+                raise RateLimitExceeded(provider, wait)
+            await asyncio.sleep(wait)
+
+    def update(self, provider, credential, headers, status_code, resource=CORE):
+        """ Records the rate limit headers of a response against the resource it names, or the one it was sent for """
+        for name, value in headers.items():
+            if name.lower() == 'x-ratelimit-resource':
+                resource = value
+        self.budget(provider, credential, resource).update(headers, status_code, time.time())
+
+    def _shed(self):
+        with self._lock:
+            self.shed += 1
+
+    @property
+    def stats(self):
+        """ Admitted and shed request counts, and the last known budget of each provider and credential
+
+        Budgets are keyed provider:credential, with the resource after the provider as provider/resource:credential
+        for resources other than core.
+        """
+        with self._lock:
+            budgets = list(self._budgets.items())
+            stats = {'admitted': self.admitted, 'shed': self.shed}
+        stats['budgets'] = {
+            '{}{}:{}'.format(provider, '' if resource == CORE else '/' + resource, credential): budget.dict()
+            for (provider, credential, resource), budget in budgets
+        }
+        return stats
+
+
+# Shared by every profile so that all requests to a provider draw from the same budget
+scheduler = UpstreamScheduler()
@@ -0,0 +1,102 @@
+""" Minimal client for the Redis serialization protocol
+
+Only supports the handful of commands the cache backend needs, which keeps the service free of a redis dependency.
+"""
+import socket
+import threading
+
+from service.local import local_connection
+
+
+class RespError(Exception):
+    """ Error reply from the server """
+
+
+class RespClient:
+    """ Thread safe RESP client, each thread of each process keeps its own connection """
+    def __init__(self, host='127.0.0.1', port=6379, db=0, timeout=5):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        """ The calling thread's socket and its reader
+
+        :rtype: (socket.socket, io.BufferedReader)
+        """
+        return local_connection(self._local, self.connect)
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = (sock, sock.makefile('rb'))
+        if self.db:
+            self._send(connection, ('SELECT', self.db))
+        return connection
+
+    def close(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            sock, reader = connection
+            reader.close()
+            sock.close()
+            self._local.connection = None
+
+    def execute(self, *args):
+        """ Sends a command and returns the decoded reply, reconnecting once if the connection was dropped
+
+        :param args: command name and arguments, as str, bytes or int
+        :return: the reply as bytes, int, list or None
+        """
+        try:
+            return self._send(self.connection, args)
+        except (ConnectionError, socket.timeout):
+            self.close()
+            return self._send(self.connection, args)
+
+    def _send(self, connection, args):
+        sock, reader = connection
+        sock.sendall(self.encode(args))
+        reply = self.read_reply(reader)
+        if isinstance(reply, RespError):
+            raise reply
+        return reply
+
+    @staticmethod
+    def encode(args):
+        parts = [b'*' + str(len(args)).encode() + b'\r\n']
+        for arg in args:
+            if isinstance(arg, int):
+                arg = str(arg)
+            if isinstance(arg, str):
+                arg = arg.encode('utf-8')
+            parts.append(b'$' + str(len(arg)).encode() + b'\r\n' + arg + b'\r\n')
+        return b''.join(parts)
+
+    @classmethod
+    def read_reply(cls, reader):
+        line = reader.readline()
+        if not line:
+            raise ConnectionError('Connection closed by server')
+        prefix, payload = line[:1], line[1:-2]
+        if prefix == b'+':
+            return payload
+        if prefix == b'-':
+            return RespError(payload.decode('utf-8'))
+        if prefix == b':':
+            return int(payload)
+        if prefix == b'$':
+            length = int(payload)
+            if length == -1:
+                return None
+            data = reader.read(length + 2)
+            return data[:-2]
+        if prefix == b'*':
+            length = int(payload)
+            if length == -1:
+                return None
+            return [cls.read_reply(reader) for _ in range(length)]
+        raise RespError('Unknown reply type {!r}'.format(prefix))
@@ -1,26 +1,205 @@
-import json
+import math
+import time
 
-from flask import Blueprint, request, Response
+from flask import Blueprint, g, request, Response
 
-from service.handlers import handle_get_profile
+from service import codec, constants, handlers, metrics
+from service.handlers import (
+    handle_get_profile,
+    handle_get_profile_async,
+    handle_get_profiles,
+    iter_profiles,
+    ProfileFetchTimeout,
+)
+from service.ratelimit import CORE, RateLimitExceeded, scheduler
+from service.tracing import Trace
 
 
 api_blueprint = Blueprint('api', __name__)
 
+TRUE_VALUES = ('1', 'true', 'yes')
 
-@api_blueprint.route('/api/profile', methods=['GET'])
-def get_profile():
-    """ Endpoint for a consolidated profile resource """
+CACHES = {
+    'consolidated': handlers.consolidated_cache,
+    'provider': handlers.provider_cache,
+    'snapshot': handlers.snapshot_cache,
+    'stale': handlers.stale_cache,
+    'partial': handlers.partial_cache,
+}
+
+FLIGHTS = {
+    'sync': handlers.profile_flight,
+    'async': handlers.async_profile_flight,
+}
+
+
+def collect_cache_metrics():
+    """ Hit and miss counts and the hit ratio of each cache """
+    hits = metrics.Counter('git_profile_cache_hits_total', 'Cache lookups that found a value', ('cache',))
+    misses = metrics.Counter('git_profile_cache_misses_total', 'Cache lookups that found nothing', ('cache',))
+    ratio = metrics.Gauge('git_profile_cache_hit_ratio', 'Share of cache lookups that found a value', ('cache',))
+    for name, cache in CACHES.items():
+        stats = cache.stats
+        hits.inc(name, amount=stats['hits'])
+        misses.inc(name, amount=stats['misses'])
+        lookups = stats['hits'] + stats['misses']
+        ratio.set(stats['hits'] / lookups if lookups else 0, name)
+    return [hits, misses, ratio]
+
+
+def collect_rate_limit_metrics():
+    """ Last known rate limit budget of each provider and credential, and the scheduler's admitted and shed counts """
+    stats = scheduler.stats
+    remaining = metrics.Gauge(
+        'git_profile_ratelimit_remaining',
+        'Requests left in the rate limit window',
+        ('provider', 'resource', 'credential'),
+    )
+    limit = metrics.Gauge(
+        'git_profile_ratelimit_limit',
+        'Requests allowed per rate limit window',
+        ('provider', 'resource', 'credential'),
+    )
+    for key, budget in stats['budgets'].items():
+        provider, credential = key.split(':', 1)
+        provider, _, resource = provider.partition('/')
+        if budget['remaining'] is not None:
+            remaining.set(budget['remaining'], provider, resource or CORE, credential)
+        if budget['limit'] is not None:
+            limit.set(budget['limit'], provider, resource or CORE, credential)
+    admitted = metrics.Counter('git_profile_upstream_admitted_total', 'Upstream requests admitted by the scheduler')
+    admitted.inc(amount=stats['admitted'])
+    shed = metrics.Counter('git_profile_upstream_shed_total', 'Upstream requests shed by the scheduler')
+    shed.inc(amount=stats['shed'])
+    return [remaining, limit, admitted, shed]
+
+
+def collect_single_flight_metrics():
+    """ Profile crawls run and the crawls coalesced into one already running, for the sync and async engines """
+    executions = metrics.Counter(
+        'git_profile_singleflight_executions_total', 'Profile crawls that ran for their callers', ('engine',),
+    )
+    coalesced = metrics.Counter(
+        'git_profile_singleflight_coalesced_total', 'Profile crawls that waited for one already running', ('engine',),
+    )
+    for name, flight in FLIGHTS.items():
+        stats = flight.stats
+        executions.inc(name, amount=stats['executions'])
+        coalesced.inc(name, amount=stats['coalesced'])
+    return [executions, coalesced]
+
+
+metrics.registry.add_collector(collect_cache_metrics)
+metrics.registry.add_collector(collect_rate_limit_metrics)
+metrics.registry.add_collector(collect_single_flight_metrics)
+
+
+def route_label():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+@api_blueprint.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    metrics.requests_in_flight.inc(route_label())
+
+
+@api_blueprint.after_request
+def record_request_metrics(response):
+    duration = time.perf_counter() - g.request_started
+    metrics.request_duration.observe(duration, route_label(), request.method, str(response.status_code))
+    return response
+
+
+@api_blueprint.teardown_request
+def finish_request_metrics(exc):
+    if 'request_started' in g:
+        metrics.requests_in_flight.dec(route_label())
+
+
+def profile_response(handler):
+    """ Builds the consolidated profile response using the given handler
+
+    With debug=true the response has a Server-Timing header and the trace of the request's upstream calls.
+    """
     headers = {'content-type': 'application/json'}
     try:
         github_username = request.args['github']
         bitbucket_username = request.args['bitbucket']
     except KeyError as exc:
         return Response(
-            json.dumps({"error": "No {} in request params".format(exc.args[0])}),
+            codec.dumps({"error": "No {} in request params".format(exc.args[0])}),
+            status=400,
+            headers=headers
+        )
+
+    refresh = request.args.get('refresh', '').lower() in TRUE_VALUES
+    debug = request.args.get('debug', '').lower() in TRUE_VALUES
+    trace = Trace() if debug or constants.SERVER_TIMING else None
+
+    try:
+        body = handler(github_username, bitbucket_username, refresh=refresh, trace=trace)
+        status = 200
+    except ProfileFetchTimeout as exc:
+        body, status = {"error": str(exc)}, 504
+    except RateLimitExceeded as exc:
+        if exc.retry_after:
+            headers['retry-after'] = str(math.ceil(exc.retry_after))
+        body, status = {"error": str(exc)}, 429
+
+    if trace is not None:
+        headers['server-timing'] = trace.server_timing()
+    if debug:
+        body = dict(body, trace=trace.dict())
+    return Response(codec.dumps(body), status=status, headers=headers)
+
+
+@api_blueprint.route('/api/profile', methods=['GET'])
+def get_profile():
+    """ Endpoint for a consolidated profile resource """
+    return profile_response(handle_get_profile)
+
+
+@api_blueprint.route('/api/async/profile', methods=['GET'])
+def get_profile_async():
+    """ Endpoint for a consolidated profile resource fetched on the asyncio engine """
+    return profile_response(handle_get_profile_async)
+
+
+@api_blueprint.route('/api/profiles', methods=['POST'])
+def get_profiles():
+    """ Endpoint for consolidated profiles of many username pairs
+
+    With stream=true the items are sent as newline delimited json in the order they complete, each with the index of
+    its pair.
+    """
+    headers = {'content-type': 'application/json'}
+    pairs = request.get_json(silent=True)
+    if not isinstance(pairs, list):
+        return Response(
+            codec.dumps({"error": "Request body must be a list of github and bitbucket usernames"}),
+            status=400,
+            headers=headers
+        )
+    if len(pairs) > constants.BATCH_MAX_ITEMS:
+        return Response(
+            codec.dumps({"error": "No more than {} profiles per request".format(constants.BATCH_MAX_ITEMS)}),
             status=400,
             headers=headers
         )
 
-    profile_dict = handle_get_profile(github_username, bitbucket_username)
-    return Response(json.dumps(profile_dict), status=200, headers=headers)
+    refresh = request.args.get('refresh', '').lower() in TRUE_VALUES
+    if request.args.get('stream', '').lower() in TRUE_VALUES:
+        lines = (
+            codec.dumps(dict(item, index=index)) + '\n'
+            for index, item in iter_profiles(pairs, refresh=refresh)
+        )
+        return Response(lines, status=200, headers={'content-type': 'application/x-ndjson'})
+
+    return Response(codec.dumps(handle_get_profiles(pairs, refresh=refresh)), status=200, headers=headers)
+
+
+@api_blueprint.route('/metrics', methods=['GET'])
+def get_metrics():
+    """ Endpoint for the service's metrics in the Prometheus text format """
+    return Response(metrics.registry.render(), status=200, headers={'content-type': 'text/plain; version=0.0.4'})
@@ -0,0 +1,91 @@
+""" Production server: gunicorn worker processes, each serving requests on a pool of threads
+
+The app is created by create_app in the master before the workers fork when it is preloaded, so that workers start
+with the caches already warm from the snapshot store. Workers finish the requests they are serving before exiting on
+SIGTERM, for up to the graceful timeout.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from gunicorn.app.base import BaseApplication
+
+from service import constants, create_app, handlers, ratelimit
+
+
+def load_app():
+    """ Creates the app and warms the caches from the snapshot store
+
+    :rtype: flask.Flask
+    """
+    app = create_app()
+    handlers.warm_start()
+    return app
+
+
+def post_worker_init(worker):
+    """ Splits the upstream rates between the workers, sizes the profile executor and starts the background threads
+
+    Every worker admits requests from its own buckets, so each gets an equal share of the provider rates. Each of the
+    worker's request threads can hold two profile executor threads, one per provider, whatever number of threads the
+    server was started with. Threads started before the fork do not carry over.
+    """
+    ratelimit.scheduler.share(worker.cfg.workers)
+    handlers.profile_executor = ThreadPoolExecutor(max_workers=2 * worker.cfg.threads)
+    if constants.PREWARM_INTERVAL:
+        handlers.start_prewarming()
+
+
+def worker_exit(server, worker):
+    """ Writes the snapshots still queued in the exiting worker """
+    if handlers.snapshot_store is not None:
+        handlers.snapshot_store.flush()
+
+
+def options(
+        bind,
+        workers=constants.SERVER_WORKERS,
+        threads=constants.SERVER_THREADS,
+        timeout=constants.SERVER_TIMEOUT,
+        graceful_timeout=constants.SERVER_GRACEFUL_TIMEOUT,
+        preload=True,
+):
+    """ Gunicorn settings of the production server
+
+    :param bind: address to listen on, "host:port"
+    :type bind: str
+    :param workers: worker processes
+    :type workers: int
+    :param threads: request threads of each worker
+    :type threads: int
+    :param timeout: seconds a worker may be silent before it is restarted
+    :type timeout: int
+    :param graceful_timeout: seconds workers get to finish their requests when shutting down
+    :type graceful_timeout: int
+    :param preload: create the app once in the master instead of in every worker
+    :type preload: bool
+    :rtype: dict
+    """
+    return {
+        'bind': bind,
+        'workers': workers,
+        'threads': threads,
+        'worker_class': 'gthread',
+        'timeout': timeout,
+        'graceful_timeout': graceful_timeout,
+        'preload_app': preload,
+        'post_worker_init': post_worker_init,
+        'worker_exit': worker_exit,
+    }
+
+
+class ProductionServer(BaseApplication):
+    """ Runs the app under gunicorn with the given settings, see options """
+    def __init__(self, settings):
+        self.settings = settings
+        super().__init__()
+
+    def load_config(self):
+        for name, value in self.settings.items():
+            self.cfg.set(name, value)
+
+    def load(self):
+        return load_app()
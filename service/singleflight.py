@@ -0,0 +1,82 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """ Coalesces concurrent calls for the same key into a single call
+
+    The first caller for a key runs the function, callers arriving while it runs wait for and share its result or
+    exception.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.executions = 0
+        self.coalesced = 0
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """ Runs func, or waits for the call already running for key
+
+        :param key: hashable key identifying the call
+        :param func: function to run
+        :type func: function
+        :return: the result of func
+        """
+        with self._lock:
+            self.calls += 1
+            future = self._futures.get(key)
+            leader = future is None
+            if leader:
+                future = self._futures[key] = Future()
+                self.executions += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = func()
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._futures[key]
+
+    @property
+    def stats(self):
+        """ Counters describing how many calls were coalesced """
+        return {'calls': self.calls, 'executions': self.executions, 'coalesced': self.coalesced}
+
+
+class AsyncSingleFlight(SingleFlight):
+    """ SingleFlight for coroutines running on one event loop """
+    async def do(self, key, func):
+        """ Awaits func(), or the call already running for key
+
+        :param key: hashable key identifying the call
+        :param func: function returning an awaitable
+        :type func: function
+        :return: the result of the awaitable
+        """
+        self.calls += 1
+        future = self._futures.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        future = self._futures[key] = asyncio.ensure_future(func())
+        self.executions += 1
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if future.done():
+                self._futures.pop(key, None)
+            else:
+                future.add_done_callback(lambda _: self._futures.pop(key, None))
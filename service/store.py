@@ -0,0 +1,212 @@
+""" Persistent store of crawled profiles, so that restarts and cache flushes do not send every profile back to a crawl
+
+Profiles live in a sqlite file with one row per provider profile holding its aggregate, indexed by provider and
+username, and one row per repo holding the record the aggregate was summed from. Writes are queued in memory and
+written in batches by a daemon thread, so storing a crawl never waits on the disk.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from service import codec, constants
+from service.local import connect_sqlite, local_connection
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS profiles ('
+    'provider TEXT NOT NULL, username TEXT NOT NULL, aggregate TEXT NOT NULL, has_records INTEGER NOT NULL, '
+    'updated_at REAL NOT NULL, PRIMARY KEY (provider, username))',
+    'CREATE INDEX IF NOT EXISTS profiles_updated_at ON profiles (updated_at)',
+    'CREATE TABLE IF NOT EXISTS repos ('
+    'provider TEXT NOT NULL, username TEXT NOT NULL, name TEXT NOT NULL, record TEXT NOT NULL, '
+    'PRIMARY KEY (provider, username, name))',
+)
+
+
+class SnapshotStore:
+    """ Aggregates and per-repo records of provider profiles kept in a sqlite file
+
+    Reads see queued writes straight away. Each thread keeps its own connection, and the database runs in WAL mode so
+    that workers reading it do not block the writer.
+
+    :param path: path of the sqlite file
+    :type path: str
+    :param flush_interval: seconds between batched writes
+    :type flush_interval: float
+    """
+    def __init__(self, path, flush_interval=constants.SNAPSHOT_STORE_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batches = 0
+        self.written = 0
+        # Writes queued for the next batch, and the batch being written, keyed by (provider, username)
+        self._pending = OrderedDict()
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._local = threading.local()
+        self._writer = None
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+
+    @property
+    def connection(self):
+        return local_connection(self._local, lambda: connect_sqlite(self.path))
+
+    def put(self, provider, username, aggregate, records=None):
+        """ Queues a profile to be written with the next batch, replacing what is stored for it
+
+        :param provider: provider name
+        :type provider: str
+        :param username: username of the profile
+        :type username: str
+        :param aggregate: aggregate in its serialized form, see ProfileAggregate.dump
+        :type aggregate: list
+        :param records: per-repo records keyed by repo name, or None when the profile was crawled without them
+        :type records: dict
+        """
+        key = (provider, username)
+        with self._lock:
+            self._pending[key] = (aggregate, records, time.time())
+            self._pending.move_to_end(key)
+            # The writer does not survive a fork, a forked worker starts its own
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._write_forever, name='snapshot-store', daemon=True)
+                self._writer.start()
+
+    def _write_forever(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Writing profile snapshots to %s failed', self.path)
+
+    def flush(self):
+        """ Writes every queued profile in a single transaction
+
+        :return: number of profiles written
+        :rtype: int
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, OrderedDict()
+                self._flushing = batch
+            if not batch:
+                return 0
+            connection = self.connection
+            try:
+                connection.execute('BEGIN IMMEDIATE')
+                for (provider, username), (aggregate, records, updated_at) in batch.items():
+                    connection.execute(
+                        'INSERT OR REPLACE INTO profiles (provider, username, aggregate, has_records, updated_at) '
+                        'VALUES (?, ?, ?, ?, ?)',
+                        (provider, username, codec.dumps(aggregate), records is not None, updated_at),
+                    )
+                    # Without records the stored repos are left as they are, they are not read back without has_records
+                    # and the next put with records replaces them
+                    if records is None:
+                        continue
+                    connection.execute('DELETE FROM repos WHERE provider = ? AND username = ?', (provider, username))
+                    connection.executemany(
+                        'INSERT INTO repos (provider, username, name, record) VALUES (?, ?, ?, ?)',
+                        [(provider, username, name, codec.dumps(record)) for name, record in records.items()],
+                    )
+                connection.execute('COMMIT')
+            except BaseException:
+                # BEGIN itself fails when the database stays locked past the timeout
+                if connection.in_transaction:
+                    connection.execute('ROLLBACK')
+                with self._lock:
+                    # Put the batch back behind anything queued since, which is newer
+                    for key, value in batch.items():
+                        self._pending.setdefault(key, value)
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = {}
+            self.batches += 1
+            self.written += len(batch)
+            return len(batch)
+
+    def _queued(self, key):
+        with self._lock:
+            return self._pending.get(key) or self._flushing.get(key)
+
+    def aggregate(self, provider, username):
+        """ Aggregate of a profile and when it was stored, read from the profile index without touching its repos
+
+        :param provider: provider name
+        :type provider: str
+        :param username: username of the profile
+        :type username: str
+        :return: aggregate and the unix time it was stored, or None when the profile is not stored
+        :rtype: tuple
+        """
+        queued = self._queued((provider, username))
+        if queued is not None:
+            return queued[0], queued[2]
+        row = self.connection.execute(
+            'SELECT aggregate, updated_at FROM profiles WHERE provider = ? AND username = ?', (provider, username)
+        ).fetchone()
+        return (codec.parse(row[0]), row[1]) if row else None
+
+    def get(self, provider, username):
+        """ Snapshot of a profile for an incremental refresh, like Profile.snapshot
+
+        :param provider: provider name
+        :type provider: str
+        :param username: username of the profile
+        :type username: str
+        :return: the aggregate and per-repo records, or None when the profile is not stored with its records
+        :rtype: dict
+        """
+        queued = self._queued((provider, username))
+        if queued is not None:
+            aggregate, records, _ = queued
+            return {'aggregate': aggregate, 'repos': dict(records)} if records is not None else None
+        connection = self.connection
+        row = connection.execute(
+            'SELECT aggregate, has_records FROM profiles WHERE provider = ? AND username = ?', (provider, username)
+        ).fetchone()
+        if row is None or not row[1]:
+            return None
+        rows = connection.execute(
+            'SELECT name, record FROM repos WHERE provider = ? AND username = ?', (provider, username)
+        )
+        return {'aggregate': codec.parse(row[0]), 'repos': {name: codec.parse(record) for name, record in rows}}
+
+    def recent(self, limit):
+        """ The most recently stored profiles, newest first
+
+        :param limit: maximum number of profiles
+        :type limit: int
+        :return: provider, username, aggregate and the unix time it was stored of each profile
+        :rtype: list
+        """
+        self.flush()
+        rows = self.connection.execute(
+            'SELECT provider, username, aggregate, updated_at FROM profiles ORDER BY updated_at DESC LIMIT ?', (limit,)
+        )
+        return [
+            (provider, username, codec.parse(aggregate), updated_at)
+            for provider, username, aggregate, updated_at in rows
+        ]
+
+    @property
+    def stats(self):
+        with self._lock:
+            queued = len(self._pending)
+        return {'queued': queued, 'batches': self.batches, 'written': self.written}
+
+
+def from_path(path):
+    """ Opens the snapshot store at a path
+
+    :param path: path of the sqlite file, empty to run without a store
+    :type path: str
+    :rtype: SnapshotStore
+    """
+    return SnapshotStore(path) if path else None
@@ -0,0 +1,121 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Trace:
+    """ Records the upstream calls and phase durations of a single api request
+
+    A trace is handed explicitly to each profile of the request, and from there reaches every thread the profile's
+    work runs on, so it is safe to record into from several threads at once. Phase durations are summed over every
+    thread and can add up to more than the request took.
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.calls = []
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    def record_call(self, provider, kind, method, url, status_code, size, duration):
+        """ Records a completed upstream call
+
+        :param provider: provider name
+        :type provider: str
+        :param kind: what the call fetches: profile, list or count
+        :type kind: str
+        :param method: http method
+        :type method: str
+        :param url: full url of the resource
+        :type url: str
+        :param status_code: response status code
+        :type status_code: int
+        :param size: response body size in bytes
+        :type size: int
+        :param duration: seconds the call took
+        :type duration: float
+        """
+        call = {
+            'provider': provider,
+            'kind': kind,
+            'method': method,
+            'url': url,
+            'status': status_code,
+            'bytes': size,
+            'duration_ms': round(duration * 1000, 3),
+        }
+        with self._lock:
+            self.calls.append(call)
+
+    def add_phase(self, name, duration):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0) + duration
+
+    @contextmanager
+    def phase(self, name):
+        """ Adds the time spent in the block to a phase """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - started)
+
+    def upstream(self):
+        """ Call count, bytes, time and status codes of the calls to each provider
+
+        :rtype: dict
+        """
+        with self._lock:
+            calls = list(self.calls)
+        upstream = {}
+        for call in calls:
+            totals = upstream.setdefault(call['provider'], {'calls': 0, 'bytes': 0, 'duration_ms': 0, 'statuses': {}})
+            totals['calls'] += 1
+            totals['bytes'] += call['bytes']
+            totals['duration_ms'] += call['duration_ms']
+            status = str(call['status'])
+            totals['statuses'][status] = totals['statuses'].get(status, 0) + 1
+        for totals in upstream.values():
+            totals['duration_ms'] = round(totals['duration_ms'], 3)
+        return upstream
+
+    def dict(self):
+        """ The whole trace, as returned by the debug flag of the profile endpoints
+
+        :rtype: dict
+        """
+        with self._lock:
+            calls = list(self.calls)
+            phases = dict(self.phases)
+        return {
+            'duration_ms': round((time.perf_counter() - self.started) * 1000, 3),
+            'upstream': self.upstream(),
+            'phases': {name: round(duration * 1000, 3) for name, duration in phases.items()},
+            'calls': calls,
+        }
+
+    def server_timing(self):
+        """ Server-Timing header value with the time spent on each provider and phase, and in total
+
+        :rtype: str
+        """
+        metrics = [
+            '{};dur={};desc="{} calls {} bytes"'.format(
+                provider, totals['duration_ms'], totals['calls'], totals['bytes'],
+            )
+            for provider, totals in sorted(self.upstream().items())
+        ]
+        with self._lock:
+            phases = sorted(self.phases.items())
+        metrics += ['{};dur={}'.format(name, round(duration * 1000, 3)) for name, duration in phases]
+        metrics.append('total;dur={}'.format(round((time.perf_counter() - self.started) * 1000, 3)))
+        return ', '.join(metrics)
+
+
+@contextmanager
+def phase(trace, name):
+    """ Trace.phase for an optional trace, does nothing without one """
+    if trace is None:
+        yield
+    else:
+        with trace.phase(name):
+            yield
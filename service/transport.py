@@ -0,0 +1,179 @@
+import threading
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from service import constants
+from service.ratelimit import CORE, credential_id, INTERACTIVE
+
+
+class ValidatorStore:
+    """ Remembers the ETag and Last-Modified validators of responses along with their bodies
+
+    Used to send conditional requests and rebuild the stored response when the upstream answers 304 Not Modified.
+    Entries are evicted least recently used first once the entry count or total body size goes over its bound.
+    """
+    def __init__(self, max_entries=constants.VALIDATOR_STORE_MAX_ENTRIES, max_bytes=constants.VALIDATOR_STORE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, response):
+        """ Stores the validators and body of a response, if it has any validators
+
+        :param key: hashable key for the request
+        :param response: a successful response
+        :type response: requests.Response
+        """
+        etag = response.headers.get('etag')
+        last_modified = response.headers.get('last-modified')
+        if not etag and not last_modified:
+            return
+        entry = {
+            'etag': etag,
+            'last_modified': last_modified,
+            'headers': dict(response.headers),
+            'content': response.content,
+            'encoding': response.encoding,
+        }
+        size = len(entry['content'])
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= len(self._entries.pop(key)['content'])
+            self._entries[key] = entry
+            self.current_bytes += size
+            while len(self._entries) > self.max_entries or self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= len(evicted['content'])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    @staticmethod
+    def conditional_headers(entry):
+        headers = {}
+        if entry['etag']:
+            headers['if-none-match'] = entry['etag']
+        if entry['last_modified']:
+            headers['if-modified-since'] = entry['last_modified']
+        return headers
+
+    @staticmethod
+    def build_response(entry, url):
+        """ Rebuilds the stored response so callers can treat a 304 like the original 200 """
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response.headers.update(entry['headers'])
+        response.encoding = entry['encoding']
+        response._content = entry['content']
+        return response
+
+
+class Transport:
+    """ Shared HTTP transport with a keep-alive connection pool per upstream host
+
+    A single transport lives for the whole process so that connections and TLS sessions are reused between requests.
+    With a scheduler, requests that name their provider are admitted by it and report their rate limit headers to it.
+    """
+    def __init__(
+            self,
+            hosts=constants.UPSTREAM_HOSTS,
+            pool_size=constants.UPSTREAM_POOL_SIZE,
+            retries=constants.UPSTREAM_RETRIES,
+            backoff=constants.UPSTREAM_RETRY_BACKOFF,
+            timeout=(constants.UPSTREAM_CONNECT_TIMEOUT, constants.UPSTREAM_READ_TIMEOUT),
+            scheduler=None,
+    ):
+        self.timeout = timeout
+        self.scheduler = scheduler
+        self.validators = ValidatorStore()
+        self.session = requests.Session()
+        for host in hosts:
+            retry = Retry(
+                total=retries,
+                backoff_factor=backoff,
+                status_forcelist=constants.UPSTREAM_RETRY_STATUSES,
+                respect_retry_after_header=False,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+            self.session.mount(host, adapter)
+
+    def request(
+            self, method, url, headers=None, conditional=False, provider=None, priority=INTERACTIVE, data=None,
+            resource=CORE,
+    ):
+        """ Sends a request over the pooled session
+
+        Conditional requests send the validators stored for the url, and a 304 response is replaced with the stored
+        response.
+
+        :param method: http method
+        :type method: str
+        :param url: full url of the resource
+        :type url: str
+        :param headers: request headers
+        :type headers: dict
+        :param conditional: send and store ETag/Last-Modified validators
+        :type conditional: bool
+        :param provider: provider name the scheduler tracks the request under
+        :type provider: str
+        :param priority: scheduler priority, service.ratelimit.INTERACTIVE or BACKGROUND
+        :type priority: int
+        :param data: request body, never sent conditionally
+        :type data: str
+        :param resource: rate limit resource the scheduler admits the request against
+        :type resource: str
+        :rtype: requests.Response
+        :raises service.ratelimit.RateLimitExceeded: when the scheduler sheds the request
+        """
+        if not conditional or data is not None:
+            return self.send(method, url, headers, provider, priority, data, resource)
+
+        key = (method, url)
+        entry = self.validators.get(key)
+        headers = dict(headers or {})
+        if entry is not None:
+            headers.update(self.validators.conditional_headers(entry))
+
+        response = self.send(method, url, headers, provider, priority, resource=resource)
+        if response.status_code == 304 and entry is not None:
+            return self.validators.build_response(entry, url)
+        if response.status_code == 200:
+            self.validators.set(key, response)
+        return response
+
+    def send(self, method, url, headers, provider, priority, data=None, resource=CORE):
+        if self.scheduler is None or provider is None:
+            return self.session.request(method, url, headers=headers, data=data, timeout=self.timeout)
+
+        credential = credential_id(headers)
+        self.scheduler.acquire(provider, credential, priority, resource)
+        response = self.session.request(method, url, headers=headers, data=data, timeout=self.timeout)
+        self.scheduler.update(provider, credential, response.headers, response.status_code, resource)
+        return response
+
+    def get(self, url, headers=None, conditional=False, **kwargs):
+        return self.request('GET', url, headers=headers, conditional=conditional, **kwargs)
+
+    def head(self, url, headers=None, conditional=False, **kwargs):
+        return self.request('HEAD', url, headers=headers, conditional=conditional, **kwargs)
@@ -1,16 +1,70 @@
-from service import app
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from service import create_app
 
 
 class RequestContext:
     """ test request context decorator for testing routes """
-    def __init__(self, path, method='GET', content_type='application/json'):
+    def __init__(self, path, method='GET', content_type='application/json', data=None):
         self.path = path
         self.method = method
         self.content_type = content_type
+        self.data = data
 
     def __call__(self, func):
         def wrapper(*args, **kwargs):
-            context_kwargs = {'method': self.method, 'content_type': self.content_type}
-            with app.test_request_context(self.path, **context_kwargs):
+            context_kwargs = {'method': self.method, 'content_type': self.content_type, 'data': self.data}
+            with create_app().test_request_context(self.path, **context_kwargs):
                 func(*args, **kwargs)
         return wrapper
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeUpstream:
+    """ Local http server standing in for a provider api
+
+    Every request gets the next (status, headers, body) from the list of responses, the last one is repeated once the
+    list runs out. Requests are recorded as (method, path, headers) with lowercase header names.
+    """
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def respond(self):
+                self.rfile.read(int(self.headers.get('content-length') or 0))
+                upstream.requests.append((self.command, self.path, {k.lower(): v for k, v in self.headers.items()}))
+                responses = upstream.responses
+                status, headers, body = responses.pop(0) if len(responses) > 1 else responses[0]
+                content = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('content-length', str(len(content)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(content)
+
+            do_GET = do_HEAD = do_POST = respond
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,178 @@
+import asyncio
+import json
+from unittest import mock, TestCase
+
+from service import aio
+
+
+def make_response(body=None, links=None, status_code=200):
+    content = json.dumps(body).encode('utf-8') if body is not None else b''
+    links = {rel: {'url': url} for rel, url in (links or {}).items()}
+    return aio.AsyncResponse(status_code, {}, links, content)
+
+
+class FakeAsyncTransport:
+    """ Serves canned responses keyed by method and url """
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = []
+
+    async def request(self, method, url, **kwargs):
+        self.calls.append((method, url))
+        return self.responses[(method, url)]
+
+
+class EventLoopThreadTestCase(TestCase):
+    def test_run(self):
+        async def add(a, b):
+            return a + b
+
+        self.assertEqual(aio.run(add(1, 2)), 3)
+
+    def test_run_raises(self):
+        async def fail():
+            raise ValueError('bad')
+
+        with self.assertRaises(ValueError):
+            aio.run(fail())
+
+
+class AsyncResponseTestCase(TestCase):
+    def test_json(self):
+        response = make_response({'profile': 'data'})
+
+        self.assertEqual(response.json(), {'profile': 'data'})
+
+
+class AsyncGithubProfileTestCase(TestCase):
+    def test_get_all_data(self):
+        repo1 = {
+            'watchers_count': 10, 'stargazers_count': 20, 'open_issues_count': 3, 'size': 1234,
+            'language': 'Python', 'topics': ['flask', 'api'],
+        }
+        repo2 = {
+            'watchers_count': 1, 'stargazers_count': 2, 'open_issues_count': 300, 'size': 123456,
+            'language': 'Java', 'topics': ['bugs'],
+        }
+        transport = FakeAsyncTransport({
+            ('GET', 'https://api.github.com/users/user1'): make_response({
+                'repos_url': 'https://api.github.com/users/user1/repos',
+                'starred_url': 'https://api.github.com/users/user1/starred{/owner}{/repo}',
+                'followers': 1234,
+            }),
+            ('GET', 'https://api.github.com/users/user1/repos?per_page=1'): make_response(
+                [repo1], links={'next': 'https://api.github.com/users/user1/repos?per_page=1&page=2'}
+            ),
+            ('GET', 'https://api.github.com/users/user1/repos?per_page=1&page=2'): make_response([repo2]),
+            ('HEAD', 'https://api.github.com/users/user1/starred?per_page=1'): make_response(
+                links={'last': 'https://api.github.com/users/user1/starred?per_page=1&page=92'}
+            ),
+        })
+
+        profile = aio.AsyncGithubProfile('user1', page_len=1)
+        with mock.patch.object(profile, 'async_transport', transport):
+            aio.run(profile.get_all_data())
+
+        self.assertEqual(profile.total_repo_count, 2)
+        self.assertEqual(profile.total_watcher_count, 11)
+        self.assertEqual(profile.total_follower_count, 1234)
+        self.assertEqual(profile.total_stars_received_count, 92)
+        self.assertEqual(profile.total_stars_given_count, 22)
+        self.assertEqual(profile.total_open_issues_count, 303)
+        self.assertEqual(profile.total_size, 124690)
+        self.assertCountEqual(profile.languages_used, ['Python', 'Java'])
+        self.assertCountEqual(profile.repo_topics, ['flask', 'api', 'bugs'])
+
+
+class AsyncBitbucketProfileTestCase(TestCase):
+    def test_get_team_profile(self):
+        transport = FakeAsyncTransport({
+            ('GET', 'https://api.bitbucket.org/2.0/users/user1'): make_response(
+                {'type': 'error', 'error': {'message': 'user1 is a team account'}}
+            ),
+            ('GET', 'https://api.bitbucket.org/2.0/teams/user1'): make_response({'profile': 'data'}),
+        })
+
+        profile = aio.AsyncBitbucketProfile('user1')
+        with mock.patch.object(profile, 'async_transport', transport):
+            aio.run(profile.get_user_profile())
+
+        self.assertEqual(profile.user_profile, {'profile': 'data'})
+
+    def test_get_all_data(self):
+        base = 'https://api.bitbucket.org/2.0/repositories/user1'
+        repo1 = {
+            'size': 1234, 'language': 'Python',
+            'links': {'watchers': {'href': base + '/repo1/watchers'}, 'issues': {'href': base + '/repo1/issues'}},
+        }
+        repo2 = {
+            'size': 123456, 'language': 'Java',
+            'links': {'watchers': {'href': base + '/repo2/watchers'}},
+        }
+        transport = FakeAsyncTransport({
+            ('GET', 'https://api.bitbucket.org/2.0/users/user1'): make_response({
+                'links': {
+                    'repositories': {'href': base},
+                    'followers': {'href': 'https://api.bitbucket.org/2.0/users/user1/followers'},
+                }
+            }),
+            ('GET', base + '?pagelen=25'): make_response({'values': [repo1, repo2]}),
+            ('GET', 'https://api.bitbucket.org/2.0/users/user1/followers?pagelen=0'): make_response({'size': 1234}),
+            ('GET', base + '/repo1/watchers?pagelen=0'): make_response({'size': 10}),
+            ('GET', base + '/repo1/issues?pagelen=0'): make_response({'size': 3}),
+            ('GET', base + '/repo2/watchers?pagelen=0'): make_response({'size': 1}),
+        })
+
+        profile = aio.AsyncBitbucketProfile('user1', page_len=25, max_in_flight=1)
+        with mock.patch.object(profile, 'async_transport', transport):
+            aio.run(profile.get_all_data())
+
+        self.assertEqual(profile.total_repo_count, 2)
+        self.assertEqual(profile.total_watcher_count, 11)
+        self.assertEqual(profile.total_follower_count, 1234)
+        self.assertEqual(profile.total_open_issues_count, 3)
+        self.assertEqual(profile.total_size, 124690)
+        self.assertCountEqual(profile.languages_used, ['Python', 'Java'])
+
+    def test_get_all_data_streams_repo_counts(self):
+        base = 'https://api.bitbucket.org/2.0/repositories/user1'
+        repos = [
+            {'size': 1, 'language': None, 'links': {'watchers': {'href': base + '/repo{}/watchers'.format(index)}}}
+            for index in range(4)
+        ]
+        running = []
+        peak = []
+
+        async def get_repo_counts(repo):
+            running.append(repo)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(repo)
+            if repo == repos[2]:
+                raise ValueError('count failed')
+            return 2, 1
+
+        transport = FakeAsyncTransport({
+            ('GET', 'https://api.bitbucket.org/2.0/users/user1'): make_response({
+                'links': {
+                    'repositories': {'href': base},
+                    'followers': {'href': 'https://api.bitbucket.org/2.0/users/user1/followers'},
+                }
+            }),
+            ('GET', base + '?pagelen=2'): make_response({'values': repos[:2], 'next': base + '?pagelen=2&page=2'}),
+            ('GET', base + '?pagelen=2&page=2'): make_response({'values': repos[2:]}),
+            ('GET', 'https://api.bitbucket.org/2.0/users/user1/followers?pagelen=0'): make_response({'size': 5}),
+        })
+
+        profile = aio.AsyncBitbucketProfile('user1', page_len=2, max_in_flight=2)
+        with mock.patch.object(profile, 'async_transport', transport), \
+                mock.patch.object(profile, 'get_repo_counts', side_effect=get_repo_counts):
+            with self.assertRaises(ValueError):
+                aio.run(profile.get_all_data())
+
+        self.assertLessEqual(max(peak), 2)
+        self.assertEqual(profile.repos, [])
+        self.assertEqual(profile.total_repo_count, 4)
+        self.assertEqual(profile.counted_repos, 3)
+        self.assertEqual(profile.total_watcher_count, 6)
+        self.assertEqual(profile.total_open_issues_count, 3)
@@ -0,0 +1,36 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from benchmarks import aggregate, compare, run
+
+
+class BenchmarkTestCase(TestCase):
+    def test_run_and_compare(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'result.json')
+            result = run.main([
+                '--users', '2', '--repos', '12', '--page-len', '5', '--requests', '4', '--latency', '0',
+                '--output', output,
+            ])
+            with open(output) as saved:
+                self.assertEqual(json.load(saved)['results']['requests'], 4)
+
+        results = result['results']
+        self.assertEqual(results['errors'], 0, results['first_error'])
+        self.assertGreaterEqual(results['upstream_calls']['by_kind']['github:list'], 2 * 3)
+        rows = compare.compare(result, result)
+        self.assertEqual({change for _, _, _, change, _ in rows if change is not None}, {0})
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+
+        self.assertEqual(run.percentile(values, 50), 50)
+        self.assertEqual(run.percentile(values, 99), 99)
+        self.assertIsNone(run.percentile([], 50))
+
+    def test_aggregate(self):
+        results = aggregate.main(['--repos', '50', '--page-len', '20', '--repeat', '1'])
+
+        self.assertEqual(len(results), 4)
@@ -0,0 +1,282 @@
+import fnmatch
+import os
+import socketserver
+import tempfile
+import threading
+import time
+from unittest import mock, TestCase
+
+from service import cache, resp
+
+
+class TTLCacheTestCase(TestCase):
+    def test_get_set(self):
+        inst = cache.TTLCache(ttl=60)
+        inst.set('key', {'value': 1})
+
+        self.assertEqual(inst.get('key'), {'value': 1})
+        self.assertIsNone(inst.get('other'))
+        self.assertEqual(inst.stats['hits'], 1)
+        self.assertEqual(inst.stats['misses'], 1)
+
+    def test_expiry(self):
+        inst = cache.TTLCache(ttl=60)
+        inst.set('key', 'value')
+
+        with mock.patch.object(cache.time, 'monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNone(inst.get('key'))
+
+        self.assertEqual(len(inst), 0)
+        self.assertEqual(inst.stats['expirations'], 1)
+
+    def test_evict_by_entries(self):
+        inst = cache.TTLCache(max_entries=2)
+        inst.set('a', 1)
+        inst.set('b', 2)
+        inst.get('a')
+        inst.set('c', 3)
+
+        self.assertEqual(inst.get('a'), 1)
+        self.assertIsNone(inst.get('b'))
+        self.assertEqual(inst.get('c'), 3)
+        self.assertEqual(inst.stats['evictions'], 1)
+
+    def test_evict_by_bytes(self):
+        inst = cache.TTLCache(max_bytes=15)
+        inst.set('a', 'x' * 8)
+        inst.set('b', 'y' * 8)
+
+        self.assertIsNone(inst.get('a'))
+        self.assertEqual(inst.get('b'), 'y' * 8)
+        self.assertEqual(inst.stats['bytes'], 10)
+
+    def test_value_larger_than_cache(self):
+        inst = cache.TTLCache(max_bytes=5)
+        inst.set('a', 'x' * 8)
+
+        self.assertEqual(len(inst), 0)
+
+    def test_replace(self):
+        inst = cache.TTLCache()
+        inst.set('a', 'x')
+        inst.set('a', 'xyz')
+
+        self.assertEqual(inst.get('a'), 'xyz')
+        self.assertEqual(inst.stats['bytes'], 5)
+
+    def test_delete_clear(self):
+        inst = cache.TTLCache()
+        inst.set('a', 1)
+        inst.set('b', 2)
+        inst.delete('a')
+
+        self.assertIsNone(inst.get('a'))
+        inst.clear()
+        self.assertEqual(inst.stats['entries'], 0)
+        self.assertEqual(inst.stats['bytes'], 0)
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """ Speaks just enough of the redis protocol for RedisBackend """
+    def handle(self):
+        while True:
+            try:
+                command = resp.RespClient.read_reply(self.rfile)
+            except ConnectionError:
+                return
+            self.wfile.write(self.server.execute(command))
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeRedisHandler)
+        self.data = {}
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def get(self, key):
+        value, expires_at = self.data.get(key, (None, None))
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    def execute(self, command):
+        name, args = command[0].upper(), command[1:]
+        with self.lock:
+            if name == b'GET':
+                value = self.get(args[0])
+                return b'$-1\r\n' if value is None else resp.RespClient.encode([value])[4:]
+            if name == b'SET':
+                options = [arg.upper() for arg in args[2:]]
+                if b'NX' in options and self.get(args[0]) is not None:
+                    return b'$-1\r\n'
+                expires_at = None
+                if b'PX' in options:
+                    expires_at = time.monotonic() + int(args[2 + options.index(b'PX') + 1]) / 1000
+                self.data[args[0]] = (args[1], expires_at)
+                return b'+OK\r\n'
+            if name == b'DEL':
+                count = sum(self.data.pop(key, None) is not None for key in args)
+                return ':{}\r\n'.format(count).encode()
+            if name == b'SCAN':
+                pattern = args[args.index(b'MATCH') + 1].decode()
+                keys = [key for key in self.data if fnmatch.fnmatchcase(key.decode(), pattern)]
+                return b'*2\r\n$1\r\n0\r\n' + resp.RespClient.encode(keys)
+        return b'-ERR unknown command\r\n'
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class CacheBackendTestMixin:
+    """ Behaviour every cache backend must share """
+    def make_cache(self, ttl=60):
+        raise NotImplementedError
+
+    def test_get_set(self):
+        inst = self.make_cache()
+        inst.set(('provider', 'user1'), {'languages_used': ['Python']})
+
+        self.assertEqual(inst.get(('provider', 'user1')), {'languages_used': ['Python']})
+        self.assertIsNone(inst.get(('provider', 'user2')))
+        self.assertEqual(inst.stats['hits'], 1)
+        self.assertEqual(inst.stats['misses'], 1)
+
+    def test_ttl(self):
+        inst = self.make_cache()
+        inst.set(('a',), 1, ttl=0.01)
+        time.sleep(0.02)
+
+        self.assertIsNone(inst.get(('a',)))
+
+    def test_add(self):
+        inst = self.make_cache()
+
+        self.assertTrue(inst.add(('a',), 1))
+        self.assertFalse(inst.add(('a',), 2))
+        self.assertEqual(inst.get(('a',)), 1)
+
+    def test_delete_clear(self):
+        inst = self.make_cache()
+        inst.set(('a',), 1)
+        inst.set(('b',), 2)
+        inst.delete(('a',))
+
+        self.assertIsNone(inst.get(('a',)))
+        inst.clear()
+        self.assertIsNone(inst.get(('b',)))
+
+    def test_get_or_set_single_compute(self):
+        inst = self.make_cache()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return {'total_size': 10}
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(inst.get_or_set(('provider', 'user1'), compute)))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'total_size': 10}] * 5)
+
+
+class TTLCacheBackendTestCase(CacheBackendTestMixin, TestCase):
+    def make_cache(self, ttl=60):
+        return cache.TTLCache(ttl=ttl)
+
+
+class SqliteBackendTestCase(CacheBackendTestMixin, TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'cache.db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make_cache(self, ttl=60):
+        return cache.SqliteBackend(self.path, namespace='test', ttl=ttl)
+
+    def test_shared_between_instances(self):
+        self.make_cache().set(('a',), [1, 2])
+
+        self.assertEqual(self.make_cache().get(('a',)), [1, 2])
+        self.assertIsNone(cache.SqliteBackend(self.path, namespace='other').get(('a',)))
+
+    def test_new_connection_after_fork(self):
+        backend = self.make_cache()
+        connection = backend.connection
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            forked_connection = backend.connection
+
+        self.assertIsNot(forked_connection, connection)
+        self.assertEqual(forked_connection.execute('SELECT count(*) FROM cache').fetchone(), (0,))
+
+
+class RedisBackendTestCase(CacheBackendTestMixin, TestCase):
+    def setUp(self):
+        self.server = FakeRedisServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def make_cache(self, ttl=60):
+        client = resp.RespClient(*self.server.server_address)
+        return cache.RedisBackend(client, namespace='test', ttl=ttl)
+
+    def test_new_connection_after_fork(self):
+        backend = self.make_cache()
+        backend.set(('a',), 1)
+        sock, reader = backend.client.connection
+        with mock.patch('os.getpid', return_value=os.getpid() + 1):
+            forked_sock, forked_reader = backend.client.connection
+            self.assertEqual(backend.get(('a',)), 1)
+
+        self.assertIsNot(forked_sock, sock)
+        self.assertIsNot(forked_reader, reader)
+
+    def test_clear_only_namespace(self):
+        self.make_cache().set(('a',), 1)
+        other = cache.RedisBackend(resp.RespClient(*self.server.server_address), namespace='other')
+        other.set(('a',), 2)
+        self.make_cache().clear()
+
+        self.assertEqual(other.get(('a',)), 2)
+
+
+class SerializeTestCase(TestCase):
+    def test_round_trip(self):
+        small = {'a': 1}
+        large = {'repo_topics': ['topic{}'.format(i) for i in range(500)]}
+
+        self.assertEqual(cache.serialize(small)[:1], b'j')
+        self.assertEqual(cache.serialize(large)[:1], b'z')
+        self.assertEqual(cache.deserialize(cache.serialize(small)), small)
+        self.assertEqual(cache.deserialize(cache.serialize(large)), large)
+
+
+class FromUrlTestCase(TestCase):
+    def test_from_url(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sqlite_cache = cache.from_url('sqlite://' + os.path.join(tmpdir, 'cache.db'), 'provider')
+            self.assertIsInstance(sqlite_cache, cache.SqliteBackend)
+
+        redis_cache = cache.from_url('redis://localhost:6380/2', 'provider', ttl=5)
+        self.assertIsInstance(redis_cache, cache.RedisBackend)
+        self.assertEqual((redis_cache.client.port, redis_cache.client.db, redis_cache.ttl), (6380, 2, 5))
+        self.assertIsInstance(cache.from_url('memory', 'provider'), cache.TTLCache)
+        with self.assertRaises(ValueError):
+            cache.from_url('memcached://localhost', 'provider')
@@ -0,0 +1,36 @@
+import json
+from unittest import mock, TestCase
+
+from service import codec
+
+
+class CodecTestCase(TestCase):
+    def test_loads_bytes_and_str(self):
+        for orjson in (codec.orjson, None):
+            with mock.patch.object(codec, 'orjson', orjson):
+                self.assertEqual(codec.loads(b'{"name": "caf\\u00e9"}'), {'name': 'café'})
+                self.assertEqual(codec.loads('[1, 2]'), [1, 2])
+
+    def test_project_list(self):
+        content = json.dumps([{'size': 1, 'name': 'a', 'owner': {}}, {'name': 'b'}]).encode('utf-8')
+
+        self.assertEqual(codec.loads(content, fields=('size', 'name')), [{'size': 1, 'name': 'a'}, {'name': 'b'}])
+
+    def test_project_items_key(self):
+        content = json.dumps({'size': 2, 'next': 'url', 'values': [{'size': 1, 'owner': {}}]}).encode('utf-8')
+
+        body = codec.loads(content, fields=('size',), items_key='values')
+
+        self.assertEqual(body, {'size': 2, 'next': 'url', 'values': [{'size': 1}]})
+
+    def test_error_body_not_projected(self):
+        content = b'{"message": "Not Found"}'
+
+        self.assertEqual(codec.loads(content, fields=('size',)), {'message': 'Not Found'})
+        self.assertEqual(codec.loads(content, fields=('size',), items_key='values'), {'message': 'Not Found'})
+
+    def test_dumps(self):
+        value = {'languages': ['Python'], 'count': 2 ** 70, 'ratio': 0.1}
+        for orjson in (codec.orjson, None):
+            with mock.patch.object(codec, 'orjson', orjson):
+                self.assertEqual(codec.dumps(value), json.dumps(value))
@@ -0,0 +1,103 @@
+import time
+from unittest import mock, TestCase
+
+from service import credentials, models, ratelimit, transport
+from tests import FakeUpstream
+
+
+def make_pool(*tokens, **kwargs):
+    scheduler = ratelimit.UpstreamScheduler(rates={})
+    authorizations = [credentials.github_authorization(token) for token in tokens]
+    return credentials.TokenPool('github', authorizations, scheduler=scheduler, **kwargs)
+
+
+def report_remaining(pool, authorization, remaining):
+    headers = {'x-ratelimit-limit': '5000', 'x-ratelimit-remaining': str(remaining)}
+    pool.scheduler.update('github', ratelimit.credential_id({'authorization': authorization}), headers, 200)
+
+
+class TokenPoolTestCase(TestCase):
+    def test_empty(self):
+        pool = make_pool()
+
+        self.assertIsNone(pool.choose())
+
+    def test_from_config(self):
+        pool = credentials.TokenPool.from_config('github', ' abc, ,def ', credentials.github_authorization)
+
+        self.assertEqual(pool.authorizations, ['token abc', 'token def'])
+
+    def test_bitbucket_authorization(self):
+        self.assertEqual(credentials.bitbucket_authorization('user:pass'), 'Basic dXNlcjpwYXNz')
+        self.assertEqual(credentials.bitbucket_authorization('access'), 'Bearer access')
+
+    def test_round_robin(self):
+        pool = make_pool('a', 'b', 'c')
+
+        chosen = [pool.choose() for _ in range(4)]
+
+        self.assertEqual(chosen, ['token a', 'token b', 'token c', 'token a'])
+
+    def test_most_remaining_budget(self):
+        pool = make_pool('a', 'b', 'c')
+        report_remaining(pool, 'token a', 10)
+        report_remaining(pool, 'token b', 4000)
+        report_remaining(pool, 'token c', 20)
+
+        self.assertEqual({pool.choose() for _ in range(3)}, {'token b'})
+
+    def test_drops_rejected(self):
+        pool = make_pool('a', 'b')
+        pool.report('token a', 401)
+
+        self.assertEqual({pool.choose() for _ in range(2)}, {'token b'})
+        self.assertEqual(pool.stats, {'credentials': 2, 'dropped': 1})
+
+    def test_cooldown(self):
+        pool = make_pool('a', 'b', cooldown=0.01)
+        pool.report('token a', 403, {'X-RateLimit-Remaining': '0'})
+        self.assertEqual(pool.stats['dropped'], 1)
+        time.sleep(0.02)
+
+        self.assertEqual([pool.choose() for _ in range(2)], ['token a', 'token b'])
+
+    def test_keeps_forbidden_with_remaining_budget(self):
+        pool = make_pool('a', 'b')
+        pool.report('token a', 403, {'X-RateLimit-Remaining': '4999'})
+        pool.report('token a', 403)
+
+        self.assertEqual(pool.stats, {'credentials': 2, 'dropped': 0})
+        self.assertEqual([pool.choose() for _ in range(2)], ['token a', 'token b'])
+
+    def test_all_dropped(self):
+        pool = make_pool('a', 'b')
+        pool.report('token b', 401)
+        pool.report('token a', 401)
+
+        self.assertEqual(pool.choose(), 'token b')
+
+
+class ProfileCredentialsTestCase(TestCase):
+    def test_unauthenticated_without_pool(self):
+        with mock.patch.object(models.GithubProfile, 'token_pool', make_pool()):
+            headers = models.GithubProfile('user1').headers
+
+        self.assertNotIn('authorization', headers)
+
+    def test_rotates_and_drops_rejected_token(self):
+        pool = make_pool('a', 'b')
+        profile = models.GithubProfile('user1')
+        responses = [
+            (401, {}, {'message': 'Bad credentials'}),
+            (200, {}, {'followers': 1}),
+            (200, {}, {'followers': 2}),
+        ]
+        with FakeUpstream(responses) as upstream, mock.patch.object(models.GithubProfile, 'token_pool', pool):
+            with mock.patch.object(profile, 'transport', transport.Transport(hosts=())):
+                with mock.patch('service.constants.GITHUB_PROFILE_URL', upstream.url + '/users/{username}'):
+                    for _ in range(3):
+                        profile.get_user_profile()
+
+        authorizations = [headers['authorization'] for _, _, headers in upstream.requests]
+        self.assertEqual(authorizations, ['token a', 'token b', 'token b'])
+        self.assertEqual(profile.user_profile, {'followers': 2})
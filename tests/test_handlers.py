@@ -1,9 +1,25 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
 from unittest import mock, TestCase
 
-from service import handlers
+from service import constants, handlers, models, store
+
+
+def clear_caches():
+    handlers.consolidated_cache.clear()
+    handlers.provider_cache.clear()
+    handlers.snapshot_cache.clear()
+    handlers.stale_cache.clear()
+    handlers.partial_cache.clear()
 
 
 class HandleGetProfileTestCase(TestCase):
+    def setUp(self):
+        clear_caches()
+
     def test_handle_get_profile(self):
         inst = mock.Mock()
         inst.dict = {'profile': 'data'}
@@ -19,3 +35,559 @@ class HandleGetProfileTestCase(TestCase):
         self.assertEqual(github_profile.username, 'user1')
         self.assertEqual(bitbucket_profile.username, 'user2')
         self.assertEqual(profile, {'profile': 'data'})
+
+    def test_handle_get_profile_error_propagates(self):
+        with mock.patch.object(handlers.GithubProfile, 'get_all_data', side_effect=ValueError('bad')), \
+                mock.patch.object(handlers.BitbucketProfile, 'get_all_data'):
+            with self.assertRaises(ValueError):
+                handlers.handle_get_profile('user1', 'user2')
+
+    def test_handle_get_profile_cached(self):
+        with mock.patch.object(handlers.GithubProfile, 'get_all_data') as mock_github_get_data, \
+                mock.patch.object(handlers.BitbucketProfile, 'get_all_data') as mock_bitbucket_get_data:
+            first = handlers.handle_get_profile('user1', 'user2')
+            second = handlers.handle_get_profile('user1', 'user2')
+
+        self.assertEqual(first, second)
+        self.assertEqual(mock_github_get_data.call_count, 1)
+        self.assertEqual(mock_bitbucket_get_data.call_count, 1)
+
+    def test_handle_get_profile_shares_provider_cache(self):
+        with mock.patch.object(handlers.GithubProfile, 'get_all_data') as mock_github_get_data, \
+                mock.patch.object(handlers.BitbucketProfile, 'get_all_data') as mock_bitbucket_get_data:
+            handlers.handle_get_profile('user1', 'user2')
+            handlers.handle_get_profile('user1', 'user3')
+
+        self.assertEqual(mock_github_get_data.call_count, 1)
+        self.assertEqual(mock_bitbucket_get_data.call_count, 2)
+
+    def test_handle_get_profile_refresh(self):
+        with mock.patch.object(handlers.GithubProfile, 'get_all_data') as mock_github_get_data, \
+                mock.patch.object(handlers.BitbucketProfile, 'get_all_data') as mock_bitbucket_get_data:
+            handlers.handle_get_profile('user1', 'user2')
+            handlers.handle_get_profile('user1', 'user2', refresh=True)
+
+        self.assertEqual(mock_github_get_data.call_count, 2)
+        self.assertEqual(mock_bitbucket_get_data.call_count, 2)
+
+
+class FetchProfilesTestCase(TestCase):
+    def setUp(self):
+        clear_caches()
+
+    def test_fetch_profiles_concurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+        github_profile = mock.Mock(username='user1', aggregates={}, snapshot={})
+        github_profile.get_all_data.side_effect = barrier.wait
+        bitbucket_profile = mock.Mock(username='user2', aggregates={}, snapshot={})
+        bitbucket_profile.get_all_data.side_effect = barrier.wait
+
+        handlers.fetch_profiles({'github': github_profile, 'bitbucket': bitbucket_profile})
+
+        github_profile.get_all_data.assert_called_once_with()
+        bitbucket_profile.get_all_data.assert_called_once_with()
+
+    def test_fetch_profiles_timeout(self):
+        event = threading.Event()
+        slow_profile = mock.Mock(username='slow-user', aggregates={}, snapshot={})
+        slow_profile.get_all_data.side_effect = lambda: event.wait(5)
+        try:
+            with self.assertRaises(handlers.ProfileFetchTimeout) as context:
+                handlers.fetch_profiles({'github': slow_profile}, timeout=0.01)
+        finally:
+            event.set()
+
+        self.assertEqual(context.exception.provider, 'github')
+        self.assertEqual(context.exception.username, 'slow-user')
+
+
+class LoadProfileTestCase(TestCase):
+    def setUp(self):
+        clear_caches()
+
+    def test_load_profile_single_fetch(self):
+        calls = []
+
+        def get_all_data():
+            calls.append(1)
+            time.sleep(0.05)
+
+        profiles = [handlers.GithubProfile('user1') for _ in range(5)]
+        for profile in profiles:
+            profile.get_all_data = get_all_data
+            profile.total_repo_count = 3
+        threads = [threading.Thread(target=handlers.load_profile, args=('github', profile)) for profile in profiles]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        aggregates = handlers.provider_cache.get(('github', 'user1'))
+        self.assertEqual(models.ProfileAggregate.load(aggregates).total_repo_count, 3)
+
+    def test_load_profile_cached(self):
+        profile = handlers.GithubProfile('user1')
+        profile.total_size = 10
+        handlers.provider_cache.set(('github', 'user1'), profile.aggregates)
+
+        cached_profile = handlers.GithubProfile('user1')
+        with mock.patch.object(cached_profile, 'get_all_data') as mock_get_all_data:
+            handlers.load_profile('github', cached_profile)
+
+        mock_get_all_data.assert_not_called()
+        self.assertEqual(cached_profile.total_size, 10)
+
+    def test_load_profile_refresh(self):
+        handlers.provider_cache.set(('github', 'user1'), handlers.GithubProfile('user1').aggregates)
+
+        profile = handlers.GithubProfile('user1')
+        with mock.patch.object(profile, 'get_all_data') as mock_get_all_data:
+            profile.total_size = 10
+            handlers.load_profile('github', profile, refresh=True)
+
+        mock_get_all_data.assert_called_once_with()
+        aggregates = handlers.provider_cache.get(('github', 'user1'))
+        self.assertEqual(models.ProfileAggregate.load(aggregates).total_size, 10)
+
+    def test_load_profile_incremental(self):
+        snapshot = {'aggregate': handlers.GithubProfile('user1').aggregates, 'repos': {}}
+        handlers.snapshot_cache.set(('github', 'user1'), snapshot)
+
+        profile = handlers.GithubProfile('user1')
+        with mock.patch.object(profile, 'get_incremental_data', return_value=True) as mock_incremental, \
+                mock.patch.object(profile, 'get_all_data') as mock_get_all_data:
+            handlers.load_profile('github', profile)
+
+        mock_incremental.assert_called_once_with(snapshot)
+        mock_get_all_data.assert_not_called()
+
+    def test_load_profile_incremental_fallback(self):
+        handlers.snapshot_cache.set(('github', 'user1'), {'aggregate': [], 'repos': {}})
+
+        profile = handlers.GithubProfile('user1')
+        with mock.patch.object(profile, 'get_incremental_data', return_value=False), \
+                mock.patch.object(profile, 'get_all_data') as mock_get_all_data:
+            handlers.load_profile('github', profile)
+
+        mock_get_all_data.assert_called_once_with()
+        self.assertEqual(
+            handlers.snapshot_cache.get(('github', 'user1')), {'aggregate': profile.aggregates, 'repos': {}},
+        )
+
+
+class StaleWhileRevalidateTestCase(TestCase):
+    def setUp(self):
+        clear_caches()
+        handlers.requested.clear()
+        patch = mock.patch.object(handlers, 'refresh_executor', mock.Mock(submit=lambda func: func()))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_load_profile_serves_stale(self):
+        stale_profile = handlers.GithubProfile('user1')
+        stale_profile.total_size = 10
+        handlers.stale_cache.set(('github', 'user1'), stale_profile.aggregates)
+
+        profile = handlers.GithubProfile('user1')
+        with mock.patch.object(handlers, 'refresh_in_background') as mock_refresh, \
+                mock.patch.object(profile, 'get_all_data') as mock_get_all_data:
+            stale = handlers.load_profile('github', profile)
+
+        self.assertTrue(stale)
+        self.assertEqual(profile.total_size, 10)
+        mock_get_all_data.assert_not_called()
+        mock_refresh.assert_called_once_with('github', 'user1')
+
+    def test_refresh_in_background(self):
+        priorities = []
+
+        def get_all_data(profile):
+            priorities.append(profile.priority)
+            self.assertFalse(handlers.refresh_in_background('github', 'user1'))
+            profile.total_size = 20
+
+        with mock.patch.object(handlers.GithubProfile, 'get_all_data', autospec=True, side_effect=get_all_data):
+            self.assertTrue(handlers.refresh_in_background('github', 'user1'))
+
+        self.assertEqual(priorities, [handlers.BACKGROUND])
+        self.assertEqual(handlers.refreshing, set())
+        aggregates = handlers.provider_cache.get(('github', 'user1'))
+        self.assertEqual(models.ProfileAggregate.load(aggregates).total_size, 20)
+        self.assertEqual(handlers.stale_cache.get(('github', 'user1')), aggregates)
+
+    def test_refresh_in_background_error(self):
+        with mock.patch.object(handlers.GithubProfile, 'get_all_data', side_effect=ValueError('bad')), \
+                mock.patch.object(handlers.logger, 'exception') as mock_exception:
+            handlers.refresh_in_background('github', 'user1')
+
+        mock_exception.assert_called_once_with('Background refresh of %s profile for %s failed', 'github', 'user1')
+        self.assertEqual(handlers.refreshing, set())
+
+    def test_stale_profile_not_cached(self):
+        handlers.stale_cache.set(('github', 'user1'), handlers.GithubProfile('user1').aggregates)
+        with mock.patch.object(handlers, 'refresh_in_background'), \
+                mock.patch.object(handlers.BitbucketProfile, 'get_all_data'):
+            handlers.handle_get_profile('user1', 'user2')
+
+        self.assertIsNone(handlers.consolidated_cache.get(('user1', 'user2')))
+
+    @mock.patch.object(constants, 'PREWARM_INTERVAL', 60)
+    def test_prewarm(self):
+        for key, count in ((('github', 'user1'), 5), (('bitbucket', 'user2'), 3), (('github', 'user3'), 1)):
+            for _ in range(count):
+                handlers.count_request(key)
+
+        with mock.patch.object(handlers, 'refresh_in_background', return_value=True) as mock_refresh:
+            refreshed = handlers.prewarm(top_n=2)
+
+        self.assertEqual(refreshed, [('github', 'user1'), ('bitbucket', 'user2')])
+        self.assertEqual(mock_refresh.call_count, 2)
+        self.assertEqual(handlers.requested, {('github', 'user1'): 2, ('bitbucket', 'user2'): 1})
+
+    def test_count_request_only_while_prewarming(self):
+        with mock.patch.object(constants, 'PREWARM_INTERVAL', 0):
+            handlers.count_request(('github', 'user1'))
+
+        self.assertEqual(handlers.requested, {})
+
+    @mock.patch.object(constants, 'PREWARM_INTERVAL', 60)
+    def test_count_request_bounded(self):
+        for _ in range(3):
+            handlers.count_request(('github', 'user1'), max_tracked=4)
+        for index in range(10):
+            handlers.count_request(('github', 'once{}'.format(index)), max_tracked=4)
+
+        self.assertLessEqual(len(handlers.requested), 4)
+        self.assertEqual(handlers.requested[('github', 'user1')], 3)
+
+
+class SnapshotStoreTestCase(TestCase):
+    def setUp(self):
+        clear_caches()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = store.SnapshotStore(os.path.join(directory.name, 'snapshots.db'), flush_interval=60)
+        patch = mock.patch.object(handlers, 'snapshot_store', self.store)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def stored_profile(self, total_size, age):
+        profile = handlers.GithubProfile('user1')
+        profile.total_size = total_size
+        self.store.put('github', 'user1', profile.aggregates, {})
+        self.store.flush()
+        self.store.connection.execute('UPDATE profiles SET updated_at = ?', (time.time() - age,))
+
+    def test_crawl_stores_snapshot(self):
+        profile = handlers.GithubProfile('user1')
+        with mock.patch.object(profile, 'get_all_data'):
+            handlers.crawl_profile('github', profile)
+
+        self.assertEqual(self.store.get('github', 'user1'), {'aggregate': profile.aggregates, 'repos': {}})
+
+    def test_async_crawl_stores_records(self):
+        async def get_all_data():
+            profile.add_repos([{
+                'full_name': 'user1/repo1', 'updated_at': 't1', 'watchers_count': 1, 'stargazers_count': 2,
+                'open_issues_count': 3, 'size': 4, 'language': 'Python', 'topics': [],
+            }])
+
+        profile = handlers.aio.AsyncGithubProfile('user1')
+        with mock.patch.object(profile, 'get_all_data', side_effect=get_all_data):
+            handlers.aio.run(handlers.fetch_profiles_async({'github': profile}))
+
+        stored = self.store.get('github', 'user1')
+        self.assertEqual(stored['aggregate'], profile.aggregates)
+        self.assertEqual(list(stored['repos']), ['user1/repo1'])
+        self.assertEqual(handlers.snapshot_cache.get(('github', 'user1')), stored)
+
+    def test_crawl_uses_stored_snapshot(self):
+        self.stored_profile(10, age=0)
+        snapshot = self.store.get('github', 'user1')
+        profile = handlers.GithubProfile('user1')
+        with mock.patch.object(profile, 'get_incremental_data', return_value=True) as mock_incremental, \
+                mock.patch.object(profile, 'get_all_data') as mock_get_all_data:
+            handlers.crawl_profile('github', profile)
+
+        mock_incremental.assert_called_once_with(snapshot)
+        mock_get_all_data.assert_not_called()
+
+    def test_load_profile_from_store(self):
+        self.stored_profile(10, age=1)
+        profile = handlers.GithubProfile('user1')
+        with mock.patch.object(profile, 'get_all_data') as mock_get_all_data:
+            stale = handlers.load_profile('github', profile)
+
+        self.assertFalse(stale)
+        self.assertEqual(profile.total_size, 10)
+        mock_get_all_data.assert_not_called()
+        self.assertIsNotNone(handlers.provider_cache.get(('github', 'user1')))
+
+    def test_load_profile_stale_from_store(self):
+        self.stored_profile(10, age=constants.PROFILE_CACHE_TTL + 1)
+        profile = handlers.GithubProfile('user1')
+        with mock.patch.object(handlers, 'refresh_in_background') as mock_refresh:
+            stale = handlers.load_profile('github', profile)
+
+        self.assertTrue(stale)
+        self.assertEqual(profile.total_size, 10)
+        mock_refresh.assert_called_once_with('github', 'user1')
+
+    def test_warm_start(self):
+        self.stored_profile(10, age=constants.PROFILE_CACHE_TTL + 1)
+        self.store.put('bitbucket', 'user2', handlers.BitbucketProfile('user2').aggregates)
+        self.store.put('bitbucket', 'user3', handlers.BitbucketProfile('user3').aggregates)
+        self.store.flush()
+        self.store.connection.execute("UPDATE profiles SET updated_at = 0 WHERE username = 'user3'")
+
+        self.assertEqual(handlers.warm_start(), 2)
+        self.assertIsNone(handlers.provider_cache.get(('github', 'user1')))
+        self.assertIsNotNone(handlers.stale_cache.get(('github', 'user1')))
+        self.assertIsNotNone(handlers.provider_cache.get(('bitbucket', 'user2')))
+        self.assertIsNone(handlers.stale_cache.get(('bitbucket', 'user3')))
+
+
+class PartialProfileTestCase(TestCase):
+    def setUp(self):
+        clear_caches()
+        patch = mock.patch.object(handlers, 'refresh_in_background')
+        self.mock_refresh = patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_load_profile_partial(self):
+        def get_all_data(profile):
+            profile.user_profile = {'public_repos': 4}
+            profile.add_repos([{
+                'full_name': 'user1/repo1', 'updated_at': '', 'watchers_count': 1, 'stargazers_count': 0,
+                'open_issues_count': 0, 'size': 10, 'language': None, 'topics': [],
+            }])
+            raise models.CrawlBudgetExhausted('pages')
+
+        profile = handlers.GithubProfile('user1')
+        with mock.patch.object(handlers.GithubProfile, 'get_all_data', autospec=True, side_effect=get_all_data):
+            stale = handlers.load_profile('github', profile)
+
+        self.assertFalse(stale)
+        self.assertTrue(profile.partial)
+        self.assertEqual(profile.total_repo_count, 4)
+        self.assertEqual(profile.total_size, 40)
+        self.assertIsNone(handlers.provider_cache.get(('github', 'user1')))
+        self.assertIsNone(handlers.stale_cache.get(('github', 'user1')))
+        self.assertIsNone(handlers.snapshot_cache.get(('github', 'user1')))
+
+    def test_partial_incremental_refresh_uses_snapshot(self):
+        snapshot_profile = handlers.GithubProfile('user1')
+        snapshot_profile.total_size = 10
+        handlers.snapshot_cache.set(('github', 'user1'), {'aggregate': snapshot_profile.aggregates, 'repos': {}})
+
+        profile = handlers.GithubProfile('user1')
+        exhausted = models.CrawlBudgetExhausted('deadline')
+        with mock.patch.object(profile, 'get_incremental_data', side_effect=exhausted):
+            handlers.load_profile('github', profile)
+
+        self.assertTrue(profile.partial)
+        self.assertEqual(profile.total_size, 10)
+
+    def test_partial_profile_not_cached(self):
+        exhausted = models.CrawlBudgetExhausted('calls')
+        with mock.patch.object(handlers.GithubProfile, 'get_all_data', side_effect=exhausted), \
+                mock.patch.object(handlers.BitbucketProfile, 'get_all_data'):
+            profile = handlers.handle_get_profile('user1', 'user2')
+
+        self.assertTrue(profile['partial'])
+        self.assertIsNone(handlers.consolidated_cache.get(('user1', 'user2')))
+        self.assertIsNotNone(handlers.provider_cache.get(('bitbucket', 'user2')))
+
+    def test_partial_profile_completed_in_background(self):
+        exhausted = models.CrawlBudgetExhausted('calls')
+        with mock.patch.object(handlers.GithubProfile, 'get_all_data', side_effect=exhausted) as mock_get_all_data:
+            first = handlers.GithubProfile('user1')
+            handlers.load_profile('github', first)
+            second = handlers.GithubProfile('user1')
+            handlers.load_profile('github', second)
+
+        mock_get_all_data.assert_called_once_with()
+        self.mock_refresh.assert_called_once_with('github', 'user1')
+        self.assertTrue(second.partial)
+        self.assertEqual(second.aggregates, first.aggregates)
+
+    def test_async_partial_profile_completed_in_background(self):
+        async def get_all_data():
+            raise models.CrawlBudgetExhausted('calls')
+
+        profiles = [handlers.aio.AsyncGithubProfile('user1') for _ in range(2)]
+        profile_class = handlers.aio.AsyncGithubProfile
+        with mock.patch.object(profile_class, 'get_all_data', side_effect=get_all_data) as mock_crawl:
+            for profile in profiles:
+                handlers.aio.run(handlers.fetch_profiles_async({'github': profile}))
+
+        self.assertEqual(mock_crawl.call_count, 1)
+        self.mock_refresh.assert_called_once_with('github', 'user1')
+        self.assertTrue(profiles[1].partial)
+
+    def test_budgeted_crawl_does_not_join_background_crawl(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def get_all_data(profile):
+            if profile.budget is None:
+                started.set()
+                release.wait(5)
+            else:
+                raise models.CrawlBudgetExhausted('deadline')
+
+        background = handlers.GithubProfile('user1')
+        with mock.patch.object(handlers.GithubProfile, 'get_all_data', autospec=True, side_effect=get_all_data):
+            thread = threading.Thread(target=handlers.crawl_profile, args=('github', background))
+            thread.start()
+            try:
+                started.wait(5)
+                profile = handlers.GithubProfile('user1')
+                began = time.monotonic()
+                handlers.load_profile('github', profile)
+                elapsed = time.monotonic() - began
+            finally:
+                release.set()
+                thread.join()
+
+        self.assertLess(elapsed, 1)
+        self.assertTrue(profile.partial)
+
+    def test_batch_partial_profile_not_cached(self):
+        exhausted = models.CrawlBudgetExhausted('calls')
+        with mock.patch.object(handlers.GithubProfile, 'get_all_data', side_effect=exhausted), \
+                mock.patch.object(handlers.BitbucketProfile, 'get_all_data'):
+            items = handlers.handle_get_profiles([{'github': 'user1', 'bitbucket': 'user2'}])
+
+        self.assertTrue(items[0]['profile']['partial'])
+        self.assertIsNone(handlers.consolidated_cache.get(('user1', 'user2')))
+
+
+class HandleGetProfileAsyncTestCase(TestCase):
+    def setUp(self):
+        clear_caches()
+
+    def test_handle_get_profile_async(self):
+        async def get_all_data():
+            pass
+
+        inst = mock.Mock()
+        inst.dict = {'profile': 'data'}
+        with mock.patch.object(handlers.aio.AsyncGithubProfile, 'get_all_data', side_effect=get_all_data), \
+                mock.patch.object(handlers.aio.AsyncBitbucketProfile, 'get_all_data', side_effect=get_all_data), \
+                mock.patch.object(handlers, 'ConsolidatedProfile', return_value=inst) as mock_consolidated_profile:
+            profile = handlers.handle_get_profile_async('user1', 'user2')
+
+        github_profile, bitbucket_profile = mock_consolidated_profile.call_args[0]
+        self.assertEqual(github_profile.username, 'user1')
+        self.assertEqual(bitbucket_profile.username, 'user2')
+        self.assertEqual(profile, {'profile': 'data'})
+
+    def test_fetch_profiles_async_timeout(self):
+        async def get_all_data():
+            await asyncio.sleep(5)
+
+        slow_profile = mock.Mock(username='slow-user', aggregates={}, snapshot={})
+        slow_profile.get_all_data.side_effect = get_all_data
+
+        with self.assertRaises(handlers.ProfileFetchTimeout) as context:
+            handlers.aio.run(handlers.fetch_profiles_async({'github': slow_profile}, timeout=0.01))
+
+        self.assertEqual(context.exception.provider, 'github')
+
+
+class HandleGetProfilesTestCase(TestCase):
+    def setUp(self):
+        clear_caches()
+
+    def test_handle_get_profiles(self):
+        loaded = []
+
+        def load_profile(provider, profile, refresh=False):
+            loaded.append((provider, profile.username))
+            profile.total_repo_count = 1
+
+        pairs = [
+            {'github': 'user1', 'bitbucket': 'user2'},
+            {'github': 'user1', 'bitbucket': 'user3'},
+            {'github': 'user1'},
+            'user4',
+        ]
+        with mock.patch.object(handlers, 'load_profile', side_effect=load_profile):
+            items = handlers.handle_get_profiles(pairs)
+
+        self.assertCountEqual(loaded, [('github', 'user1'), ('bitbucket', 'user2'), ('bitbucket', 'user3')])
+        self.assertEqual(items[0]['github'], 'user1')
+        self.assertEqual(items[0]['bitbucket'], 'user2')
+        self.assertEqual(items[0]['profile']['total_repo_count'], 2)
+        self.assertEqual(items[1]['profile']['bitbucket_username'], 'user3')
+        self.assertEqual(items[2], {'error': 'No bitbucket in item'})
+        self.assertEqual(items[3], {'error': 'No github in item'})
+
+    def test_handle_get_profiles_invalid_usernames(self):
+        pairs = [
+            {'github': ['user1'], 'bitbucket': 'user2'},
+            {'github': 'user1', 'bitbucket': None},
+            {'github': '', 'bitbucket': 'user2'},
+            {'github': 'user1', 'bitbucket': {'name': 'user2'}},
+        ]
+        with mock.patch.object(handlers, 'load_profile') as mock_load_profile:
+            items = handlers.handle_get_profiles(pairs)
+
+        mock_load_profile.assert_not_called()
+        self.assertEqual(items, [
+            {'error': 'Invalid github username in item'},
+            {'error': 'Invalid bitbucket username in item'},
+            {'error': 'Invalid github username in item'},
+            {'error': 'Invalid bitbucket username in item'},
+        ])
+
+    def test_handle_get_profiles_item_error(self):
+        def load_profile(provider, profile, refresh=False):
+            if profile.username == 'bad':
+                raise ValueError('bad')
+
+        pairs = [{'github': 'user1', 'bitbucket': 'bad'}, {'github': 'user1', 'bitbucket': 'user2'}]
+        with mock.patch.object(handlers, 'load_profile', side_effect=load_profile):
+            items = handlers.handle_get_profiles(pairs)
+
+        self.assertEqual(items[0]['error'], 'Failed to fetch bitbucket profile for bad')
+        self.assertIn('profile', items[1])
+
+    def test_handle_get_profiles_cached(self):
+        handlers.consolidated_cache.set(('user1', 'user2'), {'profile': 'data'})
+
+        with mock.patch.object(handlers, 'load_profile') as mock_load_profile:
+            items = handlers.handle_get_profiles([{'github': 'user1', 'bitbucket': 'user2'}])
+
+        mock_load_profile.assert_not_called()
+        self.assertEqual(items, [{'github': 'user1', 'bitbucket': 'user2', 'profile': {'profile': 'data'}}])
+
+    def test_iter_profiles_timeout(self):
+        event = threading.Event()
+        try:
+            with mock.patch.object(handlers, 'load_profile', side_effect=lambda *args, **kwargs: event.wait(5)):
+                items = list(handlers.iter_profiles([{'github': 'user1', 'bitbucket': 'user2'}], timeout=0.01))
+        finally:
+            event.set()
+
+        self.assertEqual(
+            items, [(0, {'github': 'user1', 'bitbucket': 'user2', 'error': 'Timed out fetching profiles'})],
+        )
+
+    def test_iter_profiles_yields_as_completed(self):
+        release = threading.Event()
+
+        def load_profile(provider, profile, refresh=False):
+            if profile.username == 'slow':
+                release.wait(5)
+
+        pairs = [{'github': 'user1', 'bitbucket': 'slow'}, {'github': 'user1', 'bitbucket': 'user2'}]
+        with mock.patch.object(handlers, 'load_profile', side_effect=load_profile):
+            items = handlers.iter_profiles(pairs)
+            first_index, _ = next(items)
+            release.set()
+            second_index, _ = next(items)
+
+        self.assertEqual((first_index, second_index), (1, 0))
@@ -0,0 +1,75 @@
+import threading
+from unittest import TestCase
+
+from service import metrics
+
+
+class MetricsTestCase(TestCase):
+    def test_counter(self):
+        counter = metrics.Counter('calls_total', 'Calls', ('provider', 'kind'))
+        counter.inc('github', 'list')
+        counter.inc('github', 'list', amount=2)
+        counter.inc('bitbucket', 'count')
+
+        self.assertEqual(counter.render(), [
+            '# HELP calls_total Calls',
+            '# TYPE calls_total counter',
+            'calls_total{provider="bitbucket",kind="count"} 1',
+            'calls_total{provider="github",kind="list"} 3',
+        ])
+
+    def test_gauge(self):
+        gauge = metrics.Gauge('in_flight', 'In flight')
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+
+        self.assertEqual(gauge.samples(), ['in_flight 1'])
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('latency_seconds', 'Latency', ('route',), buckets=(0.1, 1))
+        histogram.observe(0.05, '/a')
+        histogram.observe(0.5, '/a')
+        histogram.observe(5, '/a')
+
+        self.assertEqual(histogram.samples(), [
+            'latency_seconds_bucket{route="/a",le="0.1"} 1',
+            'latency_seconds_bucket{route="/a",le="1"} 2',
+            'latency_seconds_bucket{route="/a",le="+Inf"} 3',
+            'latency_seconds_sum{route="/a"} 5.55',
+            'latency_seconds_count{route="/a"} 3',
+        ])
+
+    def test_label_escaping(self):
+        counter = metrics.Counter('calls_total', 'Calls', ('user',))
+        counter.inc('a"b\\c')
+
+        self.assertEqual(counter.samples(), ['calls_total{user="a\\"b\\\\c"} 1'])
+
+    def test_thread_safe(self):
+        counter = metrics.Counter('calls_total', 'Calls')
+
+        def work():
+            for _ in range(1000):
+                counter.inc()
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(counter.samples(), ['calls_total 8000'])
+
+    def test_registry(self):
+        registry = metrics.Registry()
+        registry.counter('calls_total', 'Calls').inc()
+        registry.add_collector(lambda: [metrics.Gauge('collected', 'Collected')])
+
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP calls_total Calls',
+            '# TYPE calls_total counter',
+            'calls_total 1',
+            '# HELP collected Collected',
+            '# TYPE collected gauge',
+        ]) + '\n')
@@ -1,8 +1,12 @@
-from unittest import TestCase
+import json
+import threading
+import time
+from concurrent.futures import Future
+from unittest import mock, TestCase
 
 import responses
 
-from service import constants, models
+from service import constants, credentials, models, ratelimit
 
 
 class ProfileTestCase(TestCase):
@@ -11,6 +15,7 @@ class ProfileTestCase(TestCase):
 
         self.assertEqual(profile.username, 'user1')
         self.assertEqual(profile.page_len, 25)
+        self.assertFalse(profile.keep_repos)
         self.assertEqual(profile.user_profile, {})
         self.assertEqual(profile.repos, [])
 
@@ -24,6 +29,133 @@ class ProfileTestCase(TestCase):
         self.assertEqual(profile.languages_used, set())
         self.assertEqual(profile.repo_topics, set())
 
+    def test_iter_pages(self):
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def get_page(url):
+            with lock:
+                running.append(url)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(url)
+            return [url]
+
+        profile = models.GithubProfile('user1')
+        profile.max_page_requests = 2
+        pages = list(profile.iter_pages(['url{}'.format(i) for i in range(6)], get_page))
+
+        self.assertEqual(pages, [['url{}'.format(i)] for i in range(6)])
+        self.assertLessEqual(max(peak), 2)
+
+    def test_add_repos(self):
+        repo = {
+            'watchers_count': 1, 'stargazers_count': 2, 'open_issues_count': 3, 'size': 4,
+            'language': None, 'topics': [],
+        }
+        profile = models.GithubProfile('user1')
+        profile.add_repos([repo, repo])
+        kept_profile = models.GithubProfile('user1', keep_repos=True)
+        kept_profile.add_repos([repo, repo])
+
+        self.assertEqual(profile.repos, [])
+        self.assertEqual(profile.total_repo_count, 2)
+        self.assertEqual(kept_profile.repos, [repo, repo])
+        self.assertEqual(kept_profile.total_size, 8)
+
+    def test_decode_listed_repo_fields(self):
+        response = mock.Mock(content=b'[{"full_name": "user1/repo1", "size": 4, "owner": {"login": "user1"}}]')
+        profile = models.GithubProfile('user1')
+        kept_profile = models.GithubProfile('user1', keep_repos=True)
+
+        repos = profile.decode(response, profile.listed_repo_fields)
+        kept_repos = kept_profile.decode(response, kept_profile.listed_repo_fields)
+
+        self.assertEqual(repos, [{'full_name': 'user1/repo1', 'size': 4}])
+        self.assertIn('owner', kept_repos[0])
+
+    def test_page_numbers(self):
+        url = 'https://api.github.com/users/user1/repos?per_page=2&page=3'
+
+        self.assertEqual(models.get_page_number(url), 3)
+        self.assertIsNone(models.get_page_number('https://api.github.com/users/user1/repos?per_page=2'))
+        self.assertEqual(
+            models.set_page_number(url, 5),
+            'https://api.github.com/users/user1/repos?per_page=2&page=5'
+        )
+
+    def test_aggregates(self):
+        profile = models.GithubProfile('user1')
+        profile.total_repo_count = 2
+        profile.total_size = 1000
+        profile.languages_used = {'Python', 'C++'}
+        profile.repo_topics = {'flask'}
+
+        aggregates = profile.aggregates
+        self.assertEqual(aggregates, [2, 0, 0, 0, 0, 0, 1000, ['C++', 'Python'], ['flask']])
+
+        restored = models.GithubProfile('user1')
+        restored.load_aggregates(aggregates)
+
+        self.assertEqual(restored.aggregates, aggregates)
+        self.assertEqual(restored.total_size, 1000)
+        self.assertEqual(restored.languages_used, {'Python', 'C++'})
+        self.assertEqual(restored.repo_topics, {'flask'})
+
+
+class ProfileAggregateTestCase(TestCase):
+    def test_slots(self):
+        aggregate = models.ProfileAggregate()
+
+        self.assertFalse(hasattr(aggregate, '__dict__'))
+        with self.assertRaises(AttributeError):
+            aggregate.repos = []
+
+    def test_interned_strings(self):
+        first = models.ProfileAggregate()
+        first.add_languages([''.join(['Pyth', 'on'])])
+        second = models.ProfileAggregate.load([0] * 7 + [[''.join(['Py', 'thon'])], []])
+
+        self.assertIs(next(iter(first.languages_used)), next(iter(second.languages_used)))
+
+    def test_merge(self):
+        first = models.ProfileAggregate()
+        first.total_repo_count = 2
+        first.total_size = 10
+        first.add_languages(['Python'])
+        first.add_topics(['flask'])
+        second = models.ProfileAggregate()
+        second.total_repo_count = 3
+        second.total_size = 5
+        second.add_languages(['Python', 'Java'])
+
+        merged = first.merge(second)
+
+        self.assertEqual(merged.total_repo_count, 5)
+        self.assertEqual(merged.total_size, 15)
+        self.assertEqual(merged.languages_used, {'Python', 'Java'})
+        self.assertEqual(merged.repo_topics, {'flask'})
+        self.assertEqual(first.languages_used, {'Python'})
+
+    def test_add_page(self):
+        aggregate = models.ProfileAggregate()
+        aggregate.add_topics(['flask'])
+        repos = [
+            {'size': 3, 'stars': 1, 'language': 'Python', 'topics': ['flask', 'api']},
+            {'size': 4, 'stars': 0, 'language': None, 'topics': []},
+        ]
+
+        aggregate.add_page(repos, {'total_size': 'size', 'total_watcher_count': 'stars'}, 'language', 'topics')
+        aggregate.add_page(repos[:1], {'total_size': 'size'}, 'language')
+
+        self.assertEqual(aggregate.total_repo_count, 3)
+        self.assertEqual(aggregate.total_size, 10)
+        self.assertEqual(aggregate.total_watcher_count, 1)
+        self.assertEqual(aggregate.languages_used, {'Python'})
+        self.assertEqual(aggregate.repo_topics, {'flask', 'api'})
+
 
 class GithubProfileTestCase(TestCase):
     def test_properties(self):
@@ -91,6 +223,33 @@ class GithubProfileTestCase(TestCase):
 
         self.assertEqual(repos, ['repo1', 'repo2', 'repo3', 'repo4'])
 
+    @responses.activate
+    def test_get_paginated_list_parallel(self):
+        responses.add(
+            responses.GET,
+            'https://api.github.com/users/user1/repos?per_page=2',
+            status=200,
+            json=['repo1', 'repo2'],
+            headers={'link': (
+                '<https://api.github.com/users/user1/repos?per_page=2&page=2>; rel="next", '
+                '<https://api.github.com/users/user1/repos?per_page=2&page=4>; rel="last"'
+            )}
+        )
+        for page in (2, 3, 4):
+            responses.add(
+                responses.GET,
+                'https://api.github.com/users/user1/repos?per_page=2&page={}'.format(page),
+                status=200,
+                json=['repo{}'.format(page * 2 - 1), 'repo{}'.format(page * 2)],
+            )
+
+        profile = models.GithubProfile('user1', page_len=2)
+        profile.max_page_requests = 2
+        repos = profile.get_paginated_list('https://api.github.com/users/user1/repos')
+
+        self.assertEqual(repos, ['repo{}'.format(i) for i in range(1, 9)])
+        self.assertEqual(len(responses.calls), 4)
+
     @responses.activate
     def test_get_all_data(self):
         user_profile = {
@@ -139,7 +298,7 @@ class GithubProfileTestCase(TestCase):
             headers={'link': '<api.github.com/users/user1/repos?page=92>; rel="last"'}
         )
 
-        profile = models.GithubProfile('user1', page_len=2)
+        profile = models.GithubProfile('user1', page_len=2, keep_repos=True)
         profile.get_all_data()
 
         self.assertCountEqual(profile.repos, [repo1, repo2, repo3])
@@ -153,6 +312,170 @@ class GithubProfileTestCase(TestCase):
         self.assertCountEqual(profile.languages_used, ['Python', 'Java'])
         self.assertCountEqual(profile.repo_topics, ['flask', 'api', 'testing', 'bugs'])
 
+    @responses.activate
+    def test_get_incremental_data(self):
+        def repo(name, updated_at, count, size, language, topics):
+            return {
+                'full_name': name, 'updated_at': updated_at, 'watchers_count': count, 'stargazers_count': count,
+                'open_issues_count': count, 'size': size, 'language': language, 'topics': topics,
+            }
+
+        old_profile = models.GithubProfile('user1', keep_records=True)
+        old_profile.total_follower_count = 1
+        old_profile.add_repos([
+            repo('user1/a', 't1', 1, 10, 'Python', ['x']),
+            repo('user1/b', 't1', 2, 20, 'Java', ['y']),
+        ])
+        snapshot = old_profile.snapshot
+
+        responses.add(responses.GET, 'https://api.github.com/users/user1', json={
+            'repos_url': 'https://api.github.com/users/user1/repos',
+            'starred_url': 'https://api.github.com/users/user1/starred{/owner}{/repo}',
+            'followers': 5,
+            'public_repos': 3,
+        })
+        responses.add(
+            responses.GET,
+            'https://api.github.com/users/user1/repos?per_page=2&sort=updated&direction=desc',
+            json=[repo('user1/c', 't3', 4, 40, 'Go', ['z']), repo('user1/b', 't2', 5, 50, 'Java', [])],
+            headers={'link': (
+                '<https://api.github.com/users/user1/repos?per_page=2&sort=updated&direction=desc&page=2>; rel="next", '
+                '<https://api.github.com/users/user1/repos?per_page=2&sort=updated&direction=desc&page=9>; rel="last"'
+            )}
+        )
+        responses.add(
+            responses.GET,
+            'https://api.github.com/users/user1/repos?per_page=2&sort=updated&direction=desc&page=2',
+            json=[repo('user1/a', 't1', 1, 10, 'Python', ['x'])],
+        )
+        responses.add(
+            responses.HEAD,
+            'https://api.github.com/users/user1/starred?per_page=1',
+            headers={'link': '<https://api.github.com/users/user1/starred?per_page=1&page=7>; rel="last"'}
+        )
+
+        profile = models.GithubProfile('user1', page_len=2)
+        self.assertTrue(profile.get_incremental_data(snapshot))
+
+        self.assertEqual(len(responses.calls), 4)
+        self.assertEqual(profile.total_repo_count, 3)
+        self.assertEqual(profile.total_watcher_count, 10)
+        self.assertEqual(profile.total_stars_given_count, 10)
+        self.assertEqual(profile.total_open_issues_count, 10)
+        self.assertEqual(profile.total_size, 100)
+        self.assertEqual(profile.total_follower_count, 5)
+        self.assertEqual(profile.total_stars_received_count, 7)
+        self.assertEqual(profile.languages_used, {'Python', 'Java', 'Go'})
+        self.assertEqual(profile.repo_topics, {'x', 'z'})
+        self.assertEqual(profile.repo_records['user1/b'][0], 't2')
+
+    @responses.activate
+    def test_get_incremental_data_deleted_repo(self):
+        snapshot = {
+            'aggregate': [2, 0, 0, 0, 0, 0, 30, [], []],
+            'repos': {'user1/a': ['t1', 0, 0, 0, 10, None, []], 'user1/b': ['t1', 0, 0, 0, 20, None, []]},
+        }
+        responses.add(responses.GET, 'https://api.github.com/users/user1', json={
+            'repos_url': 'https://api.github.com/users/user1/repos',
+            'public_repos': 1,
+        })
+        responses.add(
+            responses.GET,
+            'https://api.github.com/users/user1/repos?per_page=50&sort=updated&direction=desc',
+            json=[{'full_name': 'user1/a', 'updated_at': 't1'}],
+        )
+
+        profile = models.GithubProfile('user1')
+
+        self.assertFalse(profile.get_incremental_data(snapshot))
+        self.assertEqual(profile.total_repo_count, 0)
+
+
+class GithubGraphQLTestCase(TestCase):
+    def setUp(self):
+        pool = credentials.TokenPool('github', ['token abc'], scheduler=ratelimit.UpstreamScheduler(rates={}))
+        patches = [
+            mock.patch.object(models.GithubProfile, 'token_pool', pool),
+            mock.patch.object(models.GithubProfile, 'fetch_strategy', 'graphql'),
+            mock.patch.object(constants, 'GITHUB_GRAPHQL_PAGE_LEN', 2),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    @staticmethod
+    def node(name, stars, issues, pulls, size, language, topics):
+        return {
+            'nameWithOwner': name, 'updatedAt': 't1', 'stargazerCount': stars, 'diskUsage': size,
+            'primaryLanguage': {'name': language} if language else None,
+            'issues': {'totalCount': issues}, 'pullRequests': {'totalCount': pulls},
+            'repositoryTopics': {'nodes': [{'topic': {'name': topic}} for topic in topics]},
+        }
+
+    @staticmethod
+    def rest_repo(name, stars, open_issues, size, language, topics):
+        return {
+            'full_name': name, 'updated_at': 't1', 'watchers_count': stars, 'stargazers_count': stars,
+            'open_issues_count': open_issues, 'size': size, 'language': language, 'topics': topics,
+        }
+
+    def user_page(self, nodes, end_cursor=None):
+        return {'data': {'user': {
+            'followers': {'totalCount': 1234},
+            'starredRepositories': {'totalCount': 92},
+            'repositories': {'pageInfo': {'hasNextPage': bool(end_cursor), 'endCursor': end_cursor}, 'nodes': nodes},
+        }}}
+
+    @responses.activate
+    def test_get_all_data(self):
+        responses.add(responses.POST, constants.GITHUB_GRAPHQL_URL, json=self.user_page([
+            self.node('user1/a', 20, 1, 2, 1234, 'Python', ['flask', 'api']),
+            self.node('user1/b', 20, 3, 0, 1234, 'Python', ['flask', 'testing']),
+        ], end_cursor='c2'))
+        responses.add(responses.POST, constants.GITHUB_GRAPHQL_URL, json=self.user_page([
+            self.node('user1/c', 2, 300, 0, None, None, ['bugs']),
+        ]))
+
+        profile = models.GithubProfile('user1', keep_records=True)
+        profile.get_all_data()
+
+        rest_profile = models.GithubProfile('user1', keep_records=True)
+        rest_profile.total_follower_count = 1234
+        rest_profile.total_stars_received_count = 92
+        rest_profile.add_repos([
+            self.rest_repo('user1/a', 20, 3, 1234, 'Python', ['flask', 'api']),
+            self.rest_repo('user1/b', 20, 3, 1234, 'Python', ['flask', 'testing']),
+            self.rest_repo('user1/c', 2, 300, 0, None, ['bugs']),
+        ])
+
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(responses.calls[0].request.headers['authorization'], 'token abc')
+        second_query = json.loads(responses.calls[1].request.body)
+        self.assertEqual(second_query['variables'], {'login': 'user1', 'first': 2, 'after': 'c2'})
+        self.assertEqual(profile.aggregates, rest_profile.aggregates)
+        self.assertEqual(profile.repo_records, rest_profile.repo_records)
+
+    @responses.activate
+    def test_falls_back_to_rest(self):
+        responses.add(responses.POST, constants.GITHUB_GRAPHQL_URL, json={'errors': [{'message': 'bad'}]})
+
+        profile = models.GithubProfile('user1')
+        with mock.patch.object(profile, 'get_rest_data') as get_rest_data:
+            profile.get_all_data()
+
+        get_rest_data.assert_called_once_with()
+
+    def test_rest_without_credentials(self):
+        profile = models.GithubProfile('user1')
+        empty_pool = credentials.TokenPool('github', [])
+        with mock.patch.object(profile, 'token_pool', empty_pool), \
+                mock.patch.object(profile, 'get_graphql_data') as get_graphql_data, \
+                mock.patch.object(profile, 'get_rest_data') as get_rest_data:
+            profile.get_all_data()
+
+        get_graphql_data.assert_not_called()
+        get_rest_data.assert_called_once_with()
+
 
 class BitbucketProfileTestCase(TestCase):
     def test_properties(self):
@@ -253,6 +576,38 @@ class BitbucketProfileTestCase(TestCase):
 
         self.assertEqual(repos, ['repo1', 'repo2', 'repo3', 'repo4'])
 
+    @responses.activate
+    def test_get_paginated_list_parallel(self):
+        responses.add(
+            responses.GET,
+            'https://api.bitbucket.org/2.0/repositories/user1?pagelen=2',
+            status=200,
+            json={
+                'pagelen': 2,
+                'size': 5,
+                'values': ['repo1', 'repo2'],
+                'page': 1,
+                'next': 'https://api.bitbucket.org/2.0/repositories/user1?pagelen=2&page=2'
+            },
+        )
+        responses.add(
+            responses.GET,
+            'https://api.bitbucket.org/2.0/repositories/user1?pagelen=2&page=2',
+            status=200,
+            json={'pagelen': 2, 'size': 5, 'values': ['repo3', 'repo4'], 'page': 2},
+        )
+        responses.add(
+            responses.GET,
+            'https://api.bitbucket.org/2.0/repositories/user1?pagelen=2&page=3',
+            status=200,
+            json={'pagelen': 2, 'size': 5, 'values': ['repo5'], 'page': 3},
+        )
+
+        profile = models.BitbucketProfile('user1', page_len=2)
+        repos = profile.get_paginated_list('https://api.bitbucket.org/2.0/repositories/user1')
+
+        self.assertEqual(repos, ['repo1', 'repo2', 'repo3', 'repo4', 'repo5'])
+
     @responses.activate
     def test_get_all_data(self):
         user_profile = {
@@ -335,7 +690,7 @@ class BitbucketProfileTestCase(TestCase):
             json={'pagelen': 0, 'size': 300, 'values': [], 'page': 1},
         )
 
-        profile = models.BitbucketProfile('user1', page_len=25)
+        profile = models.BitbucketProfile('user1', page_len=25, keep_repos=True)
         profile.get_all_data()
 
         self.assertCountEqual(profile.repos, [repo1, repo2, repo3])
@@ -349,6 +704,170 @@ class BitbucketProfileTestCase(TestCase):
         self.assertCountEqual(profile.languages_used, ['Python', 'Java'])
         self.assertCountEqual(profile.repo_topics, [])
 
+    def test_iter_repo_counts_in_flight_budget(self):
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def get_repo_counts(repo):
+            with lock:
+                running.append(repo)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(repo)
+            return repo, 1
+
+        profile = models.BitbucketProfile('user1', max_in_flight=2)
+        with mock.patch.object(profile, 'get_repo_counts', side_effect=get_repo_counts):
+            counts = list(profile.iter_repo_counts(iter(range(10))))
+
+        self.assertEqual(counts, [(repo, (repo, 1)) for repo in range(10)])
+        self.assertLessEqual(max(peak), 2)
+
+    def test_iter_repo_counts_already_done(self):
+        profile = models.BitbucketProfile('user1')
+        done = []
+
+        def submit(function, repo):
+            future = Future()
+            future.set_result(function(repo))
+            done.append(future)
+            return future
+
+        with mock.patch.object(profile, 'get_repo_counts', side_effect=lambda repo: (repo, 1)), \
+                mock.patch.object(models.count_executor, 'submit', side_effect=submit):
+            counts = list(profile.iter_repo_counts(iter(range(3))))
+
+        self.assertEqual(counts, [(repo, (repo, 1)) for repo in range(3)])
+        self.assertEqual(len(done), 3)
+
+    @responses.activate
+    def test_get_incremental_data(self):
+        base = 'https://api.bitbucket.org/2.0/repositories/user1'
+
+        def repo(name, updated_on, size, language):
+            return {
+                'full_name': 'user1/' + name, 'updated_on': updated_on, 'size': size, 'language': language,
+                'links': {'watchers': {'href': base + '/' + name + '/watchers'}},
+            }
+
+        old_profile = models.BitbucketProfile('user1', keep_records=True)
+        old_profile.add_repos([repo('a', 't1', 10, 'python'), repo('b', 't1', 20, 'java')])
+        old_profile.add_repo_counts([(repo('a', 't1', 10, 'python'), (1, 1)), (repo('b', 't1', 20, 'java'), (2, 2))])
+        snapshot = old_profile.snapshot
+
+        responses.add(responses.GET, 'https://api.bitbucket.org/2.0/users/user1', json={
+            'links': {
+                'repositories': {'href': base},
+                'followers': {'href': 'https://api.bitbucket.org/2.0/users/user1/followers'},
+            }
+        })
+        responses.add(
+            responses.GET,
+            base + '?pagelen=25&sort=-updated_on',
+            json={'pagelen': 25, 'size': 2, 'values': [repo('b', 't2', 30, 'java'), repo('a', 't1', 10, 'python')]}
+        )
+        responses.add(responses.GET, base + '?pagelen=0', json={'size': 2})
+        responses.add(responses.GET, base + '/b/watchers?pagelen=0', json={'size': 7})
+        responses.add(
+            responses.GET, 'https://api.bitbucket.org/2.0/users/user1/followers?pagelen=0', json={'size': 4}
+        )
+
+        profile = models.BitbucketProfile('user1', page_len=25)
+        self.assertTrue(profile.get_incremental_data(snapshot))
+
+        self.assertEqual(len(responses.calls), 5)
+        self.assertEqual(profile.total_repo_count, 2)
+        self.assertEqual(profile.total_watcher_count, 8)
+        self.assertEqual(profile.total_open_issues_count, 1)
+        self.assertEqual(profile.total_size, 40)
+        self.assertEqual(profile.total_follower_count, 4)
+        self.assertEqual(profile.languages_used, {'python', 'java'})
+
+
+class CrawlBudgetTestCase(TestCase):
+    def test_max_pages(self):
+        budget = models.CrawlBudget(max_pages=2, max_calls=0, deadline=0)
+        for kind in ('profile', 'list', 'count', 'list'):
+            budget.spend(kind)
+
+        with self.assertRaises(models.CrawlBudgetExhausted) as context:
+            budget.spend('list')
+        budget.spend('count')
+
+        self.assertEqual(context.exception.reason, 'pages')
+
+    def test_max_calls(self):
+        budget = models.CrawlBudget(max_pages=0, max_calls=1, deadline=0)
+        budget.spend('profile')
+
+        with self.assertRaises(models.CrawlBudgetExhausted) as context:
+            budget.spend('count')
+
+        self.assertEqual(context.exception.reason, 'calls')
+
+    def test_deadline(self):
+        budget = models.CrawlBudget(max_pages=0, max_calls=0, deadline=0.01)
+        budget.spend('list')
+        time.sleep(0.02)
+
+        with self.assertRaises(models.CrawlBudgetExhausted) as context:
+            budget.spend('list')
+
+        self.assertEqual(context.exception.reason, 'deadline')
+
+    def test_request_not_sent_over_budget(self):
+        profile = models.GithubProfile('user1')
+        profile.budget = models.CrawlBudget(max_pages=0, max_calls=1, deadline=0)
+        profile.budget.spend('profile')
+        with mock.patch.object(profile, 'transport') as mock_transport:
+            with self.assertRaises(models.CrawlBudgetExhausted):
+                profile.request('GET', 'https://api.github.com/users/user1/repos')
+
+        mock_transport.request.assert_not_called()
+
+    def test_extrapolate_github(self):
+        profile = models.GithubProfile('user1')
+        profile.user_profile = {'public_repos': 10}
+        profile.add_repos([{
+            'watchers_count': 1, 'stargazers_count': 2, 'open_issues_count': 0, 'size': 5,
+            'language': 'Python', 'topics': [],
+        }] * 4)
+        profile.total_follower_count = 7
+
+        profile.extrapolate()
+
+        self.assertEqual(profile.total_repo_count, 10)
+        self.assertEqual(profile.total_watcher_count, 10)
+        self.assertEqual(profile.total_stars_given_count, 20)
+        self.assertEqual(profile.total_size, 50)
+        self.assertEqual(profile.total_follower_count, 7)
+
+    def test_extrapolate_bitbucket(self):
+        profile = models.BitbucketProfile('user1')
+        profile.user_profile = {'links': {'repositories': {'href': 'https://api.bitbucket.org/2.0/repositories/user1'}}}
+        profile.list_sizes[profile.repos_url] = 8
+        repos = [{'size': 3, 'language': 'python'}] * 4
+        profile.add_repos(repos)
+        profile.add_repo_counts([({'full_name': 'user1/repo'}, (2, 1))] * 2)
+
+        profile.extrapolate()
+
+        self.assertEqual(profile.total_repo_count, 8)
+        self.assertEqual(profile.total_size, 24)
+        self.assertEqual(profile.total_watcher_count, 16)
+        self.assertEqual(profile.total_open_issues_count, 8)
+
+    def test_extrapolate_unknown_total(self):
+        profile = models.BitbucketProfile('user1')
+        profile.add_repos([{'size': 3, 'language': None}])
+
+        profile.extrapolate()
+
+        self.assertEqual(profile.total_repo_count, 1)
+        self.assertEqual(profile.total_size, 3)
+
 
 class ConsolidatedProfileTestCase(TestCase):
     def test_dict(self):
@@ -392,3 +911,8 @@ class ConsolidatedProfileTestCase(TestCase):
         self.assertEqual(profile_dict['languages_used_count'], 3)
         self.assertCountEqual(profile_dict['repo_topics'], ['python', 'flask'])
         self.assertEqual(profile_dict['repo_topics_count'], 2)
+        self.assertFalse(profile_dict['partial'])
+
+        bitbucket_profile.partial = True
+
+        self.assertTrue(profile.dict['partial'])
@@ -0,0 +1,208 @@
+import time
+from unittest import mock, TestCase
+
+from service import models, ratelimit, transport
+from tests import FakeUpstream
+
+
+def make_scheduler(rate=1000, burst=10, reserve=0.2, max_wait=(0.5, 0.5)):
+    return ratelimit.UpstreamScheduler(rates={'github': (rate, burst)}, reserve=reserve, max_wait=max_wait)
+
+
+def rate_limit_headers(remaining, limit=100, reset=None):
+    return {
+        'x-ratelimit-limit': str(limit),
+        'x-ratelimit-remaining': str(remaining),
+        'x-ratelimit-reset': str(int(reset if reset is not None else time.time() + 3600)),
+    }
+
+
+class TokenBucketTestCase(TestCase):
+    def test_take(self):
+        bucket = ratelimit.TokenBucket(rate=1, capacity=2)
+
+        self.assertEqual(bucket.take(), 0)
+        self.assertEqual(bucket.take(), 0)
+        self.assertGreater(bucket.take(), 0)
+
+    def test_take_reserve(self):
+        bucket = ratelimit.TokenBucket(rate=1, capacity=2)
+
+        self.assertGreater(bucket.take(reserve=1.5), 0)
+        self.assertEqual(bucket.take(), 0)
+
+
+class RateLimitBudgetTestCase(TestCase):
+    def test_update(self):
+        budget = ratelimit.RateLimitBudget()
+        budget.update(rate_limit_headers(0, reset=1010), 200, now=1000)
+
+        self.assertEqual(budget.limit, 100)
+        self.assertEqual(budget.remaining, 0)
+        self.assertEqual(budget.wait_time(1000), 10)
+        self.assertEqual(budget.wait_time(1020), 0)
+
+    def test_update_retry_after(self):
+        budget = ratelimit.RateLimitBudget()
+        budget.update({'Retry-After': '30'}, 429, now=1000)
+
+        self.assertEqual(budget.wait_time(1000), 30)
+
+    def test_below(self):
+        budget = ratelimit.RateLimitBudget()
+        self.assertFalse(budget.below(0.2))
+
+        budget.update(rate_limit_headers(10), 200, now=time.time())
+        self.assertTrue(budget.below(0.2))
+        self.assertFalse(budget.below(0.1))
+
+
+class UpstreamSchedulerTestCase(TestCase):
+    def test_credential_id(self):
+        self.assertEqual(ratelimit.credential_id({}), 'anonymous')
+        credential = ratelimit.credential_id({'Authorization': 'token secret'})
+        self.assertTrue(credential.startswith('token:'))
+        self.assertNotIn('secret', credential)
+
+    def test_background_shed_below_reserve(self):
+        scheduler = make_scheduler()
+        scheduler.update('github', 'anonymous', rate_limit_headers(10), 200)
+
+        with self.assertRaises(ratelimit.RateLimitExceeded):
+            scheduler.acquire('github', 'anonymous', ratelimit.BACKGROUND)
+        scheduler.acquire('github', 'anonymous', ratelimit.INTERACTIVE)
+        scheduler.acquire('github', 'other', ratelimit.BACKGROUND)
+
+        self.assertEqual(scheduler.stats['admitted'], 2)
+        self.assertEqual(scheduler.stats['shed'], 1)
+
+    def test_exhausted(self):
+        scheduler = make_scheduler()
+        scheduler.update('github', 'anonymous', rate_limit_headers(0), 200)
+
+        with self.assertRaises(ratelimit.RateLimitExceeded) as context:
+            scheduler.acquire('github', 'anonymous')
+        self.assertGreater(context.exception.retry_after, 3000)
+
+    def test_bucket_keeps_reserve_for_interactive(self):
+        scheduler = make_scheduler(rate=0.01, burst=5, max_wait=(0.1, 0.1))
+        for _ in range(4):
+            scheduler.acquire('github', 'anonymous', ratelimit.BACKGROUND)
+
+        with self.assertRaises(ratelimit.RateLimitExceeded):
+            scheduler.acquire('github', 'anonymous', ratelimit.BACKGROUND)
+        scheduler.acquire('github', 'anonymous', ratelimit.INTERACTIVE)
+
+    def test_queues_until_admitted(self):
+        scheduler = make_scheduler(rate=20, burst=1)
+        scheduler.acquire('github', 'anonymous')
+
+        started = time.monotonic()
+        scheduler.acquire('github', 'anonymous')
+
+        self.assertGreater(time.monotonic() - started, 0.02)
+
+    def test_stats(self):
+        scheduler = make_scheduler()
+        scheduler.update('github', 'anonymous', rate_limit_headers(42, reset=2000), 200)
+
+        self.assertEqual(scheduler.stats['budgets'], {
+            'github:anonymous': {'limit': 100, 'remaining': 42, 'reset_at': 2000, 'blocked_until': None},
+        })
+
+
+    def test_share(self):
+        scheduler = ratelimit.UpstreamScheduler(rates={'github': (20, 40), 'bitbucket': (4, 2)})
+        scheduler.share(4)
+
+        self.assertEqual((scheduler.buckets['github'].rate, scheduler.buckets['github'].capacity), (5, 10))
+        self.assertEqual((scheduler.buckets['bitbucket'].rate, scheduler.buckets['bitbucket'].capacity), (1, 1))
+        self.assertEqual(scheduler.buckets['github'].tokens, 10)
+
+    def test_budget_per_resource(self):
+        scheduler = make_scheduler()
+        scheduler.update('github', 'anonymous', rate_limit_headers(0), 200, resource='graphql')
+        scheduler.update('github', 'anonymous', dict(rate_limit_headers(42), **{'X-RateLimit-Resource': 'search'}), 200)
+
+        scheduler.acquire('github', 'anonymous')
+        with self.assertRaises(ratelimit.RateLimitExceeded):
+            scheduler.acquire('github', 'anonymous', resource='graphql')
+        self.assertIsNone(scheduler.budget('github', 'anonymous').remaining)
+        self.assertEqual(scheduler.budget('github', 'anonymous', 'search').remaining, 42)
+        self.assertCountEqual(
+            scheduler.stats['budgets'], ['github:anonymous', 'github/graphql:anonymous', 'github/search:anonymous'],
+        )
+
+
+class ScheduledTransportTestCase(TestCase):
+    def test_tracks_budget(self):
+        scheduler = make_scheduler()
+        inst = transport.Transport(hosts=(), scheduler=scheduler)
+        with FakeUpstream([(200, rate_limit_headers(57), {'profile': 'data'})]) as upstream:
+            response = inst.get(upstream.url + '/users/user1', provider='github')
+
+        self.assertEqual(response.json(), {'profile': 'data'})
+        self.assertEqual(scheduler.budget('github', 'anonymous').remaining, 57)
+
+    def test_stops_sending_when_exhausted(self):
+        scheduler = make_scheduler()
+        inst = transport.Transport(hosts=(), scheduler=scheduler)
+        with FakeUpstream([(403, rate_limit_headers(0), {'message': 'API rate limit exceeded'})]) as upstream:
+            inst.get(upstream.url + '/users/user1', provider='github')
+            with self.assertRaises(ratelimit.RateLimitExceeded):
+                inst.get(upstream.url + '/users/user1', provider='github')
+
+        self.assertEqual(len(upstream.requests), 1)
+
+    def test_429_left_to_scheduler(self):
+        scheduler = make_scheduler()
+        with FakeUpstream([(429, {'Retry-After': '60'}, {'message': 'Too many requests'})]) as upstream:
+            inst = transport.Transport(hosts=(upstream.url,), retries=3, scheduler=scheduler)
+            started = time.monotonic()
+            response = inst.get(upstream.url + '/users/user1', provider='github')
+            elapsed = time.monotonic() - started
+            with self.assertRaises(ratelimit.RateLimitExceeded):
+                inst.get(upstream.url + '/users/user1', provider='github')
+
+        self.assertEqual(response.status_code, 429)
+        self.assertLess(elapsed, 5)
+        self.assertEqual(len(upstream.requests), 1)
+
+    def test_graphql_budget_kept_apart(self):
+        scheduler = make_scheduler()
+        inst = transport.Transport(hosts=(), scheduler=scheduler)
+        profile = models.GithubProfile('user1')
+        headers = dict(rate_limit_headers(0), **{'X-RateLimit-Resource': 'graphql'})
+        responses = [
+            (200, headers, {'data': {'viewer': None}}),
+            (200, rate_limit_headers(57), {'followers': 1}),
+        ]
+        with FakeUpstream(responses) as upstream, mock.patch.object(profile, 'transport', inst):
+            with mock.patch('service.constants.GITHUB_GRAPHQL_URL', upstream.url + '/graphql'), \
+                    mock.patch('service.constants.GITHUB_PROFILE_URL', upstream.url + '/users/{username}'):
+                profile.query('query { viewer { login } }', {})
+                profile.get_user_profile()
+                with self.assertRaises(ratelimit.RateLimitExceeded):
+                    profile.query('query { viewer { login } }', {})
+
+        self.assertEqual(len(upstream.requests), 2)
+        self.assertEqual(scheduler.budget('github', 'anonymous').remaining, 57)
+        self.assertEqual(scheduler.budget('github', 'anonymous', 'graphql').remaining, 0)
+
+    def test_profile_priority(self):
+        scheduler = make_scheduler()
+        inst = transport.Transport(hosts=(), scheduler=scheduler)
+        profile = models.GithubProfile('user1')
+        profile.priority = ratelimit.BACKGROUND
+        responses = [
+            (200, rate_limit_headers(5), {'followers': 1}),
+            (200, rate_limit_headers(4), {'followers': 1}),
+        ]
+        with FakeUpstream(responses) as upstream, mock.patch.object(profile, 'transport', inst):
+            with mock.patch('service.constants.GITHUB_PROFILE_URL', upstream.url + '/users/{username}'):
+                profile.get_user_profile()
+                with self.assertRaises(ratelimit.RateLimitExceeded):
+                    profile.get_user_profile()
+
+        self.assertEqual(profile.user_profile, {'followers': 1})
+        self.assertEqual(len(upstream.requests), 1)
@@ -1,6 +1,11 @@
+import json
+import threading
+import time
 from unittest import mock, TestCase
 
-from service import routes
+from flask import Flask
+
+from service import create_app, routes
 from tests import RequestContext
 
 
@@ -12,7 +17,15 @@ class GetProfileTestCase(TestCase):
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json, {'profile': 'data'})
-        mock_handler.assert_called_once_with('user1', 'user2')
+        mock_handler.assert_called_once_with('user1', 'user2', refresh=False, trace=None)
+
+    @RequestContext('/api/profile?github=user1&bitbucket=user2&refresh=true')
+    def test_get_profile_refresh(self):
+        with mock.patch.object(routes, 'handle_get_profile', return_value={'profile': 'data'}) as mock_handler:
+            response = routes.get_profile()
+
+        self.assertEqual(response.status_code, 200)
+        mock_handler.assert_called_once_with('user1', 'user2', refresh=True, trace=None)
 
     @RequestContext('/api/profile?bitbucket=user2')
     def test_no_github_username(self):
@@ -27,3 +40,162 @@ class GetProfileTestCase(TestCase):
 
         self.assertEqual(response.status_code, 400)
         self.assertEqual(response.json, {"error": "No bitbucket in request params"})
+
+    @RequestContext('/api/profile?github=user1&bitbucket=user2')
+    def test_get_profile_timeout(self):
+        error = routes.ProfileFetchTimeout('github', 'user1')
+        with mock.patch.object(routes, 'handle_get_profile', side_effect=error):
+            response = routes.get_profile()
+
+        self.assertEqual(response.status_code, 504)
+        self.assertEqual(response.json, {"error": "Timed out fetching github profile for user1"})
+
+    @RequestContext('/api/profile?github=user1&bitbucket=user2&debug=true')
+    def test_get_profile_debug(self):
+        def handler(github_username, bitbucket_username, refresh, trace):
+            trace.record_call('github', 'profile', 'GET', 'https://a', 200, 100, 0.25)
+            return {'profile': 'data'}
+
+        with mock.patch.object(routes, 'handle_get_profile', side_effect=handler):
+            response = routes.get_profile()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['server-timing'].startswith('github;dur=250.0;desc="1 calls 100 bytes", '))
+        self.assertEqual(response.json['profile'], 'data')
+        self.assertEqual(response.json['trace']['upstream']['github']['calls'], 1)
+
+    @RequestContext('/api/profile?github=user1&bitbucket=user2')
+    def test_get_profile_rate_limited(self):
+        error = routes.RateLimitExceeded('github', retry_after=12.5)
+        with mock.patch.object(routes, 'handle_get_profile', side_effect=error):
+            response = routes.get_profile()
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['retry-after'], '13')
+        self.assertEqual(response.json, {"error": "Rate limit reached for github"})
+
+
+class GetProfileAsyncTestCase(TestCase):
+    @RequestContext('/api/async/profile?github=user1&bitbucket=user2')
+    def test_get_profile_async(self):
+        with mock.patch.object(routes, 'handle_get_profile_async', return_value={'profile': 'data'}) as mock_handler:
+            response = routes.get_profile_async()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {'profile': 'data'})
+        mock_handler.assert_called_once_with('user1', 'user2', refresh=False, trace=None)
+
+    @RequestContext('/api/async/profile?github=user1')
+    def test_no_bitbucket_username(self):
+        response = routes.get_profile_async()
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json, {"error": "No bitbucket in request params"})
+
+
+class GetProfilesTestCase(TestCase):
+    @RequestContext('/api/profiles', method='POST', data='[{"github": "user1", "bitbucket": "user2"}]')
+    def test_get_profiles(self):
+        items = [{'github': 'user1', 'bitbucket': 'user2', 'profile': {'profile': 'data'}}]
+        with mock.patch.object(routes, 'handle_get_profiles', return_value=items) as mock_handler:
+            response = routes.get_profiles()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, items)
+        mock_handler.assert_called_once_with([{'github': 'user1', 'bitbucket': 'user2'}], refresh=False)
+
+    @RequestContext('/api/profiles?stream=true', method='POST', data='[{"github": "user1", "bitbucket": "user2"}, {}]')
+    def test_get_profiles_stream(self):
+        items = [(1, {'error': 'No github in item'}), (0, {'github': 'user1', 'bitbucket': 'user2', 'profile': {}})]
+        with mock.patch.object(routes, 'iter_profiles', return_value=iter(items)):
+            response = routes.get_profiles()
+            lines = response.get_data(as_text=True).splitlines()
+
+        self.assertEqual(response.headers['content-type'], 'application/x-ndjson')
+        self.assertEqual([json.loads(line) for line in lines], [
+            {'index': 1, 'error': 'No github in item'},
+            {'index': 0, 'github': 'user1', 'bitbucket': 'user2', 'profile': {}},
+        ])
+
+    @RequestContext('/api/profiles', method='POST', data='{"github": "user1"}')
+    def test_not_a_list(self):
+        response = routes.get_profiles()
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json, {"error": "Request body must be a list of github and bitbucket usernames"})
+
+    @RequestContext('/api/profiles', method='POST', data='[{}, {}, {}]')
+    def test_too_many_items(self):
+        with mock.patch.object(routes.constants, 'BATCH_MAX_ITEMS', 2):
+            response = routes.get_profiles()
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json, {"error": "No more than 2 profiles per request"})
+
+
+class GetMetricsTestCase(TestCase):
+    def setUp(self):
+        app = Flask(__name__)
+        app.register_blueprint(routes.api_blueprint)
+        self.client = app.test_client()
+
+    def scrape(self):
+        response = self.client.get('/metrics')
+        lines = response.get_data(as_text=True).splitlines()
+        samples = (line.rsplit(' ', 1) for line in lines if not line.startswith('#'))
+        return response, {sample: float(value) for sample, value in samples}
+
+    def test_get_metrics(self):
+        count = 'git_profile_request_duration_seconds_count{route="/api/profile",method="GET",status="200"}'
+        _, before = self.scrape()
+        with mock.patch.object(routes, 'handle_get_profile', return_value={'profile': 'data'}):
+            self.client.get('/api/profile?github=user1&bitbucket=user2')
+        routes.scheduler.update('github', 'anonymous', {'x-ratelimit-limit': '60', 'x-ratelimit-remaining': '42'}, 200)
+
+        response, after = self.scrape()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['content-type'].startswith('text/plain'))
+        self.assertEqual(after[count] - before.get(count, 0), 1)
+        self.assertEqual(after['git_profile_requests_in_flight{route="/api/profile"}'], 0)
+        self.assertEqual(after['git_profile_requests_in_flight{route="/metrics"}'], 1)
+        self.assertEqual(
+            after['git_profile_ratelimit_remaining{provider="github",resource="core",credential="anonymous"}'], 42,
+        )
+        self.assertIn('git_profile_cache_hit_ratio{cache="provider"}', after)
+
+    def test_single_flight_metrics(self):
+        executions = 'git_profile_singleflight_executions_total{engine="sync"}'
+        coalesced = 'git_profile_singleflight_coalesced_total{engine="sync"}'
+        flight = routes.handlers.profile_flight
+        _, before = self.scrape()
+        calls = flight.stats['calls']
+        release = threading.Event()
+        threads = [
+            threading.Thread(target=flight.do, args=('metrics-test', lambda: release.wait(5))) for _ in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        while flight.stats['calls'] < calls + 3:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        _, after = self.scrape()
+
+        self.assertEqual(after[executions] - before.get(executions, 0), 1)
+        self.assertEqual(after[coalesced] - before.get(coalesced, 0), 2)
+        self.assertIn('git_profile_singleflight_executions_total{engine="async"}', after)
+
+
+class CreateAppTestCase(TestCase):
+    def test_routes_registered(self):
+        client = create_app().test_client()
+
+        with mock.patch.object(routes, 'handle_get_profile', return_value={'profile': 'data'}):
+            response = client.get('/api/profile?github=user1&bitbucket=user2')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {'profile': 'data'})
+        self.assertIsNot(create_app(), create_app())
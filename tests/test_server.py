@@ -0,0 +1,53 @@
+from unittest import mock, skipIf, TestCase
+
+try:
+    from service import server
+except ImportError:
+    server = None
+
+
+@skipIf(server is None, 'gunicorn is not installed')
+class ProductionServerTestCase(TestCase):
+    def test_options(self):
+        settings = server.options('127.0.0.1:5000', workers=3, threads=4, graceful_timeout=10, preload=False)
+
+        self.assertEqual(settings['bind'], '127.0.0.1:5000')
+        self.assertEqual(settings['workers'], 3)
+        self.assertEqual(settings['threads'], 4)
+        self.assertEqual(settings['worker_class'], 'gthread')
+        self.assertEqual(settings['graceful_timeout'], 10)
+        self.assertFalse(settings['preload_app'])
+
+    def test_config(self):
+        application = server.ProductionServer(server.options('127.0.0.1:5000', workers=3))
+
+        self.assertEqual(application.cfg.workers, 3)
+        self.assertTrue(application.cfg.preload_app)
+
+    def test_load_warms_caches(self):
+        with mock.patch.object(server.handlers, 'warm_start') as mock_warm_start:
+            app = server.load_app()
+
+        mock_warm_start.assert_called_once_with()
+        self.assertIn('api.get_metrics', app.view_functions)
+
+    def test_post_worker_init(self):
+        scheduler = mock.Mock()
+        worker = mock.Mock()
+        worker.cfg.workers = 3
+        worker.cfg.threads = 16
+        with mock.patch.object(server.ratelimit, 'scheduler', scheduler), \
+                mock.patch.object(server.handlers, 'profile_executor') as profile_executor:
+            server.post_worker_init(worker)
+            resized_executor = server.handlers.profile_executor
+
+        scheduler.share.assert_called_once_with(3)
+        self.assertIsNot(resized_executor, profile_executor)
+        self.assertEqual(resized_executor._max_workers, 32)
+
+    def test_worker_exit_flushes_store(self):
+        snapshot_store = mock.Mock()
+        with mock.patch.object(server.handlers, 'snapshot_store', snapshot_store):
+            server.worker_exit(mock.Mock(), mock.Mock())
+
+        snapshot_store.flush.assert_called_once_with()
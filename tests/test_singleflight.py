@@ -0,0 +1,112 @@
+import asyncio
+import threading
+from unittest import TestCase
+
+from service import aio, singleflight
+
+
+class SingleFlightTestCase(TestCase):
+    def run_concurrently(self, flight, key, func, count):
+        results = []
+        errors = []
+
+        def call():
+            try:
+                results.append(flight.do(key, func))
+            except ValueError as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=call) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, errors
+
+    def test_do_coalesces(self):
+        flight = singleflight.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def func():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'result'
+
+        leader = threading.Thread(target=flight.do, args=('key', func))
+        leader.start()
+        started.wait(5)
+        threading.Timer(0.05, release.set).start()
+        results, errors = self.run_concurrently(flight, 'key', func, 4)
+        leader.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['result'] * 4)
+        self.assertEqual(flight.stats, {'calls': 5, 'executions': 1, 'coalesced': 4})
+
+    def test_do_shares_exception(self):
+        flight = singleflight.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+
+        def func():
+            started.set()
+            release.wait(5)
+            raise ValueError('bad')
+
+        leader = threading.Thread(target=lambda: self.assertRaises(ValueError, flight.do, 'key', func))
+        leader.start()
+        started.wait(5)
+        threading.Timer(0.05, release.set).start()
+        results, errors = self.run_concurrently(flight, 'key', func, 3)
+        leader.join()
+
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(flight.stats['executions'], 1)
+
+    def test_do_sequential_calls_not_coalesced(self):
+        flight = singleflight.SingleFlight()
+
+        self.assertEqual(flight.do('key', lambda: 1), 1)
+        self.assertEqual(flight.do('key', lambda: 2), 2)
+        self.assertEqual(flight.stats['coalesced'], 0)
+
+
+class AsyncSingleFlightTestCase(TestCase):
+    def test_do_coalesces(self):
+        flight = singleflight.AsyncSingleFlight()
+        calls = []
+
+        async def func():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 'result'
+
+        async def main():
+            return await asyncio.gather(*(flight.do('key', func) for _ in range(5)))
+
+        results = aio.run(main())
+
+        self.assertEqual(results, ['result'] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.stats, {'calls': 5, 'executions': 1, 'coalesced': 4})
+
+    def test_do_survives_leader_cancel(self):
+        flight = singleflight.AsyncSingleFlight()
+
+        async def func():
+            await asyncio.sleep(0.05)
+            return 'result'
+
+        async def main():
+            leader = asyncio.ensure_future(flight.do('key', func))
+            await asyncio.sleep(0)
+            follower = asyncio.ensure_future(flight.do('key', func))
+            await asyncio.sleep(0)
+            leader.cancel()
+            return await follower
+
+        self.assertEqual(aio.run(main()), 'result')
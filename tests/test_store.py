@@ -0,0 +1,97 @@
+import os
+import sqlite3
+import tempfile
+import time
+from unittest import mock, TestCase
+
+from service import store
+
+AGGREGATE = [2, 1, 0, 0, 0, 3, 10, ['Python'], ['flask']]
+RECORDS = {
+    'user1/repo1': ['2020-01-01T00:00:00Z', 1, 0, 3, 4, 'Python', ['flask']],
+    'user1/repo2': ['2020-01-02T00:00:00Z', 0, 0, 0, 6, None, []],
+}
+
+
+class SnapshotStoreTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'snapshots.db')
+        self.store = store.SnapshotStore(self.path, flush_interval=60)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_queued_writes_are_read_back(self):
+        self.store.put('github', 'user1', AGGREGATE, RECORDS)
+
+        self.assertEqual(self.store.get('github', 'user1'), {'aggregate': AGGREGATE, 'repos': RECORDS})
+        self.assertEqual(self.store.aggregate('github', 'user1')[0], AGGREGATE)
+        self.assertEqual(self.store.stats['written'], 0)
+
+    def test_flush_persists_across_instances(self):
+        self.store.put('github', 'user1', AGGREGATE, RECORDS)
+        self.store.put('bitbucket', 'user1', AGGREGATE)
+
+        self.assertEqual(self.store.flush(), 2)
+        reopened = store.SnapshotStore(self.path)
+
+        self.assertEqual(reopened.get('github', 'user1'), {'aggregate': AGGREGATE, 'repos': RECORDS})
+        self.assertEqual(reopened.aggregate('bitbucket', 'user1')[0], AGGREGATE)
+        self.assertIsNone(reopened.get('bitbucket', 'user1'))
+        self.assertIsNone(reopened.aggregate('github', 'user2'))
+
+    def test_put_replaces_repos(self):
+        self.store.put('github', 'user1', AGGREGATE, RECORDS)
+        self.store.flush()
+        self.store.put('github', 'user1', AGGREGATE, {'user1/repo3': RECORDS['user1/repo1']})
+        self.store.flush()
+
+        self.assertEqual(list(self.store.get('github', 'user1')['repos']), ['user1/repo3'])
+
+    def test_put_without_records_keeps_repos(self):
+        self.store.put('github', 'user1', AGGREGATE, RECORDS)
+        self.store.flush()
+        self.store.put('github', 'user1', AGGREGATE)
+        self.store.flush()
+
+        self.assertIsNone(self.store.get('github', 'user1'))
+        self.assertEqual(self.store.connection.execute('SELECT COUNT(*) FROM repos').fetchone()[0], 2)
+
+    def test_failed_flush_requeues_batch(self):
+        self.store.put('github', 'user1', AGGREGATE, RECORDS)
+        connection = mock.Mock(in_transaction=False)
+        connection.execute.side_effect = sqlite3.OperationalError('database is locked')
+
+        with mock.patch.object(store.SnapshotStore, 'connection', connection):
+            with self.assertRaises(sqlite3.OperationalError):
+                self.store.flush()
+
+        connection.execute.assert_called_once_with('BEGIN IMMEDIATE')
+        self.assertEqual(self.store.stats['queued'], 1)
+        self.assertEqual(self.store._flushing, {})
+        self.assertEqual(self.store.flush(), 1)
+        self.assertEqual(self.store.get('github', 'user1'), {'aggregate': AGGREGATE, 'repos': RECORDS})
+
+    def test_writes_are_batched(self):
+        self.store.flush_interval = 0.01
+        for index in range(20):
+            self.store.put('github', 'user{}'.format(index), AGGREGATE)
+
+        deadline = time.time() + 5
+        while self.store.stats['written'] < 20 and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(self.store.stats['written'], 20)
+        self.assertLess(self.store.stats['batches'], 20)
+
+    def test_recent(self):
+        self.store.put('github', 'user1', AGGREGATE)
+        self.store.put('bitbucket', 'user2', AGGREGATE)
+
+        recent = self.store.recent(1)
+
+        self.assertEqual([(provider, username) for provider, username, _, _ in recent], [('bitbucket', 'user2')])
+
+    def test_from_path(self):
+        self.assertIsNone(store.from_path(''))
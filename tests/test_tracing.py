@@ -0,0 +1,61 @@
+from unittest import TestCase
+
+import responses
+
+from service import constants, models, tracing
+
+
+class TraceTestCase(TestCase):
+    def test_record_call(self):
+        trace = tracing.Trace()
+        trace.record_call('github', 'profile', 'GET', 'https://a', 200, 100, 0.25)
+        trace.record_call('github', 'list', 'GET', 'https://b', 304, 50, 0.5)
+        trace.record_call('bitbucket', 'count', 'GET', 'https://c', 200, 10, 0.125)
+
+        self.assertEqual(trace.upstream(), {
+            'github': {'calls': 2, 'bytes': 150, 'duration_ms': 750, 'statuses': {'200': 1, '304': 1}},
+            'bitbucket': {'calls': 1, 'bytes': 10, 'duration_ms': 125, 'statuses': {'200': 1}},
+        })
+        trace_dict = trace.dict()
+        self.assertEqual(len(trace_dict['calls']), 3)
+        self.assertEqual(trace_dict['calls'][0]['kind'], 'profile')
+
+    def test_phase(self):
+        trace = tracing.Trace()
+        trace.add_phase('decode', 0.001)
+        with trace.phase('decode'):
+            pass
+        with tracing.phase(None, 'decode'):
+            pass
+
+        self.assertEqual(list(trace.phases), ['decode'])
+        self.assertGreaterEqual(trace.phases['decode'], 0.001)
+
+    def test_server_timing(self):
+        trace = tracing.Trace()
+        trace.record_call('github', 'profile', 'GET', 'https://a', 200, 100, 0.25)
+        trace.add_phase('aggregate', 0.002)
+
+        metrics = trace.server_timing().split(', ')
+
+        self.assertEqual(metrics[0], 'github;dur=250.0;desc="1 calls 100 bytes"')
+        self.assertEqual(metrics[1], 'aggregate;dur=2.0')
+        self.assertTrue(metrics[2].startswith('total;dur='))
+
+
+class ProfileTraceTestCase(TestCase):
+    @responses.activate
+    def test_profile_records_calls(self):
+        responses.add(responses.GET, constants.GITHUB_PROFILE_URL.format(username='user1'), json={'followers': 1})
+
+        profile = models.GithubProfile('user1')
+        profile.trace = tracing.Trace()
+        profile.get_user_profile()
+        profile.add_repos([])
+
+        call, = profile.trace.calls
+        self.assertEqual(call['provider'], 'github')
+        self.assertEqual(call['kind'], 'profile')
+        self.assertEqual(call['status'], 200)
+        self.assertEqual(call['bytes'], len(b'{"followers": 1}'))
+        self.assertCountEqual(profile.trace.phases, ['decode', 'aggregate'])
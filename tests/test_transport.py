@@ -0,0 +1,119 @@
+from unittest import TestCase
+
+import requests
+import responses
+
+from service import models, transport
+
+
+class TransportTestCase(TestCase):
+    def test_init(self):
+        inst = transport.Transport(hosts=('https://example.com',), pool_size=4, retries=2, timeout=(1, 2))
+
+        adapter = inst.session.get_adapter('https://example.com/path')
+        self.assertEqual(adapter._pool_maxsize, 4)
+        self.assertEqual(adapter.max_retries.total, 2)
+        self.assertNotIn(429, adapter.max_retries.status_forcelist)
+        self.assertFalse(adapter.max_retries.respect_retry_after_header)
+        self.assertEqual(inst.timeout, (1, 2))
+
+    def test_profiles_share_transport(self):
+        github_profile = models.GithubProfile('user1')
+        bitbucket_profile = models.BitbucketProfile('user2')
+
+        self.assertIs(github_profile.transport, bitbucket_profile.transport)
+        self.assertIs(github_profile.transport, models.Profile.transport)
+
+    @responses.activate
+    def test_get(self):
+        responses.add(responses.GET, 'https://api.github.com/users/user1', json={'profile': 'data'})
+
+        inst = transport.Transport()
+        response = inst.get('https://api.github.com/users/user1', headers={'accept': 'application/json'})
+
+        self.assertEqual(response.json(), {'profile': 'data'})
+        self.assertEqual(responses.calls[0].request.headers['accept'], 'application/json')
+
+    @responses.activate
+    def test_head(self):
+        responses.add(responses.HEAD, 'https://api.github.com/users/user1', headers={'link': '<a>; rel="last"'})
+
+        inst = transport.Transport()
+        response = inst.head('https://api.github.com/users/user1')
+
+        self.assertEqual(response.links['last']['url'], 'a')
+
+    @responses.activate
+    def test_conditional_get(self):
+        url = 'https://api.github.com/users/user1'
+        responses.add(responses.GET, url, json={'profile': 'data'}, headers={'etag': '"abc"'})
+        responses.add(responses.GET, url, status=304)
+
+        inst = transport.Transport()
+        first = inst.get(url, conditional=True)
+        second = inst.get(url, conditional=True)
+
+        self.assertEqual(first.json(), {'profile': 'data'})
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.json(), {'profile': 'data'})
+        self.assertNotIn('if-none-match', responses.calls[0].request.headers)
+        self.assertEqual(responses.calls[1].request.headers['if-none-match'], '"abc"')
+
+    @responses.activate
+    def test_conditional_head_keeps_links(self):
+        url = 'https://api.github.com/users/user1/starred?per_page=1'
+        responses.add(
+            responses.HEAD, url,
+            headers={'last-modified': 'Mon, 01 Jan 2018 00:00:00 GMT', 'link': '<a?page=5>; rel="last"'}
+        )
+        responses.add(responses.HEAD, url, status=304)
+
+        inst = transport.Transport()
+        inst.head(url, conditional=True)
+        response = inst.head(url, conditional=True)
+
+        self.assertEqual(response.links['last']['url'], 'a?page=5')
+        self.assertEqual(responses.calls[1].request.headers['if-modified-since'], 'Mon, 01 Jan 2018 00:00:00 GMT')
+
+    @responses.activate
+    def test_unconditional_get_not_stored(self):
+        url = 'https://api.github.com/users/user1'
+        responses.add(responses.GET, url, json={'profile': 'data'}, headers={'etag': '"abc"'})
+
+        inst = transport.Transport()
+        inst.get(url)
+
+        self.assertEqual(len(inst.validators), 0)
+
+
+class ValidatorStoreTestCase(TestCase):
+    def make_response(self, content, etag='"abc"'):
+        response = requests.Response()
+        response.status_code = 200
+        response.headers['etag'] = etag
+        response._content = content
+        return response
+
+    def test_without_validators(self):
+        store = transport.ValidatorStore()
+        response = self.make_response(b'{}', etag=None)
+        del response.headers['etag']
+        store.set('a', response)
+
+        self.assertEqual(len(store), 0)
+
+    def test_evict_by_entries(self):
+        store = transport.ValidatorStore(max_entries=1)
+        store.set('a', self.make_response(b'1'))
+        store.set('b', self.make_response(b'2'))
+
+        self.assertIsNone(store.get('a'))
+        self.assertEqual(store.get('b')['content'], b'2')
+
+    def test_evict_by_bytes(self):
+        store = transport.ValidatorStore(max_bytes=5)
+        store.set('a', self.make_response(b'123'))
+        store.set('b', self.make_response(b'456'))
+
+        self.assertIsNone(store.get('a'))
+        self.assertEqual(store.current_bytes, 3)